@@ -0,0 +1,37 @@
+"""
+Benchmark of brainbox.metrics.single_units.quick_unit_metrics as a function of the number of spikes
+and of the number of clusters, computed in a single process and in a process pool.
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from brainbox.metrics.single_units import quick_unit_metrics
+
+REC_LEN_SECS = 3600
+N_WORKERS = 4
+
+
+def random_spikes(nspikes, nclusters, rec_len_secs=REC_LEN_SECS):
+    """Uniformly distributed spike times with log-normal cluster sizes"""
+    spike_times = np.sort(np.random.rand(nspikes) * rec_len_secs)
+    weights = np.exp(np.random.normal(0, 1, nclusters))
+    spike_clusters = np.random.choice(nclusters, nspikes, p=weights / weights.sum())
+    spike_amps = np.exp(np.random.normal(5.5, 0.5, nspikes)) / 1e6
+    spike_depths = np.random.rand(nspikes) * 3840
+    return spike_clusters, spike_times, spike_amps, spike_depths
+
+
+results = []
+for nspikes, nclusters in [(1e6, 100), (1e6, 500), (1e6, 1000), (5e6, 1000), (1e7, 1000)]:
+    np.random.seed(42)
+    spikes = random_spikes(int(nspikes), nclusters)
+    for n_workers in [1, N_WORKERS]:
+        t0 = time.time()
+        quick_unit_metrics(*spikes, n_workers=n_workers)
+        results.append({'nspikes': int(nspikes), 'nclusters': nclusters, 'n_workers': n_workers,
+                        'time_secs': time.time() - t0})
+        print(results[-1])
+
+print(pd.DataFrame(results).pivot_table(index=['nspikes', 'nclusters'], columns='n_workers', values='time_secs'))
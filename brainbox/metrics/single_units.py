@@ -15,6 +15,7 @@ Run the following to set-up the workspace to run the docstring examples:
 >>> units_b = bb.processing.get_units_bunch(spks_b)  # may take a few mins to compute
 """
 
+from concurrent.futures import ProcessPoolExecutor
 import time
 import logging
 
@@ -661,15 +662,16 @@ def contamination(ts, min_time, max_time, rp=0.002, min_isi=0.0001):
 def _max_acceptable_cont(FR, RP, rec_duration, acceptableCont, thresh):
     """
     Function to compute the maximum acceptable refractory period contamination
-        called during slidingRP_viol
+        called during slidingRP_viol, the inputs may be broadcastable arrays
     """
 
     time_for_viol = RP * 2 * FR * rec_duration
     expected_count_for_acceptable_limit = acceptableCont * time_for_viol
     max_acceptable = stats.poisson.ppf(thresh, expected_count_for_acceptable_limit)
-    if max_acceptable == 0 and stats.poisson.pmf(0, expected_count_for_acceptable_limit) > 0:
-        max_acceptable = -1
-    return max_acceptable
+    # works element-wise on arrays of units and refractory periods
+    return np.where(np.logical_and(max_acceptable == 0,
+                                   stats.poisson.pmf(0, expected_count_for_acceptable_limit) > 0),
+                    -1, max_acceptable)
 
 
 def slidingRP_viol(ts, bin_size=0.25, thresh=0.1, acceptThresh=0.1):
@@ -757,6 +759,99 @@ def slidingRP_viol(ts, bin_size=0.25, thresh=0.1, acceptThresh=0.1):
     return didpass
 
 
+def _slidingRP_viol_sorted(spike_times, bounds, bin_size=0.25, thresh=0.1, acceptThresh=0.1):
+    """
+    Computes slidingRP_viol for all units at once, on spikes sorted by units: the spikes of unit i are
+    contiguous and sorted in time between indices bounds[i, 0] and bounds[i, 1].
+    The autocorrelograms of all units are computed in a single pass over the spike pairs, with the
+    same discretization as the phylib correlograms used by slidingRP_viol.
+    :return: didpass int array (nunits,)
+    """
+    b = np.arange(0, 10.25, bin_size) / 1000 + 1e-6  # bins in seconds
+    bTestIdx = np.array([5, 6, 7, 8, 10, 12, 14, 16, 18, 20, 24, 28, 32, 36, 40])
+    bTest = b[bTestIdx]
+    sample_rate, window_size = (20000, 2)
+    binsize = int(sample_rate * np.clip(bin_size / 1000, 1e-5, 1e5))  # in samples
+    nbins = int(.5 * np.clip(window_size, 1e-5, 1e5) / np.clip(bin_size / 1000, 1e-5, 1e5)) + 1
+    # gather the spikes of the units, labeled by unit index
+    nunits = bounds.shape[0]
+    nspikes = bounds[:, 1] - bounds[:, 0]
+    ispikes = np.repeat(bounds[:, 0] - np.r_[0, np.cumsum(nspikes)[:-1]], nspikes) + np.arange(np.sum(nspikes))
+    units = np.repeat(np.arange(nunits), nspikes)
+    samples = (np.asarray(spike_times, dtype=np.float64)[ispikes] * sample_rate).astype(np.int64)
+    # the autocorrelograms count the pairs of spikes of the same unit within the window, the pairs
+    # are enumerated by increasing shift, a spike is dropped as soon as its next pair is out of reach
+    acg = np.zeros(nunits * nbins, dtype=np.int64)
+    i0 = np.arange(samples.size)
+    shift = 1
+    while i0.size > 0:
+        i0 = i0[i0 + shift < samples.size]
+        i1 = i0 + shift
+        d = (samples[i1] - samples[i0]) // binsize
+        keep = np.logical_and(units[i1] == units[i0], d <= nbins - 1)
+        i0, d = (i0[keep], d[keep])
+        counts = np.bincount(units[i0] * nbins + d)
+        acg[:counts.size] += counts
+        shift += 1
+    acg = acg.reshape(nunits, nbins)
+    # cumulative sum of the acg at each of the testing bins
+    res = np.cumsum(acg, axis=1)[:, bTestIdx]
+    # compute fr based on the mean of the normalized acg from 1 to 2 s, as in slidingRP_viol
+    bin_count_normalized = acg / np.maximum(nspikes, 1)[:, np.newaxis] / bin_size * 1000
+    num_bins_1s = int(nbins / 2)
+    fr = np.sum(bin_count_normalized[:, num_bins_1s:nbins], axis=1) / num_bins_1s
+    rec_dur = np.zeros(nunits)
+    has_spikes = nspikes > 0
+    rec_dur[has_spikes] = (spike_times[bounds[has_spikes, 1] - 1] - spike_times[bounds[has_spikes, 0]])
+    # the maximum allowed number of spikes for all units and testing bins in one array operation
+    m = _max_acceptable_cont(fr[:, np.newaxis], bTest[np.newaxis, :], rec_dur[:, np.newaxis],
+                             fr[:, np.newaxis] * acceptThresh, thresh)
+    didpass = np.any(np.less_equal(res, m), axis=1).astype(int)
+    # only units with samples can pass
+    didpass[rec_dur <= 0] = 0
+    return didpass
+
+
+def slidingRP_viol_clusters(spike_times, spike_clusters, cluster_ids=None, bin_size=0.25, thresh=0.1,
+                            acceptThresh=0.1):
+    """
+    Batched version of slidingRP_viol computing the metric for all clusters at once.
+
+    Parameters
+    ----------
+    spike_times : ndarray_like
+        The timestamps (in s) of the spikes, sorted.
+    spike_clusters : ndarray_like
+        The cluster ids of the spikes.
+    cluster_ids : ndarray_like (optional)
+        The cluster ids for which to compute the metric, defaults to the unique spike_clusters
+    bin_size, thresh, acceptThresh : see slidingRP_viol
+
+    Returns
+    -------
+    didpass : ndarray
+        For each cluster, 0 if unit didn't pass, 1 if unit did pass
+
+    See Also
+    --------
+    slidingRP_viol
+
+    Examples
+    --------
+    1) Compute the sliding refractory period metric for all clusters
+        >>> didpass = bb.metrics.slidingRP_viol_clusters(spks_b['times'], spks_b['clusters'])
+    """
+    if cluster_ids is None:
+        cluster_ids = np.unique(spike_clusters)
+    # sort the spikes by cluster, the stable sort keeps the spikes of each cluster in time order
+    isort = np.argsort(spike_clusters, kind='stable')
+    sorted_clusters = spike_clusters[isort]
+    bounds = np.c_[np.searchsorted(sorted_clusters, cluster_ids, side='left'),
+                   np.searchsorted(sorted_clusters, cluster_ids, side='right')]
+    return _slidingRP_viol_sorted(spike_times[isort], bounds, bin_size=bin_size, thresh=thresh,
+                                  acceptThresh=acceptThresh)
+
+
 def noise_cutoff(amps, quartile_length=.2, n_bins=100, n_low_bins=2):
     """
     A metric to determine whether a unit's amplitude distribution is cut off
@@ -849,8 +944,50 @@ def spike_sorting_metrics(times, clusters, amps, depths, cluster_ids=None, param
     return df_units, rec_qc
 
 
+def _units_metrics(spike_times, spike_amps, spike_depths, bounds, tmin, tmax, params=METRICS_PARAMS):
+    """
+    Computes the metrics of quick_unit_metrics that require looping over units, on spikes sorted by
+    units: the spikes of unit i are contiguous between indices bounds[i, 0] and bounds[i, 1]
+    Units without spikes have NaN metrics.
+    :return: dictionary of metrics arrays (nunits,)
+    """
+    nunits = bounds.shape[0]
+    metrics_list = ['contamination', 'contamination_alt', 'drift', 'missed_spikes_est', 'noise_cutoff',
+                    'slidingRP_viol']
+    r = {k: np.full((nunits,), np.nan) for k in metrics_list}
+    # the sliding refractory period metric is computed for all units at once
+    has_spikes = bounds[:, 1] > bounds[:, 0]
+    r['slidingRP_viol'][has_spikes] = _slidingRP_viol_sorted(
+        spike_times, bounds[has_spikes], bin_size=params['bin_size'], thresh=params['RPslide_thresh'],
+        acceptThresh=params['acceptable_contamination'])
+    for ic in np.arange(nunits):
+        # slice the sorted spike arrays
+        if bounds[ic, 1] == bounds[ic, 0]:  # if this cluster has no spikes, continue
+            continue
+        ts = spike_times[bounds[ic, 0]:bounds[ic, 1]]
+        amps = spike_amps[bounds[ic, 0]:bounds[ic, 1]]
+        depths = spike_depths[bounds[ic, 0]:bounds[ic, 1]]
+
+        # compute metrics
+        r['contamination_alt'][ic] = contamination_alt(ts, rp=params['refractory_period'])
+        r['contamination'][ic], _ = contamination(
+            ts, tmin, tmax, rp=params['refractory_period'], min_isi=params['min_isi'])
+        r['noise_cutoff'][ic] = noise_cutoff(amps,
+                                             quartile_length=params['nc_quartile_length'],
+                                             n_bins=params['nc_bins'],
+                                             n_low_bins=params['nc_n_low_bins'])
+        r['missed_spikes_est'][ic], _, _ = missed_spikes_est(
+            amps, spks_per_bin=params['spks_per_bin_for_missed_spks_est'],
+            sigma=params['std_smoothing_kernel_for_missed_spks_est'],
+            min_num_bins=params['min_num_bins_for_missed_spks_est'])
+
+        # wonder if there is a need to low-cut this
+        r['drift'][ic] = np.sum(np.abs(np.diff(depths))) / (tmax - tmin) * 3600
+    return r
+
+
 def quick_unit_metrics(spike_clusters, spike_times, spike_amps, spike_depths,
-                       params=METRICS_PARAMS, cluster_ids=None, tbounds=None):
+                       params=METRICS_PARAMS, cluster_ids=None, tbounds=None, n_workers=1):
     """
     Computes single unit metrics from only the spike times, amplitudes, and
     depths for a set of units.
@@ -885,6 +1022,8 @@ def quick_unit_metrics(spike_clusters, spike_times, spike_amps, spike_depths,
     with the input arrays.
     tbounds: (optional) list or 2 elements array containing a time-selection to perform the
      metrics computation on.
+    n_workers: (optional) number of processes computing the per-unit metrics. Defaults to 1,
+     ie. computation in the current process.
     params : dict (optional)
         Parameters used for computing some of the metrics in the function:
             'presence_window': float
@@ -978,35 +1117,33 @@ def quick_unit_metrics(spike_clusters, spike_times, spike_amps, spike_depths,
     r.amp_median[ir] = np.array(10 ** (camp['log_amps'].median() / 20))
     r.amp_std_dB[ir] = np.array(camp['log_amps'].std())
 
-    # loop over each cluster to compute the rest of the metrics
-    for ic in np.arange(nclust):
-        # slice the spike_times array
-        ispikes = spike_clusters == cluster_ids[ic]
-        if np.all(~ispikes):  # if this cluster has no spikes, continue
-            continue
-        ts = spike_times[ispikes]
-        amps = spike_amps[ispikes]
-        depths = spike_depths[ispikes]
-
-        # compute metrics
-        r.contamination_alt[ic] = contamination_alt(ts, rp=params['refractory_period'])
-        r.contamination[ic], _ = contamination(
-            ts, tmin, tmax, rp=params['refractory_period'], min_isi=params['min_isi'])
-        r.slidingRP_viol[ic] = slidingRP_viol(ts,
-                                              bin_size=params['bin_size'],
-                                              thresh=params['RPslide_thresh'],
-                                              acceptThresh=params['acceptable_contamination'])
-        r.noise_cutoff[ic] = noise_cutoff(amps,
-                                          quartile_length=params['nc_quartile_length'],
-                                          n_bins=params['nc_bins'],
-                                          n_low_bins=params['nc_n_low_bins'])
-        r.missed_spikes_est[ic], _, _ = missed_spikes_est(
-            amps, spks_per_bin=params['spks_per_bin_for_missed_spks_est'],
-            sigma=params['std_smoothing_kernel_for_missed_spks_est'],
-            min_num_bins=params['min_num_bins_for_missed_spks_est'])
-
-        # wonder if there is a need to low-cut this
-        r.drift[ic] = np.sum(np.abs(np.diff(depths))) / (tmax - tmin) * 3600
+    # sort the spikes by cluster once, the stable sort keeps the spikes of each cluster in time order
+    isort = np.argsort(spike_clusters, kind='stable')
+    sorted_clusters = spike_clusters[isort]
+    bounds = np.c_[np.searchsorted(sorted_clusters, cluster_ids, side='left'),
+                   np.searchsorted(sorted_clusters, cluster_ids, side='right')]
+    spike_times, spike_amps, spike_depths = (spike_times[isort], spike_amps[isort], spike_depths[isort])
+    # compute the rest of the metrics on the contiguous spikes of each cluster
+    if n_workers == 1:
+        rc = _units_metrics(spike_times, spike_amps, spike_depths, bounds, tmin, tmax, params)
+        for k in rc:
+            r[k] = rc[k]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = []
+            for ic in np.array_split(np.arange(nclust), n_workers * 4):
+                if ic.size == 0:
+                    continue
+                # each worker only gets the spikes of its own clusters
+                ispikes = np.concatenate([np.arange(*b) for b in bounds[ic]] + [np.array([], dtype=int)])
+                nspikes = np.cumsum(np.r_[0, np.diff(bounds[ic], axis=1).flatten()])
+                futures.append((ic, executor.submit(
+                    _units_metrics, spike_times[ispikes], spike_amps[ispikes], spike_depths[ispikes],
+                    np.c_[nspikes[:-1], nspikes[1:]], tmin, tmax, params)))
+            for ic, future in futures:
+                rc = future.result()
+                for k in rc:
+                    r[k][ic] = rc[k]
 
     r.label = compute_labels(r)
     return r
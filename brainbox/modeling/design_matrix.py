@@ -2,8 +2,11 @@ from warnings import warn
 import numpy as np
 import pandas as pd
 import scipy.sparse as sp
+from scipy.signal import fftconvolve
 import numba as nb
 
+CONV_TOL = 1e-12  # FFT convolution values below this fraction of the maximum are set to zero
+
 
 class DesignMatrix:
     """
@@ -156,16 +159,16 @@ class DesignMatrix:
         if self.vartypes[eventname] != 'timing':
             raise TypeError(f'Column {eventname} in trialsdf is not registered as a timing')
 
-        vecsizes = self.trialsdf['duration'].apply(self.binf)
-        stiminds = self.trialsdf[eventname].apply(self.binf)
-        stimvecs = []
-        for i in self.trialsdf.index:
-            vec = np.zeros(vecsizes[i])
-            if gainmod:
-                vec[stiminds[i]] = deltaval[i]
-            else:
-                vec[stiminds[i]] = 1
-            stimvecs.append(vec.reshape(-1, 1))
+        vecsizes = self.trialsdf['duration'].apply(self.binf).to_numpy()
+        stiminds = self.trialsdf[eventname].apply(self.binf).to_numpy()
+        if np.any((stiminds >= vecsizes) | (stiminds < -vecsizes)):
+            raise IndexError(f'Some {eventname} events are out of their trial bounds.')
+        # place all the events on the concatenated trials timeline, each trial is a view of it
+        starts = np.r_[0, np.cumsum(vecsizes)[:-1]]
+        timeline = np.zeros((np.sum(vecsizes), 1))
+        timeline[starts + stiminds % np.maximum(vecsizes, 1), 0] = \
+            deltaval.loc[self.trialsdf.index].to_numpy() if gainmod else 1
+        stimvecs = np.split(timeline, starts[1:])
         regressor = pd.Series(stimvecs, index=self.trialsdf.index)
         self.add_covariate(covlabel, regressor, bases, offset, cond, desc)
         return
@@ -221,16 +224,23 @@ class DesignMatrix:
                 raise IndexError('Indices of height series does not match trialsdf.')
         elif height is None:
             height = pd.Series(np.ones(len(self.trialsdf.index)), index=self.trialsdf.index)
-        vecsizes = self.trialsdf['duration'].apply(self.binf)
-        stind = self.trialsdf[boxstart].apply(self.binf)
-        endind = self.trialsdf[boxend].apply(self.binf)
-        stimvecs = []
-        for i in self.trialsdf.index:
-            bxcar = np.zeros(vecsizes[i])
-            bxcar[stind[i]:endind[i] + 1] = height[i]
-            stimvecs.append(bxcar)
+        vecsizes = self.trialsdf['duration'].apply(self.binf).to_numpy()
+        # boxcar bounds within each trial, with the semantics of slicing bxcar[stind:endind + 1]
+        bounds = []
+        for ind in (self.trialsdf[boxstart].apply(self.binf).to_numpy(),
+                    self.trialsdf[boxend].apply(self.binf).to_numpy() + 1):
+            bounds.append(np.where(ind < 0, np.maximum(ind + vecsizes, 0), np.minimum(ind, vecsizes)))
+        stind, endind = bounds
+        isbox = endind > stind
+        # steps up and down on the concatenated trials timeline, each trial is a view of it
+        starts = np.r_[0, np.cumsum(vecsizes)[:-1]]
+        heights = height.loc[self.trialsdf.index].to_numpy()[isbox]
+        steps = np.zeros(np.sum(vecsizes) + 1)
+        np.add.at(steps, (starts + stind)[isbox], heights)
+        np.add.at(steps, (starts + endind)[isbox], -heights)
+        stimvecs = np.split(np.cumsum(steps)[:-1], starts[1:])
         regressor = pd.Series(stimvecs, index=self.trialsdf.index)
-        self.add_covariate(covlabel, regressor, None, cond, desc)
+        self.add_covariate(covlabel, regressor, None, cond=cond, desc=desc)
         return
 
     def add_covariate_raw(self, covlabel, raw,
@@ -317,12 +327,8 @@ class DesignMatrix:
             raise AttributeError(f'Covariate {covlabel} already exists in model.')
         self._compile_check()
         # Test for mismatch in length of regressor vs trials
-        mismatch = np.zeros(len(self.trialsdf.index), dtype=bool)
-        for i in self.trialsdf.index:
-            currtr = self.trialsdf.loc[i]
-            nT = self.binf(currtr.duration)
-            if regressor.loc[i].shape[0] != nT:
-                mismatch[i] = True
+        nTs = self.trialsdf['duration'].apply(self.binf).to_numpy()
+        mismatch = regressor.loc[self.trialsdf.index].apply(len).to_numpy() != nTs
 
         if np.any(mismatch):
             raise ValueError('Length mismatch between regressor and trial on trials'
@@ -355,47 +361,50 @@ class DesignMatrix:
         """
         Compiles design matrix for the current experiment based on the covariates which were added
         with the various NeuralGLM.add_covariate methods available. Can optionally compile a sparse
-        design matrix using the scipy.sparse package, however that method may take longer depending
-        on the degree of sparseness.
+        design matrix using the scipy.sparse package.
+
+        The trials are concatenated in a single timeline: each covariate is laid out over all the
+        trials at once, zeroed on the trials where it does not apply, and convolved with its bases
+        in one FFT pass that does not leak across trial boundaries (see convbasis_trials).
 
         Parameters
         ----------
         dense : bool, optional
-            Whether or not to compute a dense design matrix or a sparse one, by default True
+            Whether or not to compute a dense design matrix or a sparse one (CSR), by default True
         """
-        covars = self.covar
-        # Go trial by trial and compose smaller design matrices
-        miniDMs = []
-        rowtrials = []
-        for i, trial in self.trialsdf.iterrows():
-            nT = self.binf(trial.duration)
-            miniX = np.zeros((nT, self.currcol))
-            rowlabs = np.ones((nT, 1), dtype=int) * i
-            for cov in covars.values():
-                sidx = cov['dmcol_idx']
-                # Optionally use cond to filter out which trials to apply certain regressors,
-                if i not in cov['valid_trials']:
-                    continue
-                stim = cov['regressor'][i]
-                # Convolve Kernel or basis function with stimulus or regressor
-                if cov['bases'] is None:
-                    miniX[:, sidx] = stim
-                else:
-                    if len(stim.shape) == 1:
-                        stim = stim.reshape(-1, 1)
-                    miniX[:, sidx] = convbasis(stim, cov['bases'], self.binf(cov['offset']))
-            # Sparsify convolved result and store in miniDMs
-            if dense:
-                miniDMs.append(miniX)
-            else:
-                miniDMs.append(sp.lil_matrix(miniX))
-            rowtrials.append(rowlabs)
+        index = self.trialsdf.index.to_numpy()
+        nTs = self.trialsdf['duration'].apply(self.binf).to_numpy()
+        nbins = np.sum(nTs)
+        trlabels = np.repeat(index, nTs).reshape(-1, 1)
         if dense:
-            dm = np.vstack(miniDMs)
-
+            dm = np.zeros((nbins, self.currcol))
         else:
-            dm = sp.vstack(miniDMs).to_csc()
-        trlabels = np.vstack(rowtrials)
+            rows, cols, vals = ([], [], [])
+        for cov in self.covar.values():
+            sidx = np.atleast_1d(cov['dmcol_idx'])
+            # Optionally use cond to filter out which trials to apply certain regressors
+            valid = np.isin(index, cov['valid_trials'])
+            if not np.any(valid):
+                continue
+            stims = [np.asarray(stim) for stim in cov['regressor'].loc[index[valid]]]
+            stims = [stim.reshape(stim.shape[0], -1) for stim in stims]
+            stim = np.zeros((nbins, stims[0].shape[1]))
+            stim[np.repeat(valid, nTs)] = np.concatenate(stims)
+            # Convolve Kernel or basis function with stimulus or regressor
+            if cov['bases'] is None:
+                X = stim
+            else:
+                X = convbasis_trials(stim, cov['bases'], nTs, self.binf(cov['offset']))
+            if dense:
+                dm[:, sidx] = X
+            else:
+                r, c = np.nonzero(X)
+                rows.append(r)
+                cols.append(sidx[c])
+                vals.append(X[r, c])
+        if not dense:
+            rows, cols = (np.concatenate([[]] + rows).astype(int), np.concatenate([[]] + cols).astype(int))
+            dm = sp.csr_matrix((np.concatenate([[]] + vals), (rows, cols)), shape=(nbins, self.currcol))
         if hasattr(self, 'binnedspikes'):
             assert self.binnedspikes.shape[0] == dm.shape[0], "Oh shit. Indexing error."
         self.dm = dm
@@ -447,3 +456,39 @@ def convbasis(stim, bases, offset=0):
     elif offset > 0:
         X = X[:-offset, :]
     return X
+
+
+def convbasis_trials(stim, bases, nTs, offset=0):
+    """
+    Convolves a regressor concatenated over trials with bases functions, as convbasis applied to
+    each trial separately, in a single FFT convolution over all the trials. The trials are laid
+    out with gaps of zeros as long as the bases plus the offset, so that no trial leaks into
+    another one.
+
+    Parameters
+    ----------
+    stim : numpy.array
+        T x dx regressor of the concatenated trials
+    bases : numpy.array
+        TB x M array of M basis functions
+    nTs : numpy.array
+        number of bins of each trial, summing to T
+    offset : int, optional
+        offset in bins of the regressor relative to the bases, as in convbasis, by default 0
+
+    Returns
+    -------
+    numpy.array
+        T x (dx * M) convolved regressor, with the bases of each regressor column contiguous
+    """
+    T, dx = stim.shape
+    TB, M = bases.shape
+    gap = TB + abs(offset)
+    # position of each bin in the timeline with a gap before each trial and after the last one
+    pos = np.arange(T) + gap * (np.repeat(np.arange(len(nTs)), nTs) + 1)
+    padded = np.zeros((T + gap * (len(nTs) + 1), dx))
+    padded[pos] = stim
+    X = fftconvolve(padded[:, :, np.newaxis], bases[:, np.newaxis, :], axes=0)[pos - offset]
+    # set the FFT round off errors to zero so that the sparsity of the regressors is preserved
+    X[np.abs(X) <= CONV_TOL * np.abs(X).max(initial=0)] = 0
+    return X.reshape(T, dx * M)
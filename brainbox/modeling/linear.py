@@ -9,15 +9,17 @@ International Brain Lab, 2020
 """
 import numpy as np
 import pandas as pd
+import scipy.linalg
+import scipy.sparse as sp
 from sklearn.base import BaseEstimator
-from sklearn.linear_model import LinearRegression
+from sklearn.linear_model import LinearRegression, Ridge
 from .neural_model import NeuralModel
 
 
 class LinearGLM(NeuralModel):
     def __init__(self, design_matrix, spk_times, spk_clu,
                  binwidth=0.02, metric='rsq', estimator=None,
-                 mintrials=100):
+                 mintrials=100, solver=None, sparse=False):
         """
         Fit a linear model using a DesignMatrix object and spike data. Can use ridge regression
         or pure linear regression
@@ -46,19 +48,31 @@ class LinearGLM(NeuralModel):
         mintrials : int, optional
             Minimum number of trials in which a neuron must fire >0 spikes to be considered for
             fitting, by default 100
+        solver : str, optional
+            If 'cholesky', the least squares problem of all the cells is solved with a single
+            Cholesky factorization of the (ridge regularized) centered Gram matrix of the design
+            matrix, instead of calling the estimator. Only for LinearRegression and Ridge
+            estimators. By default None
+        sparse : bool, optional
+            Whether to hold the binned spikes as a scipy.sparse CSR matrix, by default False
         """
         super().__init__(design_matrix, spk_times, spk_clu,
-                         binwidth, mintrials)
+                         binwidth, mintrials, sparse=sparse)
         if estimator is None:
             estimator = LinearRegression()
         if not isinstance(estimator, BaseEstimator):
             raise ValueError('Estimator must be a scikit-learn estimator, e.g. LinearRegression')
+        if solver not in (None, 'cholesky'):
+            raise ValueError("solver must be None or 'cholesky'")
+        if solver == 'cholesky' and type(estimator) not in (LinearRegression, Ridge):
+            raise ValueError("The cholesky solver is only available for LinearRegression and Ridge")
         self.metric = metric
         self.estimator = estimator
+        self.solver = solver
         self.link = lambda x: x
         self.invlink = self.link
 
-    def _fit(self, dm, binned, cells=None):
+    def _fit(self, dm, binned, cells=None, init=None):
         """
         Fitting primitive that brainbox.NeuralModel.fit method will call
 
@@ -73,6 +87,8 @@ class LinearGLM(NeuralModel):
             coefficients and intercepts, must share shape with second dimension
             of binned. When None will default to a list of all cells in the model object,
             by default None
+        init : None
+            Unused, the least squares solution does not depend on initial coefficients
 
         Returns
         -------
@@ -89,10 +105,46 @@ class LinearGLM(NeuralModel):
         coefs = pd.Series(index=cells, name='coefficients', dtype=object)
         intercepts = pd.Series(index=cells, name='intercepts', dtype=object)
 
-        lm = self.estimator.fit(dm, binned)
-        weight, intercept = lm.coef_, lm.intercept_
+        try:
+            if self.solver != 'cholesky':
+                raise np.linalg.LinAlgError
+            weight, intercept = self._solve_cholesky(dm, binned)
+        except np.linalg.LinAlgError:  # singular gram matrix, the estimator gives the minimum norm solution
+            lm = self.estimator.fit(dm, binned)
+            weight, intercept = lm.coef_, lm.intercept_
         for cell in cells:
             cell_idx = np.argwhere(cells == cell)[0, 0]
             coefs.at[cell] = weight[cell_idx, :]
             intercepts.at[cell] = intercept[cell_idx]
         return coefs, intercepts
+
+    def _solve_cholesky(self, dm, binned):
+        """
+        Least squares coefficients and intercepts of all cells from the normal equations, with a
+        single Cholesky factorization of the centered Gram matrix of the design matrix, plus the
+        ridge penalty for a Ridge estimator. Same solution as the estimator for a full rank design
+        matrix.
+
+        Returns
+        -------
+        weight : np.ndarray
+            n_cells x n_regressors coefficients
+        intercept : np.ndarray
+            n_cells intercepts, zeros if the estimator does not fit an intercept
+        """
+        alpha = getattr(self.estimator, 'alpha', 0)
+        fit_intercept = self.estimator.fit_intercept
+        binned = np.asarray(binned, dtype=float)
+        xmean = np.asarray(dm.mean(axis=0)).flatten() if fit_intercept else np.zeros(dm.shape[1])
+        ymean = binned.mean(axis=0) if fit_intercept else np.zeros(binned.shape[1])
+        if sp.issparse(dm):
+            # centering would densify the design matrix, remove the means from the products instead
+            gram = (dm.T @ dm).toarray() - dm.shape[0] * np.outer(xmean, xmean)
+            xty = dm.T @ binned - dm.shape[0] * np.outer(xmean, ymean)
+        else:
+            dmc = dm - xmean
+            gram = dmc.T @ dmc
+            xty = dmc.T @ (binned - ymean)
+        gram[np.diag_indices_from(gram)] += alpha
+        weight = scipy.linalg.cho_solve(scipy.linalg.cho_factor(gram), xty).T
+        return weight, ymean - weight @ xmean
@@ -9,12 +9,93 @@ International Brain Lab, 2020
 """
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from sklearn.metrics import r2_score
 from scipy.special import xlogy
-from brainbox.processing import bincount2D
 from .utils import neglog
 
 
+def trial_spike_windows(spk_times, starts, ends):
+    """
+    Indices of the first and last + 1 spikes of each trial, spikes within [start, end]. A trial
+    starting before the end of the previous one only gets the spikes after the previous trial.
+
+    Parameters
+    ----------
+    spk_times : numpy.array
+        sorted spike times, in seconds
+    starts, ends : numpy.array
+        trials start and end times, in seconds
+
+    Returns
+    -------
+    numpy.array, numpy.array
+        first spike index and last spike index + 1 of each trial
+    """
+    endinds = np.maximum.accumulate(np.searchsorted(spk_times, ends, side='right'))
+    startinds = np.maximum(np.searchsorted(spk_times, starts), np.r_[0, endinds[:-1]])
+    return startinds, np.maximum(startinds, endinds)
+
+
+def bin_trial_spikes(spk_times, spk_clu, starts, durations, windows, clu_ids, binwidth, sparse=False):
+    """
+    Spike counts of the cells in time bins of consecutive trials, stacked along a single timeline.
+    The bins of all the spikes are found at once against the trials timeline, and counted in a
+    single bincount.
+
+    Parameters
+    ----------
+    spk_times : numpy.array
+        sorted spike times, in seconds
+    spk_clu : numpy.array
+        cluster of each spike
+    starts : numpy.array
+        start time of each trial, in seconds
+    durations : numpy.array
+        duration of each trial, in seconds
+    windows : tuple of numpy.array
+        first and last + 1 spike indices of each trial, see trial_spike_windows
+    clu_ids : numpy.array
+        non-negative integer cluster ids of the cells, the other clusters are discarded
+    binwidth : float
+        width of the time bins, in seconds
+    sparse : bool, optional
+        whether to return a scipy.sparse CSR matrix, by default False
+
+    Returns
+    -------
+    numpy.array or scipy.sparse.csr_matrix
+        (n_bins_total, n_cells) float spike counts
+    """
+    startinds, endinds = windows
+    nspikes = endinds - startinds
+    # a trial whose duration falls in the second half of a bin is shortened by half a bin
+    durmod = durations % binwidth
+    durations = np.where(durmod > (binwidth / 2), durations - (binwidth / 2), durations)
+    # number of bins of each trial: as the scale np.arange(0, duration + binwidth / 2, binwidth),
+    # or as the bin function of the duration for trials without spikes
+    nbins = np.where(nspikes > 0, np.ceil((durations + binwidth / 2) / binwidth),
+                     np.ceil(durations / binwidth)).astype(int)
+    rowstarts = np.r_[0, np.cumsum(nbins)[:-1]]
+    # spikes of the trials, with their trial number
+    spk_trial = np.repeat(np.arange(nspikes.size), nspikes)
+    spk_idx = np.arange(spk_trial.size) + np.repeat(startinds - np.r_[0, np.cumsum(nspikes)[:-1]], nspikes)
+    # column of each cluster, -1 for the clusters which are not cells
+    cell_cols = np.full(max(np.max(spk_clu, initial=0), np.max(clu_ids)) + 1, -1)
+    cell_cols[clu_ids] = np.arange(clu_ids.size)
+    cols = cell_cols[spk_clu[spk_idx]]
+    incells = cols >= 0
+    spk_trial, spk_idx, cols = (spk_trial[incells], spk_idx[incells], cols[incells])
+    xind = np.floor((spk_times[spk_idx] - starts[spk_trial]) / binwidth).astype(np.int64)
+    if np.any(xind >= nbins[spk_trial]):
+        raise IndexError('Some spikes fall beyond the last bin of their trial')
+    rows = rowstarts[spk_trial] + xind
+    shape = (np.sum(nbins), clu_ids.size)
+    if sparse:
+        return sp.csr_matrix((np.ones(rows.size), (rows, cols)), shape=shape)
+    return np.bincount(rows * shape[1] + cols, minlength=shape[0] * shape[1]).reshape(shape).astype(float)
+
+
 class NeuralModel:
     """
     Parent class for multiple types of neural models. Contains core methods for extracting
@@ -23,7 +104,7 @@ class NeuralModel:
     """
 
     def __init__(self, design_matrix, spk_times, spk_clu,
-                 binwidth=0.02, mintrials=100, stepwise=False):
+                 binwidth=0.02, mintrials=100, stepwise=False, sparse=False):
         """
         Construct GLM object using information about all trials, and the relevant spike times.
         Only ingests data, and further object methods must be called to describe kernels, gain
@@ -48,6 +129,9 @@ class NeuralModel:
             from only the mean rate, up. This allows comparison of D^2 scores for sub-models which
             incorporate only some parameters, to see which regressors actually improve
             explainability. Defaults to False.
+        sparse: bool
+            Whether to hold the binned spikes as a scipy.sparse CSR matrix, the rows of the fitted
+            trials are converted to a dense array when fitting and scoring. Defaults to False.
         """
         # Data checks #
         if not len(spk_times) == len(spk_clu):
@@ -60,27 +144,21 @@ class NeuralModel:
         base_df = design_matrix.base_df
         clu_ids = np.unique(spk_clu).flatten()
         trbounds = base_df[['trial_start', 'trial_end']]  # Get the start/end of trials
+        # First and last spike indices of each trial
+        startinds, endinds = trial_spike_windows(spk_times, trbounds.trial_start.to_numpy(),
+                                                 trbounds.trial_end.to_numpy())
         # Initialize a Cells x Trials bool array to easily see how many trials a clu spiked
         trialspiking = np.zeros((base_df.index.max() + 1, clu_ids.max() + 1), dtype=bool)
-        # Empty trial duration value to use later
-        # Iterate through each trial, and store the relevant spikes for that trial into a dict
-        # Along with the cluster labels. This makes binning spikes and accessing spikes easier.
-        spks = {}
-        clu = {}
-        st_endlast = 0
-        for i, (start, end) in trbounds.iterrows():
-            st_startind = np.searchsorted(spk_times[st_endlast:], start) + st_endlast
-            st_endind = np.searchsorted(spk_times[st_endlast:], end, side='right') + st_endlast
-            st_endlast = st_endind
-            trial_clu = np.unique(spk_clu[st_startind:st_endind])
-            trialspiking[i, trial_clu] = True
-            spks[i] = spk_times[st_startind:st_endind] - start
-            clu[i] = spk_clu[st_startind:st_endind]
+        nspikes = endinds - startinds
+        spk_trial = np.repeat(base_df.index.to_numpy(), nspikes)
+        spk_idx = np.arange(spk_trial.size) + np.repeat(startinds - np.r_[0, np.cumsum(nspikes)[:-1]], nspikes)
+        trialspiking[spk_trial, spk_clu[spk_idx]] = True
 
         # Set model parameters to begin with
         self.design = design_matrix
-        self.spikes = spks
-        self.clu = clu
+        self.spk_times = spk_times
+        self.spk_clu = spk_clu
+        self.spike_windows = pd.DataFrame({'start': startinds, 'end': endinds}, index=base_df.index)
         self.clu_ids = np.argwhere(np.sum(trialspiking, axis=0) > mintrials).flatten()
         self.stepwise = stepwise
         self.binwidth = binwidth
@@ -88,28 +166,28 @@ class NeuralModel:
         if len(self.clu_ids) == 0:
             raise UserWarning('No neuron fired a spike in a minimum number.')
 
-        # Bin spikes
-        spkarrs, arrdiffs = [], []
-        for i in self.design.trialsdf.index:
-            duration = self.design.trialsdf.loc[i, 'duration']
-            durmod = duration % self.binwidth
-            if durmod > (self.binwidth / 2):
-                duration = duration - (self.binwidth / 2)
-            if len(self.spikes[i]) == 0:
-                arr = np.zeros((self.binf(duration), len(self.clu_ids)))
-                spkarrs.append(arr)
-                continue
-            spks = self.spikes[i]
-            clu = self.clu[i]
-            arr = bincount2D(spks, clu,
-                             xbin=self.binwidth, ybin=self.clu_ids, xlim=[0, duration])[0]
-            arrdiffs.append(arr.shape[1] - self.binf(duration))
-            spkarrs.append(arr.T)
-        y = np.vstack(spkarrs)
+        # Bin spikes of the design matrix trials
+        trials = self.design.trialsdf.index
+        windows = self.spike_windows.loc[trials]
+        y = bin_trial_spikes(spk_times, spk_clu, trbounds.loc[trials, 'trial_start'].to_numpy(),
+                             self.design.trialsdf['duration'].to_numpy(dtype=float),
+                             (windows.start.to_numpy(), windows.end.to_numpy()), self.clu_ids, binwidth,
+                             sparse=sparse)
         if hasattr(self.design, 'dm'):
             assert y.shape[0] == self.design.dm.shape[0], "Oh shit. Indexing error."
         self.binnedspikes = y
 
+    @property
+    def spikes(self):
+        """dict of the spike times of each trial, relative to the trial start"""
+        starts = self.design.base_df['trial_start']
+        return {i: self.spk_times[s:e] - starts[i] for i, (s, e) in self.spike_windows.iterrows()}
+
+    @property
+    def clu(self):
+        """dict of the spike clusters of each trial"""
+        return {i: self.spk_clu[s:e] for i, (s, e) in self.spike_windows.iterrows()}
+
     def combine_weights(self):
         """
         Combined fit coefficients and intercepts to produce kernels where appropriate, which
@@ -202,6 +280,8 @@ class NeuralModel:
         # Mask for training data
         trainmask = np.isin(self.design.trlabels, train_idx).flatten()
         trainbinned = self.binnedspikes[trainmask]
+        if sp.issparse(trainbinned):
+            trainbinned = trainbinned.toarray()
         if printcond:
             print(f'Condition of design matrix is {np.linalg.cond(self.design[trainmask])}')
 
@@ -225,6 +305,8 @@ class NeuralModel:
             testinds = self.testinds
         testmask = np.isin(self.design.trlabels, testinds).flatten()
         dm, binned = self.design[testmask, :], self.binnedspikes[testmask]
+        if sp.issparse(binned):
+            binned = binned.toarray()
 
         scores = pd.Series(index=self.coefs.index, name='scores', dtype=object)
         for cell in self.coefs.index:
@@ -1,16 +1,74 @@
 from .neural_model import NeuralModel
 
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from warnings import warn, catch_warnings
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from sklearn.linear_model import PoissonRegressor
 from tqdm import tqdm
 
+CHUNKS_PER_WORKER = 4  # number of groups of cells sent to each worker process when fitting in parallel
+
+# design matrix and binned spikes of a fitting worker process, attached from shared memory
+_WORKER_DATA = {}
+
+
+def _fit_cell(dm, cellbinned, alpha, fit_intercept, init=None):
+    """
+    Fits the poisson regression of a single cell, optionally starting from (coef, intercept).
+    Returns the coefficients, the intercept and whether the fit converged
+    """
+    with catch_warnings(record=True) as w:
+        fitobj = PoissonRegressor(alpha=alpha, max_iter=300, fit_intercept=fit_intercept,
+                                  warm_start=init is not None)
+        if init is not None:
+            fitobj.coef_, fitobj.intercept_ = (np.asarray(init[0], dtype=float), init[1])
+        fitobj.fit(dm, cellbinned)
+    return fitobj.coef_, fitobj.intercept_ if fit_intercept else 0, len(w) == 0
+
+
+def _share_arrays(arrays):
+    """
+    Copies arrays to shared memory blocks
+    :return: list of the SharedMemory objects, to close and unlink once done, and the dictionary
+    of (block name, shape, dtype) specifications to attach the arrays in other processes
+    """
+    blocks, specs = ([], {})
+    for key, arr in arrays.items():
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+        blocks.append(shm)
+        specs[key] = (shm.name, arr.shape, arr.dtype.str)
+    return blocks, specs
+
+
+def _init_fit_worker(specs, dm_shape):
+    """Process pool initializer attaching the design matrix and binned spikes from shared memory"""
+    arrays = {}
+    for key, (name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _WORKER_DATA.setdefault('blocks', []).append(shm)  # keeps the buffers alive
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    if 'dm' in arrays:
+        _WORKER_DATA['dm'] = arrays['dm']
+    else:
+        _WORKER_DATA['dm'] = sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                                           shape=dm_shape)
+    _WORKER_DATA['binned'] = arrays['binned']
+
+
+def _fit_cells_worker(cell_idxs, inits, alpha, fit_intercept):
+    """Fits a group of cells, indexed by column of binned spikes, in a worker process"""
+    dm, binned = (_WORKER_DATA['dm'], _WORKER_DATA['binned'])
+    return [_fit_cell(dm, binned[:, i], alpha, fit_intercept, init) for i, init in zip(cell_idxs, inits)]
+
 
 class PoissonGLM(NeuralModel):
     def __init__(self, design_matrix, spk_times, spk_clu,
                  binwidth=0.02, metric='dsq', fit_intercept=True, alpha=0,
-                 train=0.8, blocktrain=False, mintrials=100, subset=False):
+                 train=0.8, blocktrain=False, mintrials=100, subset=False, n_workers=1, sparse=False):
         """
         Fit a poisson model using a DesignMatrix and spiking rate.
         Uses the sklearn.linear_model.PoissonRegressor to perform fitting.
@@ -38,17 +96,23 @@ class PoissonGLM(NeuralModel):
         mintrials : int, optional
             Minimum number of trials in which a unit must fire at least one spike in order to be
             included in the fitting, by default 100
+        n_workers : int, optional
+            Number of processes fitting the cells in parallel, sharing the design matrix and the
+            binned spikes through shared memory, by default 1
+        sparse : bool, optional
+            Whether to hold the binned spikes as a scipy.sparse CSR matrix, by default False
         """
         super().__init__(design_matrix, spk_times, spk_clu,
-                         binwidth, mintrials)
+                         binwidth, mintrials, sparse=sparse)
         # TODO: Implement grid search over alphas to find optimal value
         self.metric = metric
         self.fit_intercept = fit_intercept
         self.alpha = alpha
+        self.n_workers = n_workers
         self.link = np.exp
         self.invlink = np.log
 
-    def _fit(self, dm, binned, cells=None, noncovwarn=False):
+    def _fit(self, dm, binned, cells=None, noncovwarn=False, init=None):
         """
         Fit a GLM using scikit-learn implementation of PoissonRegressor. Uses a regularization
         strength parameter alpha, which is the strength of ridge regularization term.
@@ -66,31 +130,62 @@ class PoissonGLM(NeuralModel):
         cells : list
             List of cells labels for columns in binned. Will default to all cells in model if None
             is passed. Must be of the same length as columns in binned. By default None.
+        init : tuple of pandas.Series, optional
+            (coefficients, intercepts) indexed by cell, used as initial values of the fits (warm
+            start), e.g. from a previous fit of a sub model. Cells missing or None start from
+            zero coefficients. By default None
         """
         if cells is None:
             cells = self.clu_ids.flatten()
         if cells.shape[0] != binned.shape[1]:
             raise ValueError('Length of cells does not match shape of binned')
 
+        inits = [None] * len(cells)
+        if init is not None:
+            inits = [None if init[0].get(cell) is None else (init[0][cell], init[1][cell]) for cell in cells]
+        if self.n_workers > 1 and len(cells) > 1:
+            results = self._fit_parallel(dm, binned, inits)
+        else:
+            results = [_fit_cell(dm, binned[:, i], self.alpha, self.fit_intercept, inits[i])
+                       for i in tqdm(range(len(cells)), 'Fitting units:', leave=False)]
+
         coefs = pd.Series(index=cells, name='coefficients', dtype=object)
         intercepts = pd.Series(index=cells, name='intercepts')
         nonconverged = []
-        for cell in tqdm(cells, 'Fitting units:', leave=False):
-            cell_idx = np.argwhere(cells == cell)[0, 0]
-            cellbinned = binned[:, cell_idx]
-            with catch_warnings(record=True) as w:
-                fitobj = PoissonRegressor(alpha=self.alpha,
-                                          max_iter=300,
-                                          fit_intercept=self.fit_intercept).fit(dm, cellbinned)
-            if len(w) != 0:
+        for cell, (coef, intercept, converged) in zip(cells, results):
+            if not converged:
                 nonconverged.append(cell)
-            coefs.at[cell] = fitobj.coef_
-            if self.fit_intercept:
-                intercepts.at[cell] = fitobj.intercept_
-            else:
-                intercepts.at[cell] = 0
+            coefs.at[cell] = coef
+            intercepts.at[cell] = intercept
         if noncovwarn:
             if len(nonconverged) != 0:
                 warn(f'Fitting did not converge for some units: {nonconverged}')
 
         return coefs, intercepts
+
+    def _fit_parallel(self, dm, binned, inits):
+        """
+        Fits the cells in groups in a pool of n_workers processes. The design matrix and the
+        binned spikes are copied once to shared memory, each process attaches them at start.
+        Returns the list of (coefficients, intercept, converged) of each column of binned.
+        """
+        arrays = {'binned': np.ascontiguousarray(binned)}
+        if sp.issparse(dm):
+            dm = sp.csr_matrix(dm)
+            arrays.update(data=dm.data, indices=dm.indices, indptr=dm.indptr)
+        else:
+            arrays['dm'] = np.ascontiguousarray(dm)
+        blocks, specs = _share_arrays(arrays)
+        chunks = np.array_split(np.arange(binned.shape[1]), self.n_workers * CHUNKS_PER_WORKER)
+        chunks = [c for c in chunks if c.size]
+        try:
+            with ProcessPoolExecutor(self.n_workers, initializer=_init_fit_worker,
+                                     initargs=(specs, dm.shape)) as executor:
+                futures = [executor.submit(_fit_cells_worker, c, [inits[i] for i in c],
+                                           self.alpha, self.fit_intercept) for c in chunks]
+                results = [r for f in tqdm(futures, 'Fitting units:', leave=False) for r in f.result()]
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+        return results
@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from tqdm import tqdm
 from numpy.matlib import repmat
 
@@ -40,7 +41,7 @@ def neglog(weights, x, y):
 class SequentialSelector:
     def __init__(self, model, n_features_to_select=None,
                  direction='forward', scoring=None,
-                 train=None, test=None):
+                 train=None, test=None, warm_start=False):
         """
         Sequential feature selection for neural models
 
@@ -58,8 +59,14 @@ class SequentialSelector:
         scoring : str, optional
             Scoring function to use. Must be a valid argument to the subclass of NeuralModel passed
             to SequentialSelector. By default None
+        warm_start : bool, optional
+            Whether to start the fits of the submodels from the coefficients of the submodel
+            selected at the previous step for each cell, the added covariates starting at zero
+            and the removed ones being dropped. Speeds up iterative fits such as the PoissonGLM.
+            By default False
         """
         self.model = model
+        self.warm_start = warm_start
         self.design = model.design
         if n_features_to_select:
             self.n_features_to_select = int(n_features_to_select)
@@ -101,6 +108,7 @@ class SequentialSelector:
             self.train = np.isin(self.trlabels, train_idx).flatten()
             self.test = ~self.train
         n_features = len(self.features)
+        self._selected_fits = {}  # cell: (design matrix columns, coefficients, intercept)
         maskdf = pd.DataFrame(index=self.model.clu_ids, columns=self.features, dtype=bool)
         maskdf.loc[:, :] = False
         seqdf = pd.DataFrame(index=self.model.clu_ids, columns=range(self.n_features_to_select))
@@ -157,8 +165,11 @@ class SequentialSelector:
         cell_idxs = np.argwhere(np.isin(self.model.clu_ids, cells)).flatten()
         my = self.model.binnedspikes[np.ix_(self.train, cell_idxs)]
         my_test = self.model.binnedspikes[np.ix_(self.test, cell_idxs)]
+        if sp.issparse(my):
+            my, my_test = (my.toarray(), my_test.toarray())
         trainscores = pd.DataFrame(index=cells, columns=candidate_features, dtype=float)
         testscores = pd.DataFrame(index=cells, columns=candidate_features, dtype=float)
+        candidate_fits = {}
         for feature_idx in candidate_features:
             candidate_mask = mask.copy()
             candidate_mask[feature_idx] = True
@@ -169,7 +180,9 @@ class SequentialSelector:
             mdm = self.design[np.ix_(self.train, feat_idx)]
             mdm_test = self.design[np.ix_(self.test, feat_idx)]
 
-            coefs, intercepts = self.model._fit(mdm, my, cells=cells)
+            init = self._warm_start_init(cells, feat_idx) if self.warm_start else None
+            coefs, intercepts = self.model._fit(mdm, my, cells=cells, init=init)
+            candidate_fits[feature_idx] = (feat_idx, coefs, intercepts)
             for i, cell in enumerate(cells):
                 trainscores.at[cell,
                                feature_idx] = self.model._scorer(coefs.loc[cell],
@@ -182,6 +195,10 @@ class SequentialSelector:
 
         maxind = trainscores.idxmax(axis=1)
         trainmax = trainscores.max(axis=1)
+        if self.warm_start:
+            for cell in cells:
+                feat_idx, coefs, intercepts = candidate_fits[maxind.loc[cell]]
+                self._selected_fits[cell] = (feat_idx, coefs.loc[cell], intercepts.loc[cell])
         # Ugly kludge to compensate for DataFrame.lookup being deprecated
         midx, cols = pd.factorize(maxind)
         testmax = pd.Series(testscores.reindex(cols, axis=1).to_numpy()[np.arange(len(testscores)),
@@ -191,3 +208,23 @@ class SequentialSelector:
             return maxind, trainmax, testmax, trainscores, testscores
         else:
             return maxind, trainmax, testmax
+
+    def _warm_start_init(self, cells, feat_idx):
+        """
+        Initial coefficients and intercepts of the cells for a submodel using the design matrix
+        columns feat_idx, from the submodel selected at the previous step: the coefficients of the
+        columns in both submodels are kept, the others start at zero.
+        """
+        coefs, intercepts = ({}, {})
+        for cell in cells:
+            if cell not in self._selected_fits:
+                continue
+            prev_idx, prev_coefs, intercepts[cell] = self._selected_fits[cell]
+            init = np.zeros(len(feat_idx))
+            common = np.isin(feat_idx, prev_idx)
+            order = np.argsort(prev_idx)
+            init[common] = prev_coefs[order[np.searchsorted(prev_idx, feat_idx[common], sorter=order)]]
+            coefs[cell] = init
+        coefs = pd.Series(coefs, name='coefficients', dtype=object)
+        intercepts = pd.Series(intercepts, name='intercepts', dtype=float)
+        return coefs, intercepts
@@ -6,16 +6,24 @@ Code for decoding by G. Meijer
 Code from sigtest_pseudosessions and sigtest_linshift by B. Benson
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import scipy as sp
+import scipy.sparse
+import scipy.spatial
 import scipy.stats
 import types
 from itertools import groupby
+from joblib import Parallel, delayed
 from sklearn.linear_model import LinearRegression, Lasso, Ridge
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
 from sklearn.model_selection import KFold, LeaveOneOut, LeaveOneGroupOut
 from sklearn.metrics import accuracy_score
 
+XCORR_CHUNK_SPIKES = 100000  # number of reference spikes swept at once by xcorr_sparse
+XCORR_DENSE_CELLS = 2 ** 24  # xcorr_sparse counts by bincount below this number of (pair, lag) cells
+NULL_BATCH_SIZE = 20  # null draws per worker evaluated between two early stopping checks
+
 
 def get_spike_counts_in_bins(spike_times, spike_clusters, intervals):
     """
@@ -138,6 +146,8 @@ def xcorr(spike_times, spike_clusters, bin_size=None, window_size=None):
     Returns an `(n_clusters, n_clusters, winsize_samples)` array with all pairwise
     cross-correlograms.
 
+    See `xcorr_sparse` to compute a subset of cluster pairs without allocating the dense array.
+
     """
     assert np.all(np.diff(spike_times) >= 0), "The spike times must be increasing."
     assert spike_times.ndim == 1
@@ -195,8 +205,224 @@ def xcorr(spike_times, spike_clusters, bin_size=None, window_size=None):
     return _symmetrize_correlograms(correlograms)
 
 
+def neighbour_pairs(cluster_ids, positions, max_distance):
+    """
+    Cluster pairs within a distance of each other, for example the clusters whose channels are
+    less than 100 um apart, to restrict the cross-correlograms to a neighbourhood.
+
+    Parameters
+    ----------
+    cluster_ids : 1D array
+        cluster ids
+    positions : 2D array of shape (n_clusters, n_dims)
+        position of each cluster, e.g. the (x, y) coordinates of its peak channel in um
+    max_distance : float
+        maximum distance between the two clusters of a pair, in the units of `positions`
+
+    Returns
+    ---------
+    pairs : 2D array of shape (n_pairs, 2)
+        cluster ids (i, j) with i <= j, including the auto-correlograms (i, i)
+    """
+    cluster_ids = np.asarray(cluster_ids)
+    tree = sp.spatial.cKDTree(np.asarray(positions, dtype=float).reshape(cluster_ids.size, -1))
+    ij = tree.query_pairs(max_distance, output_type='ndarray')
+    ij = np.r_[np.c_[np.arange(cluster_ids.size), np.arange(cluster_ids.size)], ij]
+    pairs = np.sort(cluster_ids[ij], axis=1)
+    return np.unique(pairs, axis=0)
+
+
+def _count_keys(keys, size, weights=None):
+    """Unique keys in [0, size) and their (weighted) counts, by bincount if the key space is small"""
+    if size <= min(XCORR_DENSE_CELLS, 8 * keys.size):
+        counts = np.bincount(keys, weights=weights, minlength=size)
+        keys = np.flatnonzero(counts)
+        return keys, counts[keys].astype(np.int64)
+    if weights is None:
+        keys = np.sort(keys)
+    else:
+        order = np.argsort(keys)
+        keys, weights = (keys[order], weights[order])
+    first = np.r_[0, np.flatnonzero(np.diff(keys)) + 1] if keys.size else np.array([], np.int64)
+    if weights is None:
+        counts = np.diff(np.r_[first, keys.size])
+    else:
+        counts = np.add.reduceat(weights, first) if keys.size else np.array([])
+    return keys[first], counts.astype(np.int64)
+
+
+def _sweep_correlograms(spike_times, spike_clusters_i, lut, bin_size, winsize_bins, first, last):
+    """
+    Counts the spike pairs within the correlogram window whose first spike is in [first, last).
+    The spikes following each reference spike within the window are found at once on the sorted
+    spike times (the two pointers are the searchsorted bounds).
+    Returns the keys `row * (winsize_bins + 1) + lag bin` and their counts, rows being the indices
+    of the requested pairs in the lookup table `lut`. The zero lag counts of the reversed pairs
+    are kept apart in the extra lag bin `winsize_bins`.
+    """
+    half, width = (winsize_bins // 2, winsize_bins + 1)
+    t = spike_times[first:last]
+    stop = np.searchsorted(spike_times, t + (half + 1) * bin_size, side='right')
+    n = stop - np.arange(first + 1, last + 1)
+    a = np.repeat(np.arange(first, last), n)
+    b = a + 1 + np.arange(a.size) - np.repeat(np.cumsum(n) - n, n)
+    # same binarization of the delays as xcorr
+    d = np.round((spike_times[b] - spike_times[a]) / bin_size).astype(np.int64)
+    keep = d <= (winsize_bins / 2)
+    a, b, d = (a[keep], b[keep], d[keep])
+    ca, cb = (spike_clusters_i[a], spike_clusters_i[b])
+    # a spike pair counts at +d for the pair (ca, cb) and at -d for the pair (cb, ca)
+    fwd, bwd = (lut[ca, cb], lut[cb, ca])
+    keys = np.concatenate([(fwd * width + half + d)[fwd >= 0],
+                           (bwd * width + np.where(d > 0, half - d, winsize_bins))[bwd >= 0]])
+    return _count_keys(keys, lut.max() * width + width)
+
+
+def xcorr_sparse(spike_times, spike_clusters, bin_size=None, window_size=None, pairs=None,
+                 chunk_size=XCORR_CHUNK_SPIKES, n_workers=1):
+    """
+    Compute the cross-correlograms of a subset of cluster pairs as a sparse matrix.
+
+    The spike pairs within the window are found by a sweep over the sorted spike times, so that
+    the cost scales with the number of spike pairs within the window instead of the number of
+    shifts times the number of spikes, and only the non-zero bins of the requested pairs are kept.
+    The recording is split in time in chunks of reference spikes, counted concurrently by
+    `n_workers` threads and merged at the end. The correlograms are the same as the ones of `xcorr`.
+
+    Parameters
+    ----------
+    spike_times : 1D array
+        sorted spike times in seconds
+    spike_clusters : 1D array
+        cluster ids corresponding to each spike
+    bin_size : float
+        size of the bin, in seconds
+    window_size : float
+        size of the window, in seconds
+    pairs : 2D array of shape (n_pairs, 2), optional
+        cluster ids (i, j) of the requested correlograms, see `neighbour_pairs`. If None, all
+        pairs of clusters in the order of `xcorr`
+    chunk_size : int
+        number of reference spikes per chunk
+    n_workers : int
+        number of threads counting the chunks
+
+    Returns
+    ---------
+    correlograms : scipy.sparse.coo_matrix of shape (n_pairs, winsize_bins)
+        row k is the cross-correlogram of the pair `pairs[k]`, with the spikes of cluster
+        `pairs[k, 1]` counted relative to the spikes of cluster `pairs[k, 0]`.
+        With pairs=None, `correlograms.toarray().reshape(n_clusters, n_clusters, -1)` is the
+        output of `xcorr`
+    pairs : 2D array of shape (n_pairs, 2)
+        cluster ids of each row
+
+    Examples
+    --------
+    Correlograms of the clusters less than 50 um apart
+    >>> pairs = neighbour_pairs(clusters['cluster_id'], clusters[['x', 'y']], 50)
+    >>> ccg, pairs = xcorr_sparse(spikes.times, spikes.clusters, .001, .05, pairs=pairs)
+    """
+    spike_times = np.asarray(spike_times)
+    spike_clusters = np.asarray(spike_clusters)
+    assert np.all(np.diff(spike_times) >= 0), "The spike times must be increasing."
+    assert spike_times.ndim == 1
+    assert spike_times.shape == spike_clusters.shape
+
+    bin_size = np.clip(bin_size, 1e-5, 1e5)  # in seconds
+    window_size = np.clip(window_size, 1e-5, 1e5)  # in seconds
+    winsize_bins = 2 * int(.5 * window_size / bin_size) + 1
+
+    clusters = np.unique(spike_clusters)
+    n_clusters = len(clusters)
+    spike_clusters_i = _index_of(spike_clusters, clusters)
+
+    # lookup table of the row of each ordered pair of cluster indices, -1 if not requested
+    if pairs is None:
+        pairs = np.c_[np.repeat(clusters, n_clusters), np.tile(clusters, n_clusters)]
+        lut = np.arange(n_clusters ** 2).reshape(n_clusters, n_clusters)
+    else:
+        pairs = np.asarray(pairs).reshape(-1, 2)
+        lut = np.full((n_clusters, n_clusters), -1, dtype=np.int64)
+        ij = np.minimum(np.searchsorted(clusters, pairs), max(n_clusters - 1, 0))
+        exists = np.all(clusters[ij] == pairs, axis=1) if n_clusters else np.zeros(len(pairs), bool)
+        lut[ij[exists, 0], ij[exists, 1]] = np.where(exists)[0]
+    n_pairs = pairs.shape[0]
+
+    chunks = [(i, min(i + chunk_size, spike_times.size)) for i in range(0, spike_times.size, chunk_size)]
+
+    def sweep(chunk):
+        return _sweep_correlograms(spike_times, spike_clusters_i, lut, bin_size, winsize_bins, *chunk)
+
+    if n_workers == 1 or len(chunks) < 2:
+        counts = list(map(sweep, chunks))
+    else:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            counts = list(executor.map(sweep, chunks))
+
+    # merge the chunks, then symmetrize the zero lag as the maximum of both orientations counts
+    width = winsize_bins + 1
+    keys, counts = _count_keys(np.concatenate([np.array([], np.int64)] + [k for k, _ in counts]),
+                               n_pairs * width, np.concatenate([np.array([])] + [c for _, c in counts]))
+    rows, cols = (keys // width, keys % width)
+    zero = (cols == winsize_bins // 2) | (cols == winsize_bins)
+    zero_counts = np.zeros(n_pairs, dtype=np.int64)
+    np.maximum.at(zero_counts, rows[zero], counts[zero])
+    zero_rows = np.flatnonzero(zero_counts)
+    rows = np.r_[rows[~zero], zero_rows]
+    cols = np.r_[cols[~zero], np.full(zero_rows.size, winsize_bins // 2)]
+    counts = np.r_[counts[~zero], zero_counts[zero_rows]].astype(np.int32)
+    correlograms = sp.sparse.coo_matrix((counts, (rows, cols)), shape=(n_pairs, winsize_bins))
+    return correlograms, pairs
+
+
+def _parallel_map(fcn, args, n_workers=1):
+    """Calls fcn(*a) for a in args, in n_workers joblib workers (processes by default) if > 1"""
+    if n_workers == 1:
+        return [fcn(*a) for a in args]
+    return Parallel(n_jobs=n_workers)(delayed(fcn)(*a) for a in args)
+
+
+def _fit_predict_fold(model, X, y, train_index, test_index, proba=False, return_training=False):
+    """Fits a scikit-learn model on the training set of a fold and predicts the test set"""
+    model.fit(X[train_index], y[train_index])
+    pred = model.predict(X[test_index])
+    prob = model.predict_proba(X[test_index])[:, 1] if proba else None
+    pred_training = model.predict(X[train_index]) if return_training else None
+    return pred, prob, pred_training
+
+
+def _null_distribution(fcn, args, n_workers=1, stop=None):
+    """
+    Evaluates fcn(*a) for a in args in batches of NULL_BATCH_SIZE draws per worker, in the input
+    order. After each batch, stop(values) is called on the values so far and ends the evaluation
+    if it returns True.
+    """
+    args = list(args)
+    batch_size = len(args) if stop is None else NULL_BATCH_SIZE * n_workers
+    values = []
+    for i in range(0, len(args), max(batch_size, 1)):
+        values.extend(_parallel_map(fcn, args[i:i + batch_size], n_workers=n_workers))
+        if stop is not None and stop(np.array(values)):
+            break
+    return np.array(values, dtype=float)
+
+
+def _pseudo_statm(fStatMeas, X, genPseudo, seed=None):
+    """Statistical measure of a pseudosession, with the numpy global random state seeded"""
+    if seed is not None:
+        np.random.seed(seed)
+    return fStatMeas(X, genPseudo())
+
+
+def _shift_statm(fStatMeas, X, y, shift, N):
+    """Statistical measure of the central window of X and of the window of y shifted by shift"""
+    T = len(y)
+    return fStatMeas(np.copy(X[:, N:T - N]), np.copy(y[shift + N:shift + T - N]))
+
+
 def classify(population_activity, trial_labels, classifier, cross_validation=None,
-             return_training=False):
+             return_training=False, n_workers=1):
     """
     Classify trial identity (e.g. stim left/right) from neural population activity.
 
@@ -216,6 +442,9 @@ def classify(population_activity, trial_labels, classifier, cross_validation=Non
                     cross_validation = KFold(n_splits=5)
     return_training : bool
         if set to True the classifier will also return the performance on the training set
+    n_workers : int
+        number of cross-validation folds fitted in parallel by joblib workers, each on a copy of
+        the classifier. The results are the same as with a single worker
 
     Returns
     -------
@@ -248,18 +477,16 @@ def classify(population_activity, trial_labels, classifier, cross_validation=Non
         if return_training:
             pred_training = np.empty(trial_labels.shape[0])
 
-        for train_index, test_index in cross_validation.split(population_activity):
-            # Fit the model to the training data
-            classifier.fit(population_activity[train_index], trial_labels[train_index])
-
-            # Predict the held-out test data
-            pred[test_index] = classifier.predict(population_activity[test_index])
-            proba = classifier.predict_proba(population_activity[test_index])
-            prob[test_index] = proba[:, 1]
-
-            # Predict the training data
+        # Fit the model to the training data and predict the held-out test data of each fold
+        folds = list(cross_validation.split(population_activity))
+        results = _parallel_map(_fit_predict_fold, [
+            (classifier, population_activity, trial_labels, train_index, test_index, True, return_training)
+            for train_index, test_index in folds], n_workers=n_workers)
+        for (train_index, test_index), (fold_pred, fold_prob, fold_pred_training) in zip(folds, results):
+            pred[test_index] = fold_pred
+            prob[test_index] = fold_prob
             if return_training:
-                pred_training[train_index] = classifier.predict(population_activity[train_index])
+                pred_training[train_index] = fold_pred_training
 
     # Calculate accuracy
     accuracy = accuracy_score(trial_labels, pred)
@@ -271,7 +498,7 @@ def classify(population_activity, trial_labels, classifier, cross_validation=Non
 
 
 def regress(population_activity, trial_targets, regularization=None,
-            cross_validation=None, return_training=False):
+            cross_validation=None, return_training=False, n_workers=1):
     """
     Perform linear regression to predict a continuous variable from neural data
 
@@ -291,6 +518,9 @@ def regress(population_activity, trial_targets, regularization=None,
                     cross_validation = KFold(n_splits=5)
     return_training : bool
         if set to True the classifier will also return the performance on the training set
+    n_workers : int
+        number of cross-validation folds fitted in parallel by joblib workers. The results are the
+        same as with a single worker
 
     Returns
     -------
@@ -323,16 +553,15 @@ def regress(population_activity, trial_targets, regularization=None,
         pred = np.empty(trial_targets.shape[0])
         if return_training:
             pred_training = np.empty(trial_targets.shape[0])
-        for train_index, test_index in cross_validation.split(population_activity):
-            # Fit the model to the training data
-            reg.fit(population_activity[train_index], trial_targets[train_index])
-
-            # Predict the held-out test data
-            pred[test_index] = reg.predict(population_activity[test_index])
-
-            # Predict the training data
+        # Fit the model to the training data and predict the held-out test data of each fold
+        folds = list(cross_validation.split(population_activity))
+        results = _parallel_map(_fit_predict_fold, [
+            (reg, population_activity, trial_targets, train_index, test_index, False, return_training)
+            for train_index, test_index in folds], n_workers=n_workers)
+        for (train_index, test_index), (fold_pred, _, fold_pred_training) in zip(folds, results):
+            pred[test_index] = fold_pred
             if return_training:
-                pred_training[train_index] = reg.predict(population_activity[train_index])
+                pred_training[train_index] = fold_pred_training
     if return_training:
         return pred, pred_training
     else:
@@ -433,7 +662,8 @@ def lda_project(spike_times, spike_clusters, event_times, event_groups, pre_time
     return lda_projection
 
 
-def sigtest_pseudosessions(X, y, fStatMeas, genPseudo, npseuds=200):
+def sigtest_pseudosessions(X, y, fStatMeas, genPseudo, npseuds=200, n_workers=1, seed=None,
+                           early_stop=None):
     """
     Estimates significance level of any statistical measure following Harris, Arxiv, 2021
     (https://www.biorxiv.org/content/10.1101/2020.11.29.402719v2).
@@ -453,25 +683,43 @@ def sigtest_pseudosessions(X, y, fStatMeas, genPseudo, npseuds=200):
         experimentally known null-distribution of y
     npseuds : int
         the number of pseudosessions used to estimate the significance level
+    n_workers : int
+        number of pseudosessions evaluated in parallel by joblib workers (processes by default,
+        fStatMeas and genPseudo may be closures)
+    seed : int
+        if not None, the numpy global random state is seeded before each pseudosession with a seed
+        derived from this one and the pseudosession index, so that genPseudo gives the same
+        pseudosessions whatever the number of workers
+    early_stop : float
+        if not None, a significance level: the pseudosessions stop being drawn once the comparison
+        of the p-value with this level can not change with the remaining pseudosessions
 
     Returns
     -------
     alpha : p-value e.g. at a significance level of b, if alpha <= b then reject the null
-            hypothesis.
+            hypothesis. With early stopping, p-value over the pseudosessions drawn, on the same side
+            of early_stop as the p-value over npseuds pseudosessions
     statms_real : the value of the statistical measure evaluated on X and y
     statms_pseuds : array of statistical measures evaluated on pseudosessions
     """
     statms_real = fStatMeas(X, y)
-    statms_pseuds = np.zeros(npseuds)
-    for i in range(npseuds):
-        statms_pseuds[i] = fStatMeas(X, genPseudo())
+    seeds = np.random.SeedSequence(seed).generate_state(npseuds) if seed is not None else [None] * npseuds
+
+    def stop(statms_pseuds):
+        # number of pseudosessions above the real measure, and the most it can reach
+        n_above = np.sum(statms_pseuds > statms_real)
+        n_max = n_above + npseuds - statms_pseuds.size
+        return n_above / npseuds > early_stop or n_max / npseuds <= early_stop
+
+    statms_pseuds = _null_distribution(_pseudo_statm, [(fStatMeas, X, genPseudo, s) for s in seeds],
+                                       n_workers=n_workers, stop=None if early_stop is None else stop)
 
     alpha = 1 - (0.01 * sp.stats.percentileofscore(statms_pseuds, statms_real, kind='weak'))
 
     return alpha, statms_real, statms_pseuds
 
 
-def sigtest_linshift(X, y, fStatMeas, D=300):
+def sigtest_linshift(X, y, fStatMeas, D=300, n_workers=1, early_stop=None):
     """
     Uses a provably conservative Linear Shift technique (Harris, Kenneth Arxiv 2021,
     https://arxiv.org/ftp/arxiv/papers/2012/2012.06862.pdf) to estimate
@@ -489,11 +737,17 @@ def sigtest_linshift(X, y, fStatMeas, D=300):
     D : int
         the window length along the center of y used to compute the statistical measure.
         must have room to shift both right and left: len(y) >= D+2
+    n_workers : int
+        number of shifts evaluated in parallel by joblib workers (processes by default)
+    early_stop : float
+        if not None, a significance level: the shifts stop being evaluated once the comparison of
+        the p-value with this level can not change with the remaining shifts
 
     Returns
     -------
     alpha : conservative p-value e.g. at a significance level of b, if alpha <= b then reject the
-            null hypothesis.
+            null hypothesis. With early stopping, p-value counting the shifts evaluated, on the
+            same side of early_stop as the p-value over all the shifts
     statms_real : the value of the statistical measure evaluated on X and y
     statms_pseuds : a 1-d array of statistical measures evaluated on shifted versions of y
     """
@@ -506,10 +760,13 @@ def sigtest_linshift(X, y, fStatMeas, D=300):
 
     # compute all statms
     statms_real = fStatMeas(X[:, N:T - N], y[N:T - N])
-    statms_pseuds = np.zeros(len(shifts))
-    for si in range(len(shifts)):
-        s = shifts[si]
-        statms_pseuds[si] = fStatMeas(np.copy(X[:, N:T - N]), np.copy(y[s + N:s + T - N]))
+
+    def stop(statms_pseuds):
+        M = np.sum(statms_pseuds >= statms_real)
+        return M / (N + 1) > early_stop or (M + shifts.size - statms_pseuds.size) / (N + 1) <= early_stop
+
+    statms_pseuds = _null_distribution(_shift_statm, [(fStatMeas, X, y, s, N) for s in shifts],
+                                       n_workers=n_workers, stop=None if early_stop is None else stop)
 
     M = np.sum(statms_pseuds >= statms_real)
     alpha = M / (N + 1)
@@ -3,7 +3,7 @@ Computes properties of single-cells, e.g. the autocorrelation and firing rate.
 '''
 
 import numpy as np
-from scipy.signal import convolve, gaussian
+from scipy.signal import fftconvolve, gaussian
 from iblutil.util import Bunch
 from brainbox.population.decode import xcorr
 
@@ -31,7 +31,8 @@ def acorr(spike_times, bin_size=None, window_size=None):
 
 def calculate_peths(
         spike_times, spike_clusters, cluster_ids, align_times, pre_time=0.2,
-        post_time=0.5, bin_size=0.025, smoothing=0.025, return_fr=True):
+        post_time=0.5, bin_size=0.025, smoothing=0.025, return_fr=True, dtype=np.float64,
+        chunk_size=None, return_binned=True, binned_file=None):
     """
     Calcluate peri-event time histograms; return means and standard deviations
     for each time point across specified clusters
@@ -55,6 +56,17 @@ def calculate_peths(
     :type smoothing: float
     :param return_fr: `True` to return (estimated) firing rate, `False` to return spike counts
     :type return_fr: bool
+    :param dtype: data type of the outputs, np.float32 halves the memory footprint
+    :type dtype: numpy dtype
+    :param chunk_size: number of align times binned at once, the means and standard deviations
+        are accumulated over chunks so that the peak memory does not depend on the number of
+        align times. Defaults to all align times at once.
+    :type chunk_size: int
+    :param return_binned: `False` to not materialize the binned spikes, returned as None
+    :type return_binned: bool
+    :param binned_file: path of a `.npy` file the binned spikes are written to, the returned
+        binned spikes are then a memory-mapped array of this file
+    :type binned_file: str or pathlib.Path
     :return: peths, binned_spikes
     :rtype: peths: Bunch({'mean': peth_means, 'std': peth_stds, 'tscale': ts, 'cscale': ids})
     :rtype: binned_spikes: np.array (n_align_times, n_clusters, n_bins)
@@ -65,7 +77,8 @@ def calculate_peths(
     n_bins_pre = int(np.ceil(pre_time / bin_size)) + n_offset
     n_bins_post = int(np.ceil(post_time / bin_size)) + n_offset
     n_bins = n_bins_pre + n_bins_post
-    binned_spikes = np.zeros(shape=(len(align_times), len(cluster_ids), n_bins))
+    align_times = np.asarray(align_times)
+    ids = np.unique(cluster_ids)
 
     # build gaussian kernel if requested
     if smoothing > 0:
@@ -74,62 +87,66 @@ def calculate_peths(
         # half (causal) gaussian filter
         # window[int(np.ceil(w/2)):] = 0
         window /= np.sum(window)
-        binned_spikes_conv = np.copy(binned_spikes)
-
-    ids = np.unique(cluster_ids)
+        window = window[np.newaxis, np.newaxis, :].astype(dtype)
 
-    # filter spikes outside of the loop
-    idxs = np.bitwise_and(spike_times >= np.min(align_times) - (n_bins_pre + 1) * bin_size,
-                          spike_times <= np.max(align_times) + (n_bins_post + 1) * bin_size)
-    idxs = np.bitwise_and(idxs, np.isin(spike_clusters, cluster_ids))
+    # filter spikes, and sort them by time if needed
+    idxs = np.isin(spike_clusters, cluster_ids)
     spike_times = spike_times[idxs]
     spike_clusters = spike_clusters[idxs]
+    if np.any(np.diff(spike_times) < 0):
+        isort = np.argsort(spike_times, kind='stable')
+        spike_times, spike_clusters = (spike_times[isort], spike_clusters[isort])
 
     # compute floating tscale
     tscale = np.arange(-n_bins_pre, n_bins_post + 1) * bin_size
-    # bin spikes
-    for i, t_0 in enumerate(align_times):
-        # define bin edges
-        ts = tscale + t_0
-        # filter spikes
-        idxs = np.bitwise_and(spike_times >= ts[0], spike_times <= ts[-1])
-        i_spikes = spike_times[idxs]
-        i_clusters = spike_clusters[idxs]
-
-        # bin spikes similar to bincount2D: x = spike times, y = spike clusters
-        xscale = ts
-        xind = (np.floor((i_spikes - np.min(ts)) / bin_size)).astype(np.int64)
-        yscale, yind = np.unique(i_clusters, return_inverse=True)
-        nx, ny = [xscale.size, yscale.size]
-        ind2d = np.ravel_multi_index(np.c_[yind, xind].transpose(), dims=(ny, nx))
-        r = np.bincount(ind2d, minlength=nx * ny, weights=None).reshape(ny, nx)
-
-        # store (ts represent bin edges, so there are one fewer bins)
-        bs_idxs = np.isin(ids, yscale)
-        binned_spikes[i, bs_idxs, :] = r[:, :-1]
-
-        # smooth
-        if smoothing > 0:
-            idxs = np.where(bs_idxs)[0]
-            for j in range(r.shape[0]):
-                binned_spikes_conv[i, idxs[j], :] = convolve(
-                    r[j, :], window, mode='same', method='auto')[:-1]
-
-    # average
-    if smoothing > 0:
-        binned_spikes_ = np.copy(binned_spikes_conv)
+    # bins kept in the outputs
+    ikeep = slice(n_offset, n_bins - n_offset) if smoothing > 0 else slice(None)
+    n_align = align_times.size
+    shape_binned = (n_align, ids.size, n_bins - 2 * n_offset if smoothing > 0 else n_bins)
+    if binned_file is not None:
+        binned_spikes = np.lib.format.open_memmap(binned_file, mode='w+', dtype=dtype, shape=shape_binned)
+    elif return_binned:
+        binned_spikes = np.zeros(shape_binned, dtype=dtype)
     else:
-        binned_spikes_ = np.copy(binned_spikes)
-    if return_fr:
-        binned_spikes_ /= bin_size
-
-    peth_means = np.mean(binned_spikes_, axis=0)
-    peth_stds = np.std(binned_spikes_, axis=0)
-
+        binned_spikes = None
+
+    chunk_size = chunk_size or max(n_align, 1)
+    for i0 in np.arange(0, max(n_align, 1), chunk_size):
+        # (ts represent bin edges, so there are one fewer bins)
+        r = _bin_peths(spike_times, spike_clusters, ids, align_times[i0:i0 + chunk_size], tscale, bin_size)
+        r = r.astype(dtype)
+        if binned_spikes is not None:
+            binned_spikes[i0:i0 + chunk_size] = r[:, :, :-1][:, :, ikeep]
+        # smooth all trials and clusters along the time axis
+        if smoothing > 0:
+            binned_spikes_ = fftconvolve(r, window, mode='same', axes=-1)[:, :, :-1]
+        else:
+            binned_spikes_ = np.copy(r[:, :, :-1])
+        del r
+        if return_fr:
+            binned_spikes_ /= bin_size
+        # average
+        if i0 == 0 and chunk_size >= n_align:
+            peth_means = np.mean(binned_spikes_, axis=0)
+            peth_stds = np.std(binned_spikes_, axis=0)
+            continue
+        # merge the mean and sum of squared deviations of the chunk with the previous ones
+        n_b = binned_spikes_.shape[0]
+        mean_b = np.mean(binned_spikes_, axis=0, dtype=np.float64)
+        m2_b = np.sum((binned_spikes_ - mean_b) ** 2, axis=0, dtype=np.float64)
+        if i0 == 0:
+            n, mean, m2 = (n_b, mean_b, m2_b)
+        else:
+            delta = mean_b - mean
+            mean = mean + delta * n_b / (n + n_b)
+            m2 = m2 + m2_b + delta ** 2 * n * n_b / (n + n_b)
+            n += n_b
+        peth_means = mean.astype(dtype)
+        peth_stds = np.sqrt(m2 / n).astype(dtype)
+
+    peth_means = peth_means[:, ikeep]
+    peth_stds = peth_stds[:, ikeep]
     if smoothing > 0:
-        peth_means = peth_means[:, n_offset:-n_offset]
-        peth_stds = peth_stds[:, n_offset:-n_offset]
-        binned_spikes = binned_spikes[:, :, n_offset:-n_offset]
         tscale = tscale[n_offset:-n_offset]
 
     # package output
@@ -138,6 +155,31 @@ def calculate_peths(
     return peths, binned_spikes
 
 
+def _bin_peths(spike_times, spike_clusters, ids, align_times, tscale, bin_size):
+    """
+    Bins the spikes of all align times and clusters at once, see calculate_peths
+    :param spike_times: time sorted spike times, only for spikes of clusters in ids
+    :param spike_clusters: spike clusters
+    :param ids: unique cluster ids
+    :param align_times: align times
+    :param tscale: bin edges relative to the align times
+    :param bin_size: bin size (in seconds)
+    :return: spike counts (n_align_times, n_clusters, n_edges), the last bin gathers the spikes
+     on the last bin edge
+    """
+    # locate the spikes of each trial between the first and last bin edges
+    first = np.searchsorted(spike_times, align_times + tscale[0], side='left')
+    last = np.searchsorted(spike_times, align_times + tscale[-1], side='right')
+    nspikes = np.maximum(last - first, 0)
+    itrial = np.repeat(np.arange(align_times.size), nspikes)
+    ispikes = np.repeat(first - np.r_[0, np.cumsum(nspikes)[:-1]], nspikes) + np.arange(np.sum(nspikes))
+    nx = tscale.size
+    xind = (np.floor((spike_times[ispikes] - (align_times[itrial] + tscale[0])) / bin_size)).astype(np.int64)
+    yind = np.searchsorted(ids, spike_clusters[ispikes])
+    r = np.bincount((itrial * ids.size + yind) * nx + xind, minlength=align_times.size * ids.size * nx)
+    return r.reshape(align_times.size, ids.size, nx)
+
+
 def firing_rate(ts, hist_win=0.01, fr_win=0.5):
     '''
     Computes the instantaneous firing rate of a unit over time by computing a histogram of spike
@@ -1,6 +1,7 @@
 import numpy as np
 from brainbox.metrics import electrode_drift
-from brainbox.metrics.single_units import quick_unit_metrics, noise_cutoff
+from brainbox.metrics.single_units import (quick_unit_metrics, noise_cutoff, contamination, slidingRP_viol,
+                                           slidingRP_viol_clusters)
 from iblutil.numerical import ismember
 
 REC_LEN_SECS = 1000
@@ -69,6 +70,47 @@ def test_clusters_metrics():
     _assertions(dfm, idf, np.arange(5))
 
 
+def test_clusters_metrics_sorted_parallel():
+    np.random.seed(42)
+    frs = np.array([3, 100, 80, 40, 20, 60])
+    cid = np.array([8, 1, 3, 4, 0, 6])  # unsorted cluster ids, with clusters 2 and 5 without spikes
+    t, a, c = multiple_spike_trains(firing_rates=frs, rec_len_secs=200, cluster_ids=cid)
+    d = np.sin(2 * np.pi * c / 200 * t) * 100
+    cluster_ids = np.array([8, 5, 1, 3, 4, 2, 0, 6])
+    dfm = quick_unit_metrics(c, t, a, d, cluster_ids=cluster_ids)
+    dfm_parallel = quick_unit_metrics(c, t, a, d, cluster_ids=cluster_ids, n_workers=2)
+    for k in dfm:
+        np.testing.assert_array_equal(dfm[k], dfm_parallel[k])
+    # compare with the metrics computed on the boolean selection of each cluster
+    for i, ic in enumerate(cluster_ids):
+        ispikes = c == ic
+        if not np.any(ispikes):
+            assert np.isnan(dfm['contamination'][i])
+            continue
+        assert dfm['contamination'][i] == contamination(t[ispikes], t[0], t[-1], rp=0.0015, min_isi=0.0001)[0]
+        assert dfm['slidingRP_viol'][i] == slidingRP_viol(t[ispikes])
+        assert dfm['drift'][i] == np.sum(np.abs(np.diff(d[ispikes]))) / (t[-1] - t[0]) * 3600
+
+
+def test_slidingRP_viol_clusters():
+    np.random.seed(7)
+    frs = np.array([0.5, 5, 20, 40, 80, 120, 10])
+    t, c = (np.empty(0), np.empty(0, dtype=np.int32))
+    for ic, fr in enumerate(frs):
+        # spike trains with a 3ms refractory period, every other cluster is contaminated
+        tc = np.cumsum(0.003 + np.random.exponential(1 / fr, int(300 * fr)))
+        if ic % 2:
+            tc = np.r_[tc, tc[::4] + np.random.rand(tc[::4].size) * 0.001]
+        t, c = (np.r_[t, tc], np.r_[c, np.zeros(tc.size, dtype=np.int32) + ic])
+    ordre = np.argsort(t)
+    t, c = (t[ordre], c[ordre])
+    cluster_ids = np.r_[np.arange(frs.size), 9]  # cluster 9 has no spike
+    didpass = slidingRP_viol_clusters(t, c, cluster_ids=cluster_ids)
+    expected = np.array([slidingRP_viol(t[c == ic]) for ic in cluster_ids])
+    np.testing.assert_array_equal(didpass, expected)
+    assert 0 < np.sum(didpass) < frs.size
+
+
 def test_drift_estimate():
     """
     From spike depths, xcorrelate drift maps to find a drift estimate
@@ -1,6 +1,7 @@
 import unittest
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 import brainbox.modeling.design_matrix as bdm
 import brainbox.modeling.utils as mut
 from pathlib import Path
@@ -60,3 +61,131 @@ class TestModeling(unittest.TestCase):
         if npy_file.exists():
             ref_dm = np.load(npy_file)
             self.assertTrue(np.allclose(self.design.dm, ref_dm))
+
+    def test_dm_sparse(self):
+        """
+        Check that the sparse design matrix matches the dense one, with trial conditions and boxcars
+        """
+        design = bdm.DesignMatrix(self.trialsdf,
+                                  vartypes={'trial_start': 'timing',
+                                            'trial_end': 'timing',
+                                            'stim_onset': 'timing',
+                                            'feedback': 'timing',
+                                            'wheel_traces': 'continuous'})
+        tbases = mut.raised_cosine(0.2, 3, self.binf)
+        design.add_covariate_timing('stim_on', 'stim_onset', tbases, cond=[1, 3, 4])
+        design.add_covariate_timing('feedback', 'feedback', tbases, offset=-0.02)
+        design.add_covariate_boxcar('box', 'stim_onset', 'feedback')
+        design.compile_design_matrix()
+        dm = design.dm
+        nTs = self.binf(self.trialsdf.trial_end - self.trialsdf.trial_start)
+        self.assertEqual(dm.shape, (nTs.sum(), 7))
+        np.testing.assert_array_equal(design.trlabels.flatten(), np.repeat(np.arange(10), nTs))
+        # the stimulus covariate is zero outside of the condition trials
+        self.assertFalse(np.any(dm[~np.isin(design.trlabels.flatten(), [1, 3, 4]), :3]))
+        # each trial is the per trial convolution of the regressor
+        starts = np.r_[0, np.cumsum(nTs)[:-1]]
+        for i in range(10):
+            stim = design.covar['feedback']['regressor'][i]
+            np.testing.assert_allclose(dm[starts[i]:starts[i] + nTs[i], 3:6],
+                                       bdm.convbasis(stim, tbases, -1), atol=1e-12)
+        for i, trial in design.trialsdf.iterrows():
+            bxcar = np.zeros(nTs[i])
+            bxcar[design.binf(trial.stim_onset):design.binf(trial.feedback) + 1] = 1
+            np.testing.assert_array_equal(dm[starts[i]:starts[i] + nTs[i], 6], bxcar)
+        design.compile_design_matrix(dense=False)
+        self.assertEqual(design.dm.format, 'csr')
+        np.testing.assert_array_equal(design.dm.toarray(), dm)
+
+    def test_glm_fitting(self):
+        """
+        Check the parallel and warm started poisson fits and the cholesky linear solver
+        """
+        from brainbox.modeling.poisson import PoissonGLM
+        from brainbox.modeling.linear import LinearGLM
+        design = bdm.DesignMatrix(self.trialsdf[['trial_start', 'trial_end', 'stim_onset', 'feedback']],
+                                  vartypes={'trial_start': 'timing',
+                                            'trial_end': 'timing',
+                                            'stim_onset': 'timing',
+                                            'feedback': 'timing'})
+        tbases = mut.raised_cosine(0.2, 3, self.binf)
+        design.add_covariate_timing('stim_on', 'stim_onset', tbases)
+        design.add_covariate_timing('feedback', 'feedback', tbases)
+        design.compile_design_matrix()
+        # cells firing after the stimulus onset on top of a background rate
+        rng = np.random.default_rng(0)
+        spk_times, spk_clu = [], []
+        for clu in range(4):
+            background = rng.uniform(0, 13.3, 300)
+            evoked = (self.trialsdf.stim_onset.values[:, np.newaxis] + rng.exponential(0.05, (10, 5 * clu + 5)))
+            spk_times.append(np.r_[background, evoked.flatten()])
+            spk_clu.append(np.full(spk_times[-1].size, clu))
+        spk_times, spk_clu = np.concatenate(spk_times), np.concatenate(spk_clu)
+        order = np.argsort(spk_times)
+        spk_times, spk_clu = spk_times[order], spk_clu[order]
+
+        glm = PoissonGLM(design, spk_times, spk_clu, mintrials=5, alpha=0.1)
+        glm.fit(printcond=False)
+        glm_parallel = PoissonGLM(design, spk_times, spk_clu, mintrials=5, alpha=0.1, n_workers=2)
+        glm_parallel.fit(printcond=False)
+        for clu in glm.coefs.index:
+            np.testing.assert_array_equal(glm.coefs[clu], glm_parallel.coefs[clu])
+        np.testing.assert_array_equal(glm.intercepts, glm_parallel.intercepts)
+        # warm started from the fitted coefficients
+        coefs, intercepts = glm._fit(design.dm, glm.binnedspikes, init=(glm.coefs, glm.intercepts))
+        for clu in glm.coefs.index:
+            np.testing.assert_allclose(coefs[clu], glm.coefs[clu], atol=1e-3)
+        glm.fit(train_idx=np.arange(8), printcond=False)
+        selectors = [mut.SequentialSelector(glm, warm_start=warm_start) for warm_start in (False, True)]
+        for sfs in selectors:
+            sfs.fit()
+        pd.testing.assert_frame_equal(selectors[0].sequences_, selectors[1].sequences_)
+        np.testing.assert_allclose(selectors[0].scores_test_.values.astype(float),
+                                   selectors[1].scores_test_.values.astype(float), atol=1e-3)
+
+        lm = LinearGLM(design, spk_times, spk_clu, mintrials=5)
+        lm.fit(printcond=False)
+        lm_chol = LinearGLM(design, spk_times, spk_clu, mintrials=5, solver='cholesky')
+        lm_chol.fit(printcond=False)
+        for clu in lm.coefs.index:
+            np.testing.assert_allclose(lm.coefs[clu], lm_chol.coefs[clu], atol=1e-8)
+        np.testing.assert_allclose(lm.intercepts.astype(float), lm_chol.intercepts.astype(float), atol=1e-8)
+        # the binned spikes held as a sparse matrix give the same fit
+        lm_sparse = LinearGLM(design, spk_times, spk_clu, mintrials=5, sparse=True)
+        self.assertTrue(sp.issparse(lm_sparse.binnedspikes))
+        np.testing.assert_array_equal(lm_sparse.binnedspikes.toarray(), lm.binnedspikes)
+        lm_sparse.fit(printcond=False)
+        for clu in lm.coefs.index:
+            np.testing.assert_allclose(lm.coefs[clu], lm_sparse.coefs[clu])
+        pd.testing.assert_series_equal(lm.score(), lm_sparse.score())
+
+    def test_bin_trial_spikes(self):
+        """
+        Check the spike counts of trials binned at once against per trial histograms
+        """
+        from brainbox.modeling.neural_model import trial_spike_windows, bin_trial_spikes
+        from brainbox.processing import bincount2D
+        rng = np.random.default_rng(0)
+        starts, ends = self.trialsdf.trial_start.values, self.trialsdf.trial_end.values
+        spk_times = np.sort(rng.uniform(0, 14, 5000))
+        spk_times = spk_times[(spk_times < starts[2]) | (spk_times > ends[2])]  # a silent trial
+        spk_clu = rng.integers(0, 6, spk_times.size)
+        clu_ids = np.array([0, 2, 3, 5])
+        windows = trial_spike_windows(spk_times, starts, ends)
+        durations = ends - starts
+        binned = bin_trial_spikes(spk_times, spk_clu, starts, durations, windows, clu_ids, self.binwidth)
+        expected = []
+        for start, duration, first, last in zip(starts, durations, *windows):
+            np.testing.assert_array_equal(spk_times[first:last], spk_times[(spk_times >= start) &
+                                                                           (spk_times <= start + duration)])
+            if duration % self.binwidth > (self.binwidth / 2):
+                duration = duration - (self.binwidth / 2)
+            if first == last:
+                expected.append(np.zeros((self.binf(duration), clu_ids.size)))
+                continue
+            expected.append(bincount2D(spk_times[first:last] - start, spk_clu[first:last], xbin=self.binwidth,
+                                       ybin=clu_ids, xlim=[0, duration])[0].T)
+        np.testing.assert_array_equal(binned, np.vstack(expected))
+        sparse = bin_trial_spikes(spk_times, spk_clu, starts, durations, windows, clu_ids, self.binwidth,
+                                  sparse=True)
+        np.testing.assert_array_equal(sparse.toarray(), binned)
@@ -2,8 +2,8 @@ from pathlib import Path
 import pickle
 from sklearn.naive_bayes import MultinomialNB
 from sklearn.model_selection import KFold
-from brainbox.population.decode import (xcorr, classify, regress, get_spike_counts_in_bins,
-                                        sigtest_pseudosessions, sigtest_linshift)
+from brainbox.population.decode import (xcorr, xcorr_sparse, neighbour_pairs, classify, regress,
+                                        get_spike_counts_in_bins, sigtest_pseudosessions, sigtest_linshift)
 import unittest
 import numpy as np
 
@@ -56,6 +56,12 @@ class TestPopulation(unittest.TestCase):
         self.assertTrue(acc_training == 0.9444444444444444)
         self.assertEqual(pred.shape, event_groups.shape)
         self.assertEqual(prob.shape, event_groups.shape)
+        # the folds fitted in parallel give the same results
+        parallel = classify(counts, event_groups, clf, cross_validation=cv, return_training=True, n_workers=2)
+        self.assertEqual(parallel[0], accuracy)
+        self.assertEqual(parallel[3], acc_training)
+        np.testing.assert_array_equal(parallel[1], pred)
+        np.testing.assert_array_equal(parallel[2], prob)
 
     def test_regress(self):
         if self.test_data is None:
@@ -93,6 +99,10 @@ class TestPopulation(unittest.TestCase):
                                       return_training=True, regularization='L2')
         self.assertEqual(pred.shape, event_groups.shape)
         self.assertEqual(pred_training.shape, event_groups.shape)
+        parallel = regress(counts, event_groups, cross_validation=cv, return_training=True,
+                           regularization='L2', n_workers=2)
+        np.testing.assert_array_equal(parallel[0], pred)
+        np.testing.assert_array_equal(parallel[1], pred_training)
 
     def test_xcorr_0(self):
         # 0: 0, 10
@@ -139,6 +149,31 @@ class TestPopulation(unittest.TestCase):
 
         self.assertEqual(c.shape, (max_cluster, max_cluster, 51))
 
+    def test_xcorr_sparse(self):
+        spike_times = np.array([2, 3, 10, 12, 20, 24, 30, 40], dtype=np.uint64)
+        spike_clusters = np.array([0, 1, 0, 0, 2, 1, 0, 2])
+        c, pairs = xcorr_sparse(spike_times, spike_clusters, bin_size=1, window_size=7)
+        np.testing.assert_array_equal(c.toarray().reshape(3, 3, 7), xcorr(spike_times, spike_clusters, 1, 7))
+        np.testing.assert_array_equal(pairs[:4], [[0, 0], [0, 1], [0, 2], [1, 0]])
+        # random data in time chunks counted by several workers, with coincident spikes
+        max_cluster = 10
+        spike_times, spike_clusters = _random_data(max_cluster)
+        spike_times = np.round(spike_times, 3)
+        expected = xcorr(spike_times, spike_clusters, bin_size=.001, window_size=.05)
+        c, _ = xcorr_sparse(spike_times, spike_clusters, bin_size=.001, window_size=.05,
+                            chunk_size=1000, n_workers=3)
+        np.testing.assert_array_equal(c.toarray().reshape(expected.shape), expected)
+        # subset of pairs, the missing cluster has an empty correlogram
+        pairs = neighbour_pairs(np.arange(max_cluster), np.arange(max_cluster) * 20, 20)
+        self.assertEqual(pairs.shape, (2 * max_cluster - 1, 2))
+        pairs = np.r_[pairs, [[3, 1], [max_cluster, 0]]]
+        c, pairs_ = xcorr_sparse(spike_times, spike_clusters, bin_size=.001, window_size=.05, pairs=pairs)
+        np.testing.assert_array_equal(pairs_, pairs)
+        self.assertEqual(c.shape, (len(pairs), 51))
+        c = c.toarray()
+        np.testing.assert_array_equal(c[:-1], expected[pairs[:-1, 0], pairs[:-1, 1]])
+        self.assertEqual(c[-1].sum(), 0)
+
     def test_sigtest_pseudosessions(self):
         X = np.zeros((200, 700))
         y = np.zeros(700)
@@ -171,6 +206,47 @@ class TestPopulation(unittest.TestCase):
                 acount += 1
         self.assertTrue(acount <= 50)
 
+    def test_sigtest_parallel(self):
+        rng = np.random.default_rng(1)
+        X = rng.normal(size=(5, 400))
+        y = X[0] + rng.normal(size=400)
+
+        def fStatMeas(X, y):
+            return np.abs(np.corrcoef(X[0], y)[0, 1])
+
+        def genPseudo():
+            return np.random.normal(size=400)
+
+        # same null distribution for the same seed whatever the number of workers
+        alpha, real, pseuds = sigtest_pseudosessions(X, y, fStatMeas, genPseudo, npseuds=50, seed=3)
+        alpha_, real_, pseuds_ = sigtest_pseudosessions(X, y, fStatMeas, genPseudo, npseuds=50, seed=3,
+                                                        n_workers=2)
+        self.assertEqual((alpha, real), (alpha_, real_))
+        np.testing.assert_array_equal(pseuds, pseuds_)
+        # early stopping: the p-value is on the same side of the level with less pseudosessions
+        alpha_, _, pseuds_ = sigtest_pseudosessions(X, y, fStatMeas, genPseudo, npseuds=50, seed=3,
+                                                    early_stop=.2)
+        self.assertEqual(alpha, 0)
+        self.assertTrue(alpha_ <= .2 and pseuds_.size == 40)
+        np.testing.assert_array_equal(pseuds_, pseuds[:40])
+        y[:] = rng.normal(size=400)
+        alpha, *_ = sigtest_pseudosessions(X, y, fStatMeas, genPseudo, npseuds=100, seed=3)
+        alpha_, _, pseuds_ = sigtest_pseudosessions(X, y, fStatMeas, genPseudo, npseuds=100, seed=3,
+                                                    early_stop=.05)
+        self.assertTrue(alpha > .05 and alpha_ > .05 and pseuds_.size == 20)
+
+        # linear shifts
+        y = X[0] + rng.normal(size=400)
+        alpha, real, pseuds = sigtest_linshift(X, y, fStatMeas, D=300)
+        alpha_, real_, pseuds_ = sigtest_linshift(X, y, fStatMeas, D=300, n_workers=2)
+        self.assertEqual((alpha, real), (alpha_, real_))
+        np.testing.assert_array_equal(pseuds, pseuds_)
+        self.assertTrue(alpha <= .05)
+        y = rng.normal(size=400)
+        alpha, _, pseuds = sigtest_linshift(X, y, fStatMeas, D=300)
+        alpha_, _, pseuds_ = sigtest_linshift(X, y, fStatMeas, D=300, early_stop=.05)
+        self.assertTrue(alpha > .05 and alpha_ > .05 and pseuds_.size == 20)
+
 
 if __name__ == "__main__":
     np.random.seed(0)
@@ -1,4 +1,6 @@
 from brainbox.singlecell import acorr, calculate_peths
+from pathlib import Path
+import tempfile
 import unittest
 import numpy as np
 
@@ -48,6 +50,53 @@ class TestPeths(unittest.TestCase):
         self.assertTrue(np.all(fr.shape == (n_events, len(cluster_sel), 28)))
         self.assertTrue(peth.tscale.size == 28)
 
+    def test_peths_binning(self):
+        np.random.seed(seed=42)
+        spike_times = np.random.rand(5000, ) * 100  # unsorted spike times
+        spike_clusters = np.random.randint(0, 10, 5000)
+        event_times = np.sort(np.random.rand(50, ) * 100)
+        cluster_sel = [1, 3, 4, 8]
+        peth, bs = calculate_peths(spike_times, spike_clusters, cluster_ids=cluster_sel, align_times=event_times,
+                                   smoothing=0, return_fr=False)
+        # compare with the histograms of each trial and cluster
+        edges = np.arange(-8, 21) * 0.025
+        for i, t0 in enumerate(event_times):
+            for j, c in enumerate(cluster_sel):
+                expected, _ = np.histogram(spike_times[spike_clusters == c] - t0, edges)
+                np.testing.assert_array_equal(bs[i, j, :], expected)
+        np.testing.assert_allclose(peth.means, np.mean(bs, axis=0))
+        # single precision outputs
+        peth32, bs32 = calculate_peths(spike_times, spike_clusters, cluster_ids=cluster_sel,
+                                       align_times=event_times, dtype=np.float32)
+        peth64, _ = calculate_peths(spike_times, spike_clusters, cluster_ids=cluster_sel, align_times=event_times)
+        self.assertEqual(peth32.means.dtype, np.float32)
+        self.assertEqual(bs32.dtype, np.float32)
+        np.testing.assert_allclose(peth32.means, peth64.means, rtol=1e-5, atol=1e-3)
+
+    def test_peths_chunked(self):
+        np.random.seed(seed=42)
+        spike_times = np.sort(np.random.rand(5000, ) * 100)
+        spike_clusters = np.random.randint(0, 10, 5000)
+        event_times = np.sort(np.random.rand(50, ) * 100)
+        kwargs = dict(cluster_ids=[1, 3, 4, 8], align_times=event_times)
+        peth, bs = calculate_peths(spike_times, spike_clusters, **kwargs)
+        # running means and standard deviations over chunks of align times
+        peth_, bs_ = calculate_peths(spike_times, spike_clusters, chunk_size=7, **kwargs)
+        np.testing.assert_array_equal(bs, bs_)
+        np.testing.assert_allclose(peth.means, peth_.means, atol=1e-10)
+        np.testing.assert_allclose(peth.stds, peth_.stds, atol=1e-10)
+        # binned spikes are not materialized
+        peth_, bs_ = calculate_peths(spike_times, spike_clusters, chunk_size=7, return_binned=False, **kwargs)
+        self.assertIsNone(bs_)
+        np.testing.assert_allclose(peth.stds, peth_.stds, atol=1e-10)
+        # binned spikes are written in a memory-mapped file
+        with tempfile.TemporaryDirectory() as td:
+            file_npy = Path(td).joinpath('binned_spikes.npy')
+            _, bs_ = calculate_peths(spike_times, spike_clusters, chunk_size=7, binned_file=file_npy, **kwargs)
+            self.assertIsInstance(bs_, np.memmap)
+            del bs_
+            np.testing.assert_array_equal(np.load(file_npy), bs)
+
 
 def test_firing_rate():
     pass
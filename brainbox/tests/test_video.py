@@ -1,5 +1,8 @@
 import unittest
+import tempfile
+from pathlib import Path
 
+import cv2
 import numpy as np
 
 from brainbox import video
@@ -57,5 +60,41 @@ class TestVideo(unittest.TestCase):
         np.testing.assert_equal(df, expected)
 
 
+class TestStreamMotionEnergy(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.video_path = Path(self.tmpdir.name).joinpath('_iblrig_leftCamera.raw.mp4')
+        writer = cv2.VideoWriter(str(self.video_path), cv2.VideoWriter_fourcc(*'mp4v'), 30, (64, 48))
+        base = np.random.default_rng(0).integers(0, 255, (48, 64, 3), dtype=np.uint8)
+        for i in range(100):
+            writer.write(np.roll(base, i * (i % 3), axis=1))
+        writer.release()
+        cap = cv2.VideoCapture(str(self.video_path))
+        self.frames = np.array([cap.read()[1] for _ in range(100)])
+        cap.release()
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test_frame_chunks(self):
+        chunks = list(video.frame_chunks(self.video_path, chunk_size=30, mask=np.s_[:, :, 0], n_workers=2))
+        self.assertEqual([c.shape[0] for c in chunks], [30, 30, 30, 10])
+        np.testing.assert_array_equal(np.concatenate(chunks), self.frames[..., 0])
+
+    def test_stream_motion_energy(self):
+        mask = np.s_[10:40, 5:50, 1]
+        expected, expected_std = video.motion_energy(self.frames[(slice(None), *mask)], diff=2)
+        for chunk_size, n_workers in [(512, 1), (7, 1), (30, 3)]:
+            me, std = video.stream_motion_energy(self.video_path, mask=mask, chunk_size=chunk_size,
+                                                 n_workers=n_workers)
+            np.testing.assert_allclose(me, expected)
+            np.testing.assert_allclose(std, expected_std)
+        # written to a file, not normalized
+        out = Path(self.tmpdir.name).joinpath('me.npy')
+        me, _ = video.stream_motion_energy(self.video_path, normalize=False, chunk_size=20, out=out)
+        expected, _ = video.motion_energy(self.frames, diff=2, normalize=False)
+        np.testing.assert_array_equal(np.load(out), expected)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,14 @@
 """Functions for analyzing video frame data"""
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
 import numpy as np
 import cv2
 
+from ibllib.io.video import get_video_frames_preload, get_video_meta
+
+CHUNK_SIZE = 512  # number of frames decoded at once when streaming a video
+
 
 def frame_diff(frame1, frame2):
     """
@@ -69,3 +76,92 @@ def motion_energy(frames, diff=2, kernel=None, normalize=True):
     if normalize:
         df_ = (df_ - df_.min()) / (df_.max() - df_.min())
     return df_, stDev
+
+
+def frame_chunks(vid, frame_numbers=None, chunk_size=CHUNK_SIZE, mask=Ellipsis, func=lambda x: x, n_workers=1):
+    """
+    Generator over a video in chunks of consecutive frames, so that a whole video can be processed
+    with a constant memory.
+    :param vid: URL or local path to mp4 file.
+    :param frame_numbers: frames to read, if None, all the frames of the video.
+    :param chunk_size: number of frames per chunk.
+    :param mask: a logical mask or slice to apply to the frames, e.g. an ROI, only the masked pixels
+    are copied.
+    :param func: Function to be applied to each frame, after masking.
+    :param n_workers: number of chunks decoded concurrently, each by a thread with its own capture.
+    At most n_workers chunks are held in memory ahead of the one being processed.
+    :return: generator of uint8 arrays of shape (chunk_size, ...), the last chunk may be shorter.
+
+    Example - Sum of the red channel of an ROI over the whole video
+        total = sum(f.sum() for f in frame_chunks(video_path, mask=np.s_[100:200, 50:150, 2]))
+    """
+    if frame_numbers is None:
+        frame_numbers = np.arange(get_video_meta(vid).length)
+    frame_numbers = np.asarray(frame_numbers)
+    chunks = [frame_numbers[i:i + chunk_size] for i in range(0, frame_numbers.size, chunk_size)]
+
+    def read(chunk):
+        return get_video_frames_preload(vid, chunk, mask=mask, func=func, quiet=True, n_workers=1)
+
+    if n_workers == 1:
+        yield from map(read, chunks)
+        return
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(read, chunk) for chunk in chunks[:n_workers]]
+        for i in range(len(chunks)):
+            frames = futures[i].result()
+            futures[i] = None  # release the chunk
+            if i + n_workers < len(chunks):
+                futures.append(executor.submit(read, chunks[i + n_workers]))
+            yield frames
+
+
+def stream_motion_energy(vid, diff=2, kernel=None, normalize=True, mask=Ellipsis, frame_numbers=None,
+                         chunk_size=CHUNK_SIZE, n_workers=1, out=None):
+    """
+    Computes the motion energy of a whole video, reading the frames in chunks and keeping only the
+    last diff frames between chunks. Gives the same output as motion_energy on the loaded frames.
+    :param vid: URL or local path to mp4 file.
+    :param diff: Take difference between frames N and frames N + diff.
+    :param kernel: An optional Gaussian smoothing to apply to each frame difference with a given
+    kernel size.
+    :param normalize: If True, motion energy is min-max normalized
+    :param mask: a logical mask or slice to apply to the frames, e.g. an ROI.
+    :param frame_numbers: consecutive frames to process, if None, the whole video.
+    :param chunk_size: number of frames decoded at once.
+    :param n_workers: number of chunks decoded concurrently, see frame_chunks.
+    :param out: optional .npy file path where the motion energy is written as it is computed.
+    :return df_: A vector of length n frames - diff, normalized between 0 and 1, a memory-mapped
+    array if out is given.
+    :return stDev: The standard deviation between the frames (not normalized).
+
+    Example - ROI motion energy of a whole session written to disk
+        me, _ = stream_motion_energy(video_path, mask=np.s_[100:200, 50:150, 0], out='me.npy')
+    """
+    if frame_numbers is None:
+        frame_numbers = np.arange(get_video_meta(vid).length)
+    n = max(len(frame_numbers) - diff, 0)
+    if out is not None:
+        df_ = np.lib.format.open_memmap(Path(out), mode='w+', dtype=np.float64, shape=(n,))
+    else:
+        df_ = np.zeros(n)
+    stDev = np.zeros(n)
+    previous = None  # the last diff frames of the previous chunk
+    i = 0
+    for frames in frame_chunks(vid, frame_numbers, chunk_size=chunk_size, mask=mask, n_workers=n_workers):
+        if previous is not None:
+            frames = np.concatenate([previous, frames])
+        previous = frames[-diff:]
+        if frames.shape[0] <= diff:
+            continue
+        df = frame_diffs(frames, diff)
+        if kernel is not None:
+            df = np.array([cv2.GaussianBlur(d, kernel, 0) for d in df])
+        df_[i:i + df.shape[0]] = df.sum(axis=(1, 2))
+        stDev[i:i + df.shape[0]] = [cv2.meanStdDev(x)[1].squeeze() for x in df]
+        i += df.shape[0]
+    if normalize and n > 0:
+        df_[:] = (df_ - df_.min()) / (df_.max() - df_.min())
+    if out is not None:
+        df_.flush()
+    return df_, stDev
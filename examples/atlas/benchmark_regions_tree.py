@@ -0,0 +1,57 @@
+"""
+Benchmark of the BrainRegions ancestors and descendants queries using the nested set index of the
+regions tree, versus navigating the tree by iterating ismember until a fixed point.
+"""
+import time
+
+import numpy as np
+from iblutil.numerical import ismember
+
+from ibllib.atlas import BrainRegions
+
+N_REPEATS = 20
+
+
+def navigate_tree_fixed_point(br, ids, direction='down'):
+    """Previous implementation of BrainRegions._navigate_tree, returns the indices"""
+    indices = ismember(br.id, ids)[0]
+    count = np.sum(indices)
+    while True:
+        if direction == 'down':
+            indices |= ismember(br.parent, br.id[indices])[0]
+        elif direction == 'up':
+            indices |= ismember(br.id, br.parent[indices])[0]
+        if count == np.sum(indices):
+            break
+        count = np.sum(indices)
+    return np.where(indices)[0]
+
+
+br = BrainRegions()
+t0 = time.time()
+br.tree
+print(f"nested set index: {time.time() - t0:.4f} secs")
+
+np.random.seed(42)
+for nids in [1, 10, 100, 1000]:
+    ids = np.random.choice(br.id, nids)
+    for direction in ['down', 'up']:
+        t0 = time.time()
+        for _ in range(N_REPEATS):
+            expected = navigate_tree_fixed_point(br, ids, direction=direction)
+        t_old = (time.time() - t0) / N_REPEATS
+        t0 = time.time()
+        for _ in range(N_REPEATS):
+            _, indices = br._navigate_tree(ids, direction=direction, return_indices=True)
+        t_new = (time.time() - t0) / N_REPEATS
+        assert np.all(expected == indices)
+        print(f"{nids} ids, {direction}: fixed point {t_old * 1e3:.2f} ms, nested set {t_new * 1e3:.2f} ms")
+
+# ancestry of one region per channel: a single lookup versus one query per channel
+channel_ids = np.random.choice(br.id, 384)
+t0 = time.time()
+[br.ancestors(cid) for cid in channel_ids]
+t_loop = time.time() - t0
+t0 = time.time()
+br.ancestors_matrix(channel_ids)
+print(f"384 channels ancestors: per channel loop {t_loop * 1e3:.2f} ms, ancestors_matrix {(time.time() - t0) * 1e3:.2f} ms")
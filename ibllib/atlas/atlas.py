@@ -1,5 +1,7 @@
 from dataclasses import dataclass
 import logging
+import os
+import threading
 import matplotlib.pyplot as plt
 from pathlib import Path, PurePosixPath
 import numpy as np
@@ -19,6 +21,10 @@ from ibllib.atlas.regions import BrainRegions
 _logger = logging.getLogger('ibllib')
 ALLEN_CCF_LANDMARKS_MLAPDV_UM = {'bregma': np.array([5739, 5400, 332])}
 S3_BUCKET_IBL = 'ibl-brain-wide-map-public'
+# version of the uncompressed .npy copies of the atlas volumes, bump to invalidate the local caches
+NPY_CACHE_VERSION = 'v01'
+_SHARED_ATLASES = {}
+_SHARED_ATLASES_LOCK = threading.Lock()
 
 
 def s3_download_public(bucket, object, destination):
@@ -249,7 +255,8 @@ class BrainAtlas:
         self.bc = BrainCoordinates(nxyz=nxyz, xyz0=- bc.i2xyz(iorigin), dxyz=dxyz)
 
         self.surface = None
-        self.boundary = None
+        self.boundary = {}  # precomputed region boundaries volumes, per mapping
+        self._label_file = None  # file of the label volume, the volumes derived from labels are cached next to it
 
     @staticmethod
     def _get_cache_dir():
@@ -266,21 +273,65 @@ class BrainAtlas:
         will be set to np.nan. If you encounter issues working with these surfaces check if this might be the cause.
         """
         if self.surface is None:  # only compute if it hasn't already been computed
-            axz = self.xyz2dims[2]  # this is the dv axis
-            _surface = (self.label == 0).astype(np.int8) * 2
-            l0 = np.diff(_surface, axis=axz, append=2)
-            _top = np.argmax(l0 == -2, axis=axz).astype(float)
-            _top[_top == 0] = np.nan
-            _bottom = self.bc.nz - np.argmax(np.flip(l0, axis=axz) == 2, axis=axz).astype(float)
-            _bottom[_bottom == self.bc.nz] = np.nan
+            volumes = {}
+
+            def _volume(name):
+                # the surface and the top / bottom indices are computed together, and only if one isn't cached
+                if name not in volumes:
+                    volumes['surface'], volumes['top_bottom'] = self._compute_surface_volumes()
+                return volumes[name]
+
+            self.surface = self._cached_volume('surface', lambda: _volume('surface'))
+            _top, _bottom = self._cached_volume('top_bottom', lambda: _volume('top_bottom'))
             self.top = self.bc.i2z(_top + 1)
             self.bottom = self.bc.i2z(_bottom - 1)
-            self.surface = np.diff(_surface, axis=self.xyz2dims[0], append=2) + l0
             idx_srf = np.where(self.surface != 0)
-            self.surface[idx_srf] = 1
             self.srf_xyz = self.bc.i2xyz(np.c_[idx_srf[self.xyz2dims[0]], idx_srf[self.xyz2dims[1]],
                                                idx_srf[self.xyz2dims[2]]].astype(float))
 
+    def _compute_surface_volumes(self):
+        """
+        Computes the outer surface volume and the top and bottom surfaces indices, see compute_surface
+        :return: surface int8 volume, top_bottom (2, ...) array of dv indices
+        """
+        axz = self.xyz2dims[2]  # this is the dv axis
+        _surface = (self.label == 0).astype(np.int8) * 2
+        l0 = np.diff(_surface, axis=axz, append=2)
+        _top = np.argmax(l0 == -2, axis=axz).astype(float)
+        _top[_top == 0] = np.nan
+        _bottom = self.bc.nz - np.argmax(np.flip(l0, axis=axz) == 2, axis=axz).astype(float)
+        _bottom[_bottom == self.bc.nz] = np.nan
+        surface = np.diff(_surface, axis=self.xyz2dims[0], append=2) + l0
+        surface[surface != 0] = 1
+        return surface, np.stack((_top, _bottom))
+
+    def _cached_volume(self, name, fcn):
+        """
+        Returns a volume derived from the label volume. If the atlas has a label file, the volume is
+        computed once and cached next to it as a memory-mapped .npy file, otherwise it is computed.
+        :param name: name of the volume in the cache file name
+        :param fcn: function without arguments computing the volume
+        :return: np.array
+        """
+        if self._label_file is None:
+            return fcn()
+        file_npy = self._label_file.with_name(f'{self._label_file.stem}_{name}_{NPY_CACHE_VERSION}.npy')
+        return _npy_cache(file_npy, self._label_file, fcn)
+
+    def compute_boundary_volume(self, mapping='Allen'):
+        """
+        Computes the 3D volume of the boundaries between regions for a mapping. Once computed, it is used by
+        `slice(volume='boundary')` and the slice plots instead of computing the boundaries of each slice.
+        The bit k of a voxel is set if the next voxel along the volume axis k is in another region.
+        If the atlas has a label file (Allen atlas), the volume is cached on disk.
+        :param mapping: mapping to use. Options can be found using ba.regions.mappings.keys()
+        :return: uint8 np.array of the shape of the label volume
+        """
+        if mapping not in self.boundary:
+            self.boundary[mapping] = self._cached_volume(
+                f'boundary_{mapping}', lambda: _boundary_volume(self.label, self._get_mapping(mapping=mapping)))
+        return self.boundary[mapping]
+
     def _lookup_inds(self, ixyz):
         """
         Performs a 3D lookup from volume indices ixyz to the image volume
@@ -512,6 +563,10 @@ class BrainAtlas:
             self.compute_surface()
             return _take(self.surface, index, axis=self.xyz2dims[axis])
         elif volume == 'boundary':
+            if mapping in self.boundary:
+                # keep the boundaries along the two volume axes of the slice
+                bits = np.uint8(7 - (1 << self.xyz2dims[axis]))
+                return ((_take(self.boundary[mapping], index, axis=self.xyz2dims[axis]) & bits) != 0).astype(np.uint8)
             iregion = _take_remap(self.label, index, self.xyz2dims[axis], mapping)
             return self.compute_boundaries(iregion)
 
@@ -522,14 +577,14 @@ class BrainAtlas:
 
     def compute_boundaries(self, values):
         """
-        Compute the boundaries between regions on slice
-        :param values:
-        :return:
+        Compute the boundaries between regions on slice: a pixel is on a boundary if the next pixel
+        along either axis belongs to another region, as in compute_boundary_volume
+        :param values: 2D array of region indices
+        :return: uint8 array, 1 on the boundaries
         """
-        boundary = np.diff(values, axis=0, append=0)
-        boundary = boundary + np.diff(values, axis=1, append=0)
-        boundary[boundary != 0] = 1
-        return boundary
+        boundary = np.diff(values, axis=0, append=0) != 0
+        boundary |= np.diff(values, axis=1, append=0) != 0
+        return boundary.astype(np.uint8)
 
     def plot_cslice(self, ap_coordinate, volume='image', mapping='Allen', region_values=None, **kwargs):
         """
@@ -890,12 +945,16 @@ class AllenAtlas(BrainAtlas):
     using the IBL Bregma and coordinate system
     """
 
-    def __init__(self, res_um=25, scaling=np.array([1, 1, 1]), mock=False, hist_path=None):
+    def __init__(self, res_um=25, scaling=np.array([1, 1, 1]), mock=False, hist_path=None, mmap=False):
         """
         :param res_um: 10, 25 or 50 um
         :param scaling: scale factor along ml, ap, dv for squeeze and stretch ([1, 1, 1])
         :param mock: for testing purpose
         :param hist_path
+        :param mmap: if True, the volumes are converted once to uncompressed .npy files next to the atlas files
+         that are memory-mapped read-only, so that instantiation is fast and the processes share the page cache.
+         The volumes derived from the labels (surface, boundaries) are then cached as well.
+         Defaults to False: the volumes are read in memory and nothing is written, as before; shared_atlas opts in
         :return: atlas.BrainAtlas
         """
 
@@ -951,22 +1010,49 @@ class AllenAtlas(BrainAtlas):
                 np.savez_compressed(file_label_remap, label)
                 _logger.info(f"Cached remapping file {file_label_remap} ...")
             # loads the files
-            label = self._read_volume(file_label_remap)
-            image = self._read_volume(file_image)
+            label = self._read_volume(file_label_remap, mmap=mmap)
+            image = self._read_volume(file_image, mmap=mmap)
 
         super().__init__(image, label, dxyz, regions, ibregma,
                          dims2xyz=dims2xyz, xyz2dims=xyz2dims)
+        if not mock and mmap:
+            self._label_file = file_label_remap
 
     @staticmethod
-    def _read_volume(file_volume):
-        if file_volume.suffix == '.nrrd':
+    def _read_volume(file_volume, mmap=False):
+        """
+        Reads an atlas volume from a nrrd or npz file
+        :param file_volume: pathlib.Path of the nrrd or npz file
+        :param mmap: if True, the volume is read from an uncompressed .npy copy next to the file,
+         memory-mapped read-only. The copy is created if it doesn't exist or is older than the file.
+        :return: np.array (ap, ml, dv)
+        """
+        if mmap:
+            volume = AllenAtlas._read_volume_npy(file_volume)
+        elif file_volume.suffix == '.nrrd':
             volume, _ = nrrd.read(file_volume, index_order='C')  # ml, dv, ap
-            # we want the coronal slice to be the most contiguous
-            volume = np.transpose(volume, (2, 0, 1))  # image[iap, iml, idv]
         elif file_volume.suffix == '.npz':
             volume = np.load(file_volume)['arr_0']
+        if file_volume.suffix == '.nrrd':
+            # we want the coronal slice to be the most contiguous
+            volume = np.transpose(volume, (2, 0, 1))  # image[iap, iml, idv]
         return volume
 
+    @staticmethod
+    def _read_volume_npy(file_volume):
+        """
+        Memory-maps the .npy cache of a nrrd or npz volume file, as stored in the file (no transposition)
+        :param file_volume: pathlib.Path of the nrrd or npz file
+        :return: read-only np.memmap
+        """
+        def _read():
+            if file_volume.suffix == '.nrrd':
+                return nrrd.read(file_volume, index_order='C')[0]
+            else:
+                return np.load(file_volume)['arr_0']
+        file_npy = file_volume.with_name(f'{file_volume.stem}_{NPY_CACHE_VERSION}.npy')
+        return _npy_cache(file_npy, file_volume, _read)
+
     def xyz2ccf(self, xyz, ccf_order='mlapdv'):
         """
         Converts coordinates to the CCF coordinates, which is assumed to be the cube indices
@@ -1029,6 +1115,74 @@ def NeedlesAtlas(*args, **kwargs):
     return AllenAtlas(*args, **kwargs)
 
 
+def _npy_cache(file_npy, file_source, fcn):
+    """
+    Memory-maps a .npy cache file, created from fcn() if it doesn't exist or is older than its source file
+    :param file_npy: pathlib.Path of the .npy cache file
+    :param file_source: pathlib.Path of the file the cached array derives from
+    :param fcn: function without arguments computing the array
+    :return: read-only np.memmap, or the array computed in memory if the cache can't be written
+    """
+    if not file_npy.exists() or file_npy.stat().st_mtime < file_source.stat().st_mtime:
+        array = fcn()
+        _logger.info(f"Writing the uncompressed cache {file_npy} ({array.nbytes / 1024 ** 2:.0f} Mo)")
+        # write to a temporary file and rename so that concurrent processes never read a partial file
+        file_tmp = file_npy.with_name(f'{file_npy.name}.{os.getpid()}.part')
+        try:
+            with open(file_tmp, 'wb') as fid:
+                np.save(fid, array)
+            file_tmp.replace(file_npy)
+        except OSError as e:
+            _logger.warning(f"Could not write the cache {file_npy}, the volume is kept in memory: {e}")
+            file_tmp.unlink(missing_ok=True)
+            return array
+    return np.load(file_npy, mmap_mode='r')
+
+
+def _boundary_volume(label, mapping, chunk_size=64):
+    """
+    Computes the region boundaries volume of a label volume by chunks along the first axis,
+    see BrainAtlas.compute_boundary_volume
+    :param label: label volume
+    :param mapping: mapping array of the label indices to the region indices
+    :param chunk_size: number of slices along the first axis computed at once
+    :return: uint8 volume
+    """
+    boundary = np.zeros(label.shape, dtype=np.uint8)
+    mapping = mapping.astype(np.min_scalar_type(np.max(mapping)))
+    for first in range(0, label.shape[0], chunk_size):
+        last = min(first + chunk_size, label.shape[0])
+        # the next slice is needed for the differences along the first axis, 0 after the last one
+        values = mapping[label[first:last + 1]]
+        if last == label.shape[0]:
+            values = np.concatenate((values, np.zeros_like(values[:1])))
+        boundary[first:last] = values[1:] != values[:-1]
+        for dim in (1, 2):
+            boundary[first:last] |= (np.diff(values[:-1], axis=dim, append=0) != 0).astype(np.uint8) << dim
+    return boundary
+
+
+def shared_atlas(res_um=25, scaling=(1, 1, 1), mock=False, hist_path=None, mmap=False):
+    """
+    Returns an AllenAtlas instance shared within the process: the atlas is instantiated on the first call
+    and the same object is returned by subsequent calls with the same arguments.
+    The shared atlas must be treated as read-only.
+    :param res_um: 10, 25 or 50 um
+    :param scaling: scale factor along ml, ap, dv for squeeze and stretch ([1, 1, 1])
+    :param mock: for testing purpose
+    :param hist_path: path of the image volume file
+    :param mmap: if True, memory-maps the volumes from .npy caches written next to the atlas files,
+     see AllenAtlas. Defaults to False
+    :return: atlas.AllenAtlas
+    """
+    scaling = np.asarray(scaling, dtype=float)
+    key = (res_um, tuple(scaling.tolist()), bool(mock), None if hist_path is None else str(hist_path), bool(mmap))
+    with _SHARED_ATLASES_LOCK:
+        if key not in _SHARED_ATLASES:
+            _SHARED_ATLASES[key] = AllenAtlas(res_um, scaling=scaling, mock=mock, hist_path=hist_path, mmap=mmap)
+        return _SHARED_ATLASES[key]
+
+
 def _download_atlas_allen(file_image, FLAT_IRON_ATLAS_REL_PATH, par):
     """
     © 2015 Allen Institute for Brain Science. Allen Mouse Brain Atlas (2015)
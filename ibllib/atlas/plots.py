@@ -8,7 +8,7 @@ import numpy as np
 from scipy.ndimage import gaussian_filter
 from scipy.stats import binned_statistic
 
-from ibllib.atlas import AllenAtlas, FlatMap
+from ibllib.atlas import FlatMap, shared_atlas
 from ibllib.atlas.regions import BrainRegions
 from iblutil.numerical import ismember
 
@@ -80,7 +80,7 @@ def plot_scalar_on_slice(regions, values, coord=-1000, slice='coronal', mapping=
     :return:
     """
 
-    ba = brain_atlas or AllenAtlas()
+    ba = brain_atlas or shared_atlas()
     br = ba.regions
 
     if clevels is None:
@@ -225,7 +225,7 @@ def plot_volume_on_slice(volume, coord=-1000, slice='coronal', mapping='Allen',
     :return:
     """
 
-    ba = brain_atlas or AllenAtlas()
+    ba = brain_atlas or shared_atlas()
     assert volume.shape == ba.image.shape, 'Volume must have same shape as ba'
 
     # Find the mapping to use
@@ -269,7 +269,7 @@ def plot_points_on_slice(xyz, values=None, coord=-1000, slice='coronal', mapping
     :return:
     """
 
-    ba = brain_atlas or AllenAtlas()
+    ba = brain_atlas or shared_atlas()
 
     # Find the mapping to use
     if '-lr' in mapping:
@@ -305,7 +305,7 @@ def compute_volume_from_points(xyz, values=None, aggr='sum', fwhm=100, ba=None):
     :return:
     """
 
-    ba = ba or AllenAtlas()
+    ba = ba or shared_atlas()
 
     idx = ba._lookup(xyz)
     ba_shape = ba.image.shape[0] * ba.image.shape[1] * ba.image.shape[2]
@@ -334,7 +334,7 @@ def compute_volume_from_points(xyz, values=None, aggr='sum', fwhm=100, ba=None):
 def _plot_slice(coord, slice, region_values, vol_type, background='boundary', map='Allen', clevels=None, cmap='viridis',
                 show_cbar=False, ba=None, ax=None):
 
-    ba = ba or AllenAtlas()
+    ba = ba or shared_atlas()
 
     if clevels is None:
         clevels = (np.nanmin(region_values), np.nanmax(region_values))
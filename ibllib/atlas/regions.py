@@ -4,6 +4,7 @@ from pathlib import Path
 
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from iblutil.util import Bunch
 from iblutil.numerical import ismember
 
@@ -56,6 +57,7 @@ class BrainRegions(_BrainRegions):
         mappings = pd.read_parquet(FILE_MAPPINGS)
         self.mappings = {k: mappings[k].to_numpy() for k in mappings}
         self.n_lr = int((len(self.id) - 1) / 2)
+        self._tree = None  # nested set index of the regions tree, computed on first use
 
     @property
     def rgba(self):
@@ -107,6 +109,45 @@ class BrainRegions(_BrainRegions):
             b[k] = self.__getattribute__(k)[iself[uind]]
         return b
 
+    @property
+    def tree(self) -> Bunch:
+        """
+        Nested set index of the regions tree, computed once:
+            - first: position of each region in the depth-first (pre-order) traversal of the tree
+            - last: position of the last descendant of each region in the traversal, the descendants
+             of a region i are the regions j such that first[i] <= first[j] <= last[i]
+            - ancestors: sparse boolean matrix (nregions, nregions), row i flags the ancestors of the
+             region i, including itself
+        Regions whose parent is not in the regions (root, void) are the roots of the trees.
+        """
+        if self._tree is None:
+            n = self.id.size
+            has_parent, iparent = ismember(self.parent, self.id)
+            children = [[] for _ in range(n + 1)]  # the last list holds the roots
+            for i, ip in zip(np.where(has_parent)[0], iparent):
+                children[ip].append(i)
+            children[n] = list(np.where(~has_parent)[0])
+            first, last = (np.zeros(n, dtype=np.int64), np.zeros(n, dtype=np.int64))
+            rows, cols = ([], [])
+            # iterative depth-first traversal, the stack holds the path from the root to the current region
+            position, path, stack = (0, [], [iter(children[n])])
+            while stack:
+                i = next(stack[-1], None)
+                if i is None:
+                    stack.pop()
+                    if path:
+                        last[path.pop()] = position - 1
+                    continue
+                first[i] = position
+                position += 1
+                path.append(i)
+                rows.extend([i] * len(path))
+                cols.extend(path)
+                stack.append(iter(children[i]))
+            ancestors = sp.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(n, n))
+            self._tree = Bunch(first=first, last=last, ancestors=ancestors)
+        return self._tree
+
     def _navigate_tree(self, ids, direction='down', return_indices=False):
         """
         Private method to navigate the tree and get all related objects either up, down or along the branch.
@@ -117,19 +158,18 @@ class BrainRegions(_BrainRegions):
         to the current br object
         :return: Bunch
         """
-        indices = ismember(self.id, ids)[0]
-        count = np.sum(indices)
-        while True:
-            if direction == 'down':
-                indices |= ismember(self.parent, self.id[indices])[0]
-            elif direction == 'up':
-                indices |= ismember(self.id, self.parent[indices])[0]
-            else:
-                raise ValueError("direction should be either 'up' or 'down'")
-            if count == np.sum(indices):  # last iteration didn't find any match
-                break
-            else:
-                count = np.sum(indices)
+        isel = np.where(ismember(self.id, ids)[0])[0]
+        indices = np.zeros(self.id.size, dtype=bool)
+        if direction == 'down':
+            # union of the traversal intervals of the regions: +1 at the interval starts, -1 after the ends
+            count = np.zeros(self.id.size + 1, dtype=np.int64)
+            np.add.at(count, self.tree.first[isel], 1)
+            np.add.at(count, self.tree.last[isel] + 1, -1)
+            indices = np.cumsum(count[:-1])[self.tree.first] > 0
+        elif direction == 'up':
+            indices[self.tree.ancestors[isel].indices] = True
+        else:
+            raise ValueError("direction should be either 'up' or 'down'")
         if return_indices:
             return self.get(self.id[indices]), np.where(indices)[0]
         else:
@@ -170,6 +210,23 @@ class BrainRegions(_BrainRegions):
         """
         return self._navigate_tree(ids, direction='up', **kwargs)
 
+    def ancestors_matrix(self, ids):
+        """
+        Get the ancestors of each region of an array of ids at once, for example the ancestors
+        of the region of each channel. To find which ids are in the subtree of a region of index i:
+        ancestors_matrix(ids)[:, i].toarray()
+        :param ids: np.array of region ids, may contain duplicates
+        :return: scipy.sparse.csr_matrix of booleans (ids.size, nregions): row k flags the indices,
+         in the current br object, of the ancestors of ids[k] including itself. Rows of ids not
+         found are empty.
+        """
+        ids = np.atleast_1d(ids)
+        found, iids = ismember(ids, self.id)
+        # spreads the ancestors rows of the found ids over the rows of all ids
+        select = sp.csr_matrix((np.ones(iids.size, dtype=bool), (np.where(found)[0], np.arange(iids.size))),
+                               shape=(ids.size, iids.size))
+        return sp.csr_matrix(select @ self.tree.ancestors[iids])
+
     def leaves(self):
         """
         Get all regions that do not have children
@@ -1,6 +1,8 @@
 """
 Quality control of raw Neuropixel electrophysiology data.
 """
+from concurrent.futures import ThreadPoolExecutor
+import copy
 from pathlib import Path
 import logging
 import shutil
@@ -17,6 +19,7 @@ from neurodsp import fourier, utils, voltage
 from brainbox.io.spikeglx import Streamer
 from brainbox.metrics.single_units import spike_sorting_metrics
 from ibllib.ephys import sync_probes, spikes
+from ibllib.ephys.raw_pass import RawPassConsumer
 from ibllib.qc import base
 from ibllib.io.extractors import ephys_fpga, training_wheel
 from ibllib.misc import print_progress
@@ -32,6 +35,8 @@ BATCHES_SPACING = 300
 TMIN = 40
 SAMPLE_LENGTH = 1
 SPIKE_THRESHOLD_UV = -50  # negative, the threshold used for spike detection on pre-processed raw data
+RMS_MAX_MEMORY_GB = 8  # memory ceiling of the parallel RMS map computation
+RMS_WINDOW_COPIES = 4  # number of double precision copies of a window held by a RMS map worker
 
 
 class EphysQC(base.QC):
@@ -191,11 +196,73 @@ class EphysQC(base.QC):
         return qc_files
 
 
-def rmsmap(sglx):
+def _rmsmap_window(D, fs):
+    """
+    Computes the RMS and the Welch spectral density of a single window of raw data
+
+    :param D: raw data window (nc, nsamples)
+    :param fs: sampling frequency (Hz)
+    :return: rms (nc,), nsamples, spectral density (nfreqs, nc) or None if the window is too short for Welch
+    """
+    # remove low frequency noise below 1 Hz
+    D = fourier.hp(D, 1 / fs, [0, 1])
+    if D.shape[1] < WELCH_WIN_LENGTH_SAMPLES:
+        return utils.rms(D), D.shape[1], None
+    # compute a smoothed spectrum using welch method
+    _, w = signal.welch(D, fs=fs, window='hanning', nperseg=WELCH_WIN_LENGTH_SAMPLES,
+                        detrend='constant', return_onesided=True, scaling='density', axis=-1)
+    return utils.rms(D), D.shape[1], w.T
+
+
+def _rmsmap_windows(sglx, windows, nfreqs, progress=False):
+    """
+    Computes RMS and summed Welch spectral density over a contiguous range of windows
+
+    :param sglx: Open spikeglx reader
+    :param windows: list of (first, last) sample indices of the windows
+    :param nfreqs: number of frequencies of the one-sided Welch spectrum
+    :param progress: (False) if True prints the progress over the windows
+    :return: TRMS (nwindows, nc), nsamples (nwindows,), summed spectral density (nfreqs, nc)
+    """
+    nwin = len(windows)
+    trms = np.zeros((nwin, sglx.nc))
+    nsamples = np.zeros((nwin,))
+    spectral_density = np.zeros((nfreqs, sglx.nc))
+    for iw, (first, last) in enumerate(windows):
+        D = sglx.read_samples(first_sample=first, last_sample=last)[0].transpose()
+        trms[iw, :], nsamples[iw], w = _rmsmap_window(D, sglx.fs)
+        # the last window may be smaller than what is needed for welch
+        if w is None:
+            continue
+        spectral_density += w
+        # print at least every 20 windows
+        if progress and (iw % min(20, max(int(np.floor(nwin / 75)), 1))) == 0:
+            print_progress(iw, nwin)
+    return trms, nsamples, spectral_density
+
+
+def _rmsmap_shard(sglx, windows, nfreqs):
+    """
+    Computes a shard of the RMS map on its own handle of the raw data, so that several shards can
+    be read concurrently, including from a compressed file
+    """
+    sr = copy.copy(sglx)
+    sr.open()
+    try:
+        return _rmsmap_windows(sr, windows, nfreqs)
+    finally:
+        sr.close()
+
+
+def rmsmap(sglx, n_workers=1, max_memory_gb=RMS_MAX_MEMORY_GB):
     """
     Computes RMS map in time domain and spectra for each channel of Neuropixel probe
 
     :param sglx: Open spikeglx reader
+    :param n_workers: (1) number of threads used to compute contiguous ranges of windows
+     concurrently. The partial spectral densities of each range are summed at the end.
+    :param max_memory_gb: memory ceiling of the computation, limits the number of concurrent
+     workers according to the size of a window
     :return: a dictionary with amplitudes in channeltime space, channelfrequency space, time
      and frequency scales
     """
@@ -203,34 +270,85 @@ def rmsmap(sglx):
     # the window generator will generates window indices
     wingen = utils.WindowGenerator(ns=sglx.ns, nswin=rms_win_length_samples, overlap=0)
     # pre-allocate output dictionary of numpy arrays
-    win = {'TRMS': np.zeros((wingen.nwin, sglx.nc)),
-           'nsamples': np.zeros((wingen.nwin,)),
-           'fscale': fourier.fscale(WELCH_WIN_LENGTH_SAMPLES, 1 / sglx.fs, one_sided=True),
+    win = {'fscale': fourier.fscale(WELCH_WIN_LENGTH_SAMPLES, 1 / sglx.fs, one_sided=True),
            'tscale': wingen.tscale(fs=sglx.fs)}
-    win['spectral_density'] = np.zeros((len(win['fscale']), sglx.nc))
-    # loop through the whole session
-    for first, last in wingen.firstlast:
-        D = sglx.read_samples(first_sample=first, last_sample=last)[0].transpose()
-        # remove low frequency noise below 1 Hz
-        D = fourier.hp(D, 1 / sglx.fs, [0, 1])
-        iw = wingen.iw
-        win['TRMS'][iw, :] = utils.rms(D)
-        win['nsamples'][iw] = D.shape[1]
-        # the last window may be smaller than what is needed for welch
-        if last - first < WELCH_WIN_LENGTH_SAMPLES:
-            continue
-        # compute a smoothed spectrum using welch method
-        _, w = signal.welch(D, fs=sglx.fs, window='hanning', nperseg=WELCH_WIN_LENGTH_SAMPLES,
-                            detrend='constant', return_onesided=True, scaling='density', axis=-1)
-        win['spectral_density'] += w.T
-        # print at least every 20 windows
-        if (iw % min(20, max(int(np.floor(wingen.nwin / 75)), 1))) == 0:
-            print_progress(iw, wingen.nwin)
+    windows = list(wingen.firstlast)
+    nfreqs = len(win['fscale'])
+    # each worker holds a few double precision copies of its current window in memory
+    window_bytes = rms_win_length_samples * sglx.nc * 8 * RMS_WINDOW_COPIES
+    n_workers = int(max(1, min(n_workers, len(windows), max_memory_gb * 1024 ** 3 // window_bytes)))
+    if n_workers == 1:
+        shards = [_rmsmap_windows(sglx, windows, nfreqs, progress=True)]
+    else:
+        _logger.info(f"Computing RMS map over {len(windows)} windows with {n_workers} workers")
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_rmsmap_shard, sglx, list(ws), nfreqs)
+                       for ws in np.array_split(np.array(windows), n_workers)]
+            shards = [future.result() for future in futures]
+    # reduce the shards: the windows are concatenated and the spectral densities summed
+    win['TRMS'] = np.concatenate([shard[0] for shard in shards], axis=0)
+    win['nsamples'] = np.concatenate([shard[1] for shard in shards])
+    win['spectral_density'] = np.zeros((nfreqs, sglx.nc))
+    for shard in shards:
+        win['spectral_density'] += shard[2]
     sglx.close()
     return win
 
 
-def extract_rmsmap(sglx, out_folder=None, overwrite=False):
+class RmsMap(RawPassConsumer):
+    """
+    Raw pass consumer computing the RMS map and the spectral density, same output as rmsmap
+    """
+
+    def setup(self, sr):
+        super().setup(sr)
+        self.nswin = int(2 ** np.ceil(np.log2(sr.fs * RMS_WIN_LENGTH_SECS)))
+        wingen = utils.WindowGenerator(ns=sr.ns, nswin=self.nswin, overlap=0)
+        self.win = {'TRMS': np.zeros((wingen.nwin, sr.nc)),
+                    'nsamples': np.zeros((wingen.nwin,)),
+                    'fscale': fourier.fscale(WELCH_WIN_LENGTH_SAMPLES, 1 / sr.fs, one_sided=True),
+                    'tscale': wingen.tscale(fs=sr.fs)}
+        self.win['spectral_density'] = np.zeros((len(self.win['fscale']), sr.nc))
+
+    @property
+    def multiple(self):
+        return self.nswin
+
+    def process(self, first, data, sync):
+        # the batches are a multiple of the RMS window length
+        for i0 in np.arange(0, data.shape[0], self.nswin):
+            iw = (first + i0) // self.nswin
+            rms, ns, w = _rmsmap_window(data[i0:i0 + self.nswin, :].transpose(), self.fs)
+            self.win['TRMS'][iw, :] = rms
+            self.win['nsamples'][iw] = ns
+            if w is not None:
+                self.win['spectral_density'] += w
+
+    def finalize(self):
+        return self.win
+
+
+def _save_rmsmap(rms, sglx_type, out_folder):
+    """
+    Saves the output of rmsmap as _iblqc_ephysTimeRms and _iblqc_ephysSpectralDensity ALF objects
+    :return: list of output files
+    """
+    alf_object_time = f'ephysTimeRms{sglx_type.upper()}'
+    alf_object_freq = f'ephysSpectralDensity{sglx_type.upper()}'
+    # output ALF files, single precision with the optional label as suffix before extension
+    if not out_folder.exists():
+        out_folder.mkdir()
+    tdict = {'rms': rms['TRMS'].astype(np.single), 'timestamps': rms['tscale'].astype(np.single)}
+    fdict = {'power': rms['spectral_density'].astype(np.single),
+             'freqs': rms['fscale'].astype(np.single)}
+    out_time = alfio.save_object_npy(
+        out_folder, object=alf_object_time, dico=tdict, namespace='iblqc')
+    out_freq = alfio.save_object_npy(
+        out_folder, object=alf_object_freq, dico=fdict, namespace='iblqc')
+    return out_time + out_freq
+
+
+def extract_rmsmap(sglx, out_folder=None, overwrite=False, n_workers=1, max_memory_gb=RMS_MAX_MEMORY_GB):
     """
     Wrapper for rmsmap that outputs _ibl_ephysRmsMap and _ibl_ephysSpectra ALF files
 
@@ -238,6 +356,8 @@ def extract_rmsmap(sglx, out_folder=None, overwrite=False):
     :param out_folder: folder in which to store output ALF files. Default uses the folder in which
      the `fbin` file lives.
     :param overwrite: do not re-extract if all ALF files already exist
+    :param n_workers: (1) number of threads used to compute the RMS map, see rmsmap
+    :param max_memory_gb: memory ceiling of the RMS map computation, see rmsmap
     :param label: string or list of strings that will be appended to the filename before extension
     :return: None
     """
@@ -254,33 +374,58 @@ def extract_rmsmap(sglx, out_folder=None, overwrite=False):
         _logger.warning(f'RMS map already exists for .{sglx.type} data in {out_folder}, skipping. Use overwrite option.')
         return files_time + files_freq
     # crunch numbers
-    rms = rmsmap(sglx)
-    # output ALF files, single precision with the optional label as suffix before extension
-    if not out_folder.exists():
-        out_folder.mkdir()
-    tdict = {'rms': rms['TRMS'].astype(np.single), 'timestamps': rms['tscale'].astype(np.single)}
-    fdict = {'power': rms['spectral_density'].astype(np.single),
-             'freqs': rms['fscale'].astype(np.single)}
-    out_time = alfio.save_object_npy(
-        out_folder, object=alf_object_time, dico=tdict, namespace='iblqc')
-    out_freq = alfio.save_object_npy(
-        out_folder, object=alf_object_freq, dico=fdict, namespace='iblqc')
-    return out_time + out_freq
+    rms = rmsmap(sglx, n_workers=n_workers, max_memory_gb=max_memory_gb)
+    return _save_rmsmap(rms, sglx.type, out_folder)
+
+
+def extract_sync_rmsmap(sglx, out_folder=None, parts='', overwrite=False):
+    """
+    Extracts the sync fronts and the RMS map of a raw ephys file in a single pass over the raw data
+    and outputs the spikeglx.sync, _iblqc_ephysTimeRms and _iblqc_ephysSpectralDensity ALF files
+
+    :param sglx: spikeglx Reader
+    :param out_folder: folder in which to store output ALF files. Default uses the folder in which
+     the `fbin` file lives.
+    :param parts: string or list of strings that will be appended to the sync filenames before extension
+    :param overwrite: do not re-extract if all ALF files already exist
+    :return: list of output files
+    """
+    out_folder = Path(out_folder or sglx.file_bin.parent)
+    alfname = dict(object='sync', namespace='spikeglx')
+    if parts:
+        alfname['extra'] = parts
+    files_time = list(out_folder.glob(f"_iblqc_ephysTimeRms{sglx.type.upper()}*"))
+    files_freq = list(out_folder.glob(f"_iblqc_ephysSpectralDensity{sglx.type.upper()}*"))
+    if (len(files_time) == 2 == len(files_freq)) and alfio.exists(out_folder, **alfname) and not overwrite:
+        _logger.warning(f'Sync and RMS map already exist for .{sglx.type} data in {out_folder}, skipping. '
+                        f'Use overwrite option.')
+        sglx.close()
+        return alfio._ls(out_folder, **alfname)[0] + files_time + files_freq
+    rms = RmsMap()
+    _, sync_files = ephys_fpga._sync_to_alf(sglx, out_folder, save=True, parts=parts, consumers=[rms])
+    sglx.close()
+    return sync_files + _save_rmsmap(rms.finalize(), sglx.type, out_folder)
 
 
-def raw_qc_session(session_path, overwrite=False):
+def raw_qc_session(session_path, overwrite=False, sync=False):
     """
     Wrapper that exectutes QC from a session folder and outputs the results whithin the same folder
     as the original raw data.
     :param session_path: path of the session (Subject/yyyy-mm-dd/number
     :param overwrite: bool (False) Force means overwriting an existing QC file
+    :param sync: bool (False) if True, the sync of the ap files is extracted in the same pass over the
+     raw data as the ap RMS map, see extract_sync_rmsmap
     :return: None
     """
     efiles = spikeglx.glob_ephys_files(session_path)
     qc_files = []
     for efile in efiles:
         if efile.get('ap') and efile.ap.exists():
-            qc_files.extend(extract_rmsmap(efile.ap, out_folder=None, overwrite=overwrite))
+            if sync:
+                qc_files.extend(extract_sync_rmsmap(spikeglx.Reader(efile.ap), parts=efile.label,
+                                                    overwrite=overwrite))
+            else:
+                qc_files.extend(extract_rmsmap(efile.ap, out_folder=None, overwrite=overwrite))
         if efile.get('lf') and efile.lf.exists():
             qc_files.extend(extract_rmsmap(efile.lf, out_folder=None, overwrite=overwrite))
     return qc_files
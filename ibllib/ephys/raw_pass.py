@@ -0,0 +1,88 @@
+"""
+Single pass over a raw electrophysiology binary file.
+
+Each batch of samples is read, and decompressed for mtscomp files, only once and handed over to a list of consumers
+that each compute their own product (sync fronts, RMS map, spectral density...). This allows computing several products
+from the same raw file without paying for the disk reads and the decompression several times.
+
+>>> from ibllib.ephys.ephysqc import RmsMap
+>>> from ibllib.io.extractors.ephys_fpga import SyncFronts
+>>> sync, rms = raw_pass(spikeglx.Reader(bin_file), [SyncFronts(), RmsMap()])
+"""
+import logging
+
+import numpy as np
+
+_logger = logging.getLogger('ibllib')
+
+# the batches are kept short so that the data and the sync of a batch are read from the mtscomp decompressed chunks cache
+RAW_PASS_BATCH_SECS = 4
+
+
+class RawPassConsumer:
+    """
+    Base class of a raw pass consumer. Subclasses implement the `process` and `finalize` methods, and may
+    override `setup` and `multiple`.
+    """
+    needs_data = True  # if no consumer of the pass needs the data, only the sync traces are read
+
+    def setup(self, sr):
+        """
+        Called once with the open reader before the pass
+        :param sr: open spikeglx.Reader
+        """
+        self.fs = sr.fs
+
+    @property
+    def multiple(self):
+        """Number of samples the batches boundaries have to be a multiple of, read after setup"""
+        return 1
+
+    def process(self, first, data, sync):
+        """
+        Called for each batch, in order
+        :param first: index of the first sample of the batch
+        :param data: float32 array (nsamples, nc) of the batch, as returned by spikeglx.Reader.read_samples,
+         None if no consumer of the pass needs the data
+        :param sync: int8 array (nsamples, nsync_channels) of the sync traces of the batch
+        """
+        raise NotImplementedError
+
+    def finalize(self):
+        """
+        Called once after the pass
+        :return: the product of the consumer
+        """
+        raise NotImplementedError
+
+
+def raw_pass(sr, consumers, batch_secs=RAW_PASS_BATCH_SECS):
+    """
+    Reads a raw ephys file once and hands over each batch of samples to all consumers
+
+    :param sr: spikeglx.Reader, if the reader is not open it is opened and closed at the end of the pass
+    :param consumers: list of RawPassConsumer instances
+    :param batch_secs: approximate duration of a batch, the batches are a multiple of all consumers' multiples
+    :return: list of the consumers products, in the same order as the consumers
+    """
+    opened = sr.is_open
+    if not opened:
+        sr.open()
+    for consumer in consumers:
+        consumer.setup(sr)
+    multiple = int(np.lcm.reduce([int(consumer.multiple) for consumer in consumers]))
+    batch = int(max(1, np.round(batch_secs * sr.fs / multiple)) * multiple)
+    needs_data = any(consumer.needs_data for consumer in consumers)
+    _logger.info(f"Raw pass over {sr.file_bin} with {len(consumers)} consumers, {batch} samples batches")
+    for first in range(0, sr.ns, batch):
+        last = min(first + batch, sr.ns)
+        if needs_data:
+            data, sync = sr.read_samples(first_sample=first, last_sample=last)
+        else:
+            data, sync = (None, sr.read_sync(slice(first, last)))
+        for consumer in consumers:
+            consumer.process(first, data, sync)
+    # If opened Reader was passed into function, leave open
+    if not opened:
+        sr.close()
+    return [consumer.finalize() for consumer in consumers]
@@ -4,6 +4,7 @@ Complete FPGA data extraction depends on Bpod extraction
 from collections import OrderedDict
 import logging
 from pathlib import Path
+import tempfile
 import uuid
 
 import matplotlib.pyplot as plt
@@ -15,6 +16,7 @@ import one.alf.io as alfio
 from iblutil.util import Bunch
 
 import ibllib.exceptions as err
+from ibllib.ephys.raw_pass import RawPassConsumer, raw_pass, RAW_PASS_BATCH_SECS
 from ibllib.io import raw_data_loaders
 from ibllib.io.extractors.bpod_trials import extract_all as bpod_extract_all
 from ibllib.io.extractors.opto_trials import LaserBool
@@ -25,6 +27,7 @@ import ibllib.plots as plots
 _logger = logging.getLogger('ibllib')
 
 SYNC_BATCH_SIZE_SECS = 100  # number of samples to read at once in bin file for sync
+SYNC_FRONTS_BUFFER_SIZE = 2 ** 16  # initial number of fronts of the sync extraction buffer
 WHEEL_RADIUS_CM = 1  # stay in radians
 WHEEL_TICKS = 1024
 
@@ -95,7 +98,72 @@ def get_ibl_sync_map(ef, version):
             return {**default_chmap, **chmap}
 
 
-def _sync_to_alf(raw_ephys_apfile, output_path=None, save=False, parts=''):
+class SyncFronts(RawPassConsumer):
+    """
+    Raw pass consumer detecting the fronts of the sync traces. The fronts are accumulated in memory in a growing
+    array of float64 times, int8 channels and int8 polarities. If a spill size is set, the fronts are appended
+    to a temporary file every time more than `spill_size` fronts are held in memory, and loaded back at the end.
+    """
+    needs_data = False
+    dtype = np.dtype([('times', np.float64), ('channels', np.int8), ('polarities', np.int8)])
+
+    def __init__(self, spill_size=None, file_spill=None):
+        """
+        :param spill_size: (None) maximum number of fronts held in memory, None never writes to disk
+        :param file_spill: temporary file, defaults to a new file in the system temporary directory
+        """
+        self.spill_size = spill_size
+        self.file_spill = Path(file_spill) if file_spill else None
+
+    def setup(self, sr):
+        super().setup(sr)
+        self.last_sync = None
+        self.fronts = np.zeros(SYNC_FRONTS_BUFFER_SIZE, dtype=self.dtype)
+        self.nfronts = 0
+        self.fid_spill = None
+
+    def _append(self, times, channels, polarities):
+        n = times.size
+        if self.nfronts + n > self.fronts.size:
+            # grow the buffer geometrically to keep the amortized cost of the appends constant
+            fronts = np.zeros(max(self.fronts.size * 2, self.nfronts + n), dtype=self.dtype)
+            fronts[:self.nfronts] = self.fronts[:self.nfronts]
+            self.fronts = fronts
+        self.fronts['times'][self.nfronts:self.nfronts + n] = times
+        self.fronts['channels'][self.nfronts:self.nfronts + n] = channels
+        self.fronts['polarities'][self.nfronts:self.nfronts + n] = polarities
+        self.nfronts += n
+        if self.spill_size is not None and self.nfronts > self.spill_size:
+            if self.fid_spill is None and self.file_spill is None:
+                self.fid_spill = tempfile.NamedTemporaryFile(
+                    prefix='fronts_times_channel_polarity', suffix='.bin', delete=False)
+            elif self.fid_spill is None:
+                self.fid_spill = open(self.file_spill, 'wb')
+            self.fronts[:self.nfronts].tofile(self.fid_spill)
+            self.nfronts = 0
+
+    def process(self, first, data, sync):
+        # prepend the last sample of the previous batch to detect the fronts across batches
+        if self.last_sync is not None:
+            sync = np.concatenate((self.last_sync, sync), axis=0)
+            first -= 1
+        ind, fronts = neurodsp.utils.fronts(sync, axis=0)
+        self._append((ind[0, :] + first) / self.fs, ind[1, :], fronts)
+        self.last_sync = sync[-1:, :]
+
+    def finalize(self):
+        fronts = self.fronts[:self.nfronts]
+        if self.fid_spill is not None:
+            # close temp file, read from it and delete
+            self.fid_spill.close()
+            try:
+                fronts = np.r_[np.fromfile(self.fid_spill.name, dtype=self.dtype), fronts]
+            finally:
+                Path(self.fid_spill.name).unlink(missing_ok=True)
+        return Bunch({k: np.copy(fronts[k]) for k in self.dtype.names})
+
+
+def _sync_to_alf(raw_ephys_apfile, output_path=None, save=False, parts='', consumers=None, spill_size=None):
     """
     Extracts sync.times, sync.channels and sync.polarities from binary ephys dataset
 
@@ -103,6 +171,10 @@ def _sync_to_alf(raw_ephys_apfile, output_path=None, save=False, parts=''):
     :param output_path: output directory
     :param save: bool write to disk only if True
     :param parts: string or list of strings that will be appended to the filename before extension
+    :param consumers: list of additional ibllib.ephys.raw_pass.RawPassConsumer computed in the same
+     pass over the raw data, their products are available via their finalize method output
+    :param spill_size: (None) maximum number of fronts held in memory before they are swapped to a
+     temporary file in the output directory. By default the fronts are kept in memory.
     :return:
     """
     # handles input argument: support ibllib.io.spikeglx.Reader, str and pathlib.Path
@@ -111,34 +183,14 @@ def _sync_to_alf(raw_ephys_apfile, output_path=None, save=False, parts=''):
     else:
         raw_ephys_apfile = Path(raw_ephys_apfile)
         sr = spikeglx.Reader(raw_ephys_apfile)
-    opened = sr.is_open
-    if not opened:  # if not (opened := sr.is_open)  # py3.8
-        sr.open()
-    # if no output, need a temp folder to swap for big files
+    # if no output, the temp swap file goes in the raw data folder
     if not output_path:
-        output_path = raw_ephys_apfile.parent
-    file_ftcp = Path(output_path).joinpath(f'fronts_times_channel_polarity{str(uuid.uuid4())}.bin')
-
-    # loop over chunks of the raw ephys file
-    wg = neurodsp.utils.WindowGenerator(sr.ns, int(SYNC_BATCH_SIZE_SECS * sr.fs), overlap=1)
-    fid_ftcp = open(file_ftcp, 'wb')
-    for sl in wg.slice:
-        ss = sr.read_sync(sl)
-        ind, fronts = neurodsp.utils.fronts(ss, axis=0)
-        # a = sr.read_sync_analog(sl)
-        sav = np.c_[(ind[0, :] + sl.start) / sr.fs, ind[1, :], fronts.astype(np.double)]
-        sav.tofile(fid_ftcp)
-    # close temp file, read from it and delete
-    fid_ftcp.close()
-    tim_chan_pol = np.fromfile(str(file_ftcp))
-    tim_chan_pol = tim_chan_pol.reshape((int(tim_chan_pol.size / 3), 3))
-    file_ftcp.unlink()
-    sync = {'times': tim_chan_pol[:, 0],
-            'channels': tim_chan_pol[:, 1],
-            'polarities': tim_chan_pol[:, 2]}
-    # If opened Reader was passed into function, leave open
-    if not opened:
-        sr.close()
+        output_path = sr.file_bin.parent
+    file_spill = Path(output_path).joinpath(f'fronts_times_channel_polarity{str(uuid.uuid4())}.bin')
+    # loop over batches of the raw ephys file, the reader is left open if it was passed open
+    products = raw_pass(sr, [SyncFronts(spill_size=spill_size, file_spill=file_spill)] + list(consumers or []),
+                        batch_secs=SYNC_BATCH_SIZE_SECS if not consumers else RAW_PASS_BATCH_SECS)
+    sync = products[0]
     if save:
         out_files = alfio.save_object_npy(output_path, sync, 'sync',
                                           namespace='spikeglx', parts=parts)
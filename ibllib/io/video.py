@@ -1,4 +1,6 @@
 """Functions for fetching video frames, meta data and file locations"""
+from concurrent.futures import ThreadPoolExecutor
+import os
 import sys
 import re
 from datetime import timedelta
@@ -12,6 +14,9 @@ from one.api import ONE
 from one import params
 
 VIDEO_LABELS = ('left', 'right', 'body')
+# gaps of up to this number of frames are decoded through rather than seeked over, as setting the
+# position decodes from the previous key frame
+MAX_GRAB_GAP = 30
 
 
 class VideoStreamer:
@@ -60,12 +65,37 @@ def get_video_frame(video_path, frame_number):
     return frame_image
 
 
+def _read_plan(frame_numbers, n_runs=1, max_gap=MAX_GRAB_GAP):
+    """
+    Groups the frames to read in sequential runs, each run requires a single seek.
+    :param frame_numbers: frame indices to read, in any order and possibly repeated
+    :param n_runs: minimum number of runs, the longest runs are split so that they can be decoded
+     concurrently
+    :param max_gap: consecutive sorted frames less than max_gap apart belong to the same run
+    :return: list of sorted unique frame numbers arrays
+    """
+    frames = np.unique(np.asarray(frame_numbers, dtype=np.int64))
+    if frames.size == 0:
+        return []
+    runs = np.split(frames, np.where(np.diff(frames) > max_gap)[0] + 1)
+    # split the longest runs until there is enough work to share between the readers
+    max_len = int(np.ceil(frames.size / n_runs))
+    return [r[i:i + max_len] for r in runs for i in range(0, r.size, max_len)]
+
+
+def _open_capture(vid):
+    is_url = isinstance(vid, str) and vid.startswith('http')
+    return VideoStreamer(vid).cap if is_url else cv2.VideoCapture(str(vid))
+
+
 def get_video_frames_preload(vid, frame_numbers=None, mask=Ellipsis, as_list=False,
-                             func=lambda x: x, quiet=False):
+                             func=lambda x: x, quiet=False, n_workers=None, out=None):
     """
     Obtain numpy array corresponding to a particular video frame in video.
     Fetching and returning a list is about 33% faster but may be less memory controlled. NB: Any
     gain in speed will be lost if subsequently converted to array.
+    The frames are read in sorted sequential runs, decoding through small gaps rather than seeking,
+    and the runs are shared between n_workers threads each with their own capture.
     :param vid: URL or local path to mp4 file or cv2.VideoCapture instance.
     :param frame_numbers: video frames to be returned. If None, return all frames.
     :param mask: a logical mask or slice to apply to frames
@@ -73,6 +103,10 @@ def get_video_frames_preload(vid, frame_numbers=None, mask=Ellipsis, as_list=Fal
     memory efficient
     :param func: Function to be applied to each frame. Applied after masking if applicable.
     :param quiet: if true, suppress frame loading progress output.
+    :param n_workers: number of threads decoding the video, defaults to 4 (or the number of cpus
+     if lower). A single thread is used if vid is a cv2.VideoCapture instance.
+    :param out: optional preallocated uint8 array (for example a np.memmap) of shape (n, ...) where
+     the frames are written
     :return: numpy array corresponding to frame of interest, or list if as_list is True.
     Default dimensions are (n, w, h, 3) where n = len(frame_numbers)
 
@@ -80,35 +114,63 @@ def get_video_frames_preload(vid, frame_numbers=None, mask=Ellipsis, as_list=Fal
         frames = get_video_frames_preload(vid, range(1000), mask=np.s_[:, :, 0])
     """
     is_cap = not isinstance(vid, (str, Path))
-    if is_cap:
-        cap = vid
-    else:
-        is_url = isinstance(vid, str) and vid.startswith('http')
-        cap = VideoStreamer(vid).cap if is_url else cv2.VideoCapture(str(vid))
+    cap = vid if is_cap else _open_capture(vid)
     assert cap.isOpened(), 'Failed to open video'
 
     frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    frame_numbers = frame_numbers if frame_numbers is not None else range(frame_count)
+    frame_numbers = np.arange(frame_count) if frame_numbers is None else np.asarray(frame_numbers, dtype=np.int64)
+    n_workers = 1 if is_cap else (n_workers or min(4, os.cpu_count()))
+    runs = _read_plan(frame_numbers, n_runs=n_workers)
+    # positions in the output of each frame number, sorted by frame number
+    isort = np.argsort(frame_numbers, kind='stable')
+    ifirst = np.searchsorted(frame_numbers[isort], [r[0] for r in runs])
 
-    # Setting the index is extremely slow; determine where frame index must be set
-    # The first index is always explicitly set.
-    to_set = np.insert(np.diff(frame_numbers), 0, 0) != 1
     if as_list:
         frame_images = [None] * len(frame_numbers)
+    elif out is not None:
+        assert out.shape[0] == len(frame_numbers)
+        frame_images = out
     else:
         ret, frame = cap.read()
         frame_images = np.zeros((len(frame_numbers), *func(frame[mask or ...]).shape), np.uint8)
-    for ii, i in enumerate(frame_numbers):
-        if not quiet:
-            sys.stdout.write(f'\rloading frame {ii}/{len(frame_numbers)}')
-            sys.stdout.flush()
-        if to_set[ii]:
-            cap.set(cv2.CAP_PROP_POS_FRAMES, i)
-        ret, frame = cap.read()
-        if ret:
-            frame_images[ii] = func(frame[mask or ...])
-        else:
-            print(f'failed to read frame #{i}')
+    nread = [0]
+
+    def read_runs(iruns):
+        """Reads the frames of a list of runs through a single capture"""
+        if len(iruns) == 0:
+            return
+        _cap = cap if is_cap or n_workers == 1 else _open_capture(vid)
+        for irun in iruns:
+            run, ipos = (runs[irun], ifirst[irun])
+            _cap.set(cv2.CAP_PROP_POS_FRAMES, run[0])
+            current = run[0]
+            for i in run:
+                while current < i:  # decode through the gap without converting the frames
+                    _cap.grab()
+                    current += 1
+                ret, frame = _cap.read()
+                current += 1
+                # the same frame may be requested several times
+                while ipos < isort.size and frame_numbers[isort[ipos]] == i:
+                    if ret:
+                        frame_images[isort[ipos]] = func(frame[mask or ...])
+                    ipos += 1
+                if not ret:
+                    print(f'failed to read frame #{i}')
+            nread[0] += run.size
+            if not quiet:
+                sys.stdout.write(f'\rloading frame {nread[0]}/{len(frame_numbers)}')
+                sys.stdout.flush()
+        if _cap is not cap:
+            _cap.release()
+
+    # each reader gets contiguous runs so that it reads forward through the file
+    readers_runs = np.array_split(np.arange(len(runs)), n_workers)
+    if n_workers == 1:
+        read_runs(readers_runs[0])
+    else:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(read_runs, readers_runs))
     if not is_cap:
         cap.release()
     if not quiet:
@@ -1,8 +1,13 @@
+import copy
+import weakref
 import scipy
 import numpy as np
 import ibllib.pipes.histology as histology
 import ibllib.atlas as atlas
 TIP_SIZE_UM = 200
+NEAREST_BOUNDARY_CACHE_SIZE = 16
+# results of get_nearest_boundary per atlas, keyed on the track, the parameters and the allen tree
+NEAREST_BOUNDARY_CACHE = weakref.WeakKeyDictionary()
 
 
 def _cumulative_distance(xyz):
@@ -15,7 +20,7 @@ class EphysAlignment:
                  feature_prev=None, brain_atlas=None, speedy=False):
 
         if not brain_atlas:
-            self.brain_atlas = atlas.AllenAtlas(25)
+            self.brain_atlas = atlas.shared_atlas(25)
         else:
             self.brain_atlas = brain_atlas
 
@@ -224,7 +229,7 @@ class EphysAlignment:
         :type region_id: np.array((n_bound))
         """
         if not brain_atlas:
-            brain_atlas = atlas.AllenAtlas(25)
+            brain_atlas = atlas.shared_atlas(25)
 
         region_ids = brain_atlas.get_labels(xyz_coords, mapping=mapping)
         region_info = brain_atlas.regions.get(region_ids)
@@ -254,12 +259,13 @@ class EphysAlignment:
 
     @staticmethod
     def get_nearest_boundary(xyz_coords, allen, extent=100, steps=8, parent=True,
-                             brain_atlas=None):
+                             brain_atlas=None, cache=False):
         """
         Finds distance to closest neighbouring brain region along trajectory. For each point in
         xyz_coords computes the plane passing through point and perpendicular to trajectory and
         finds all brain regions that lie in that plane up to a given distance extent from specified
         point. Additionally, if requested, computes distance between the parents of regions.
+        The planes of all points are looked up in the atlas at once.
         :param xyz_coords: 3D coordinates of points along probe or track
         :type xyz_coords: np.array((n_points, 3)) n_points: no. of points
         :param allen: dataframe containing allen info. Loaded from allen_structure_tree in
@@ -271,11 +277,29 @@ class EphysAlignment:
         :type steps: int
         :param parent: Whether to also compute nearest distance between parents of regions
         :type parent: bool
+        :param cache: Whether to reuse the result of a previous call with the same track and
+        parameters
+        :type cache: bool
         :return nearest_bound: dict containing results
         :type nearest_bound: dict
         """
         if not brain_atlas:
-            brain_atlas = atlas.AllenAtlas(25)
+            brain_atlas = atlas.shared_atlas(25)
+
+        if cache:
+            # the results are dropped with the atlas, the allen tree is compared by content
+            atlas_cache = NEAREST_BOUNDARY_CACHE.setdefault(brain_atlas, {})
+            key = (xyz_coords.tobytes(), xyz_coords.shape, extent, steps, parent,
+                   allen['id'].to_numpy().tobytes(),
+                   allen['parent_structure_id'].to_numpy(dtype=float).tobytes(),
+                   tuple(allen['color_hex_triplet']))
+            if key not in atlas_cache:
+                if len(atlas_cache) >= NEAREST_BOUNDARY_CACHE_SIZE:
+                    atlas_cache.pop(next(iter(atlas_cache)))
+                atlas_cache[key] = EphysAlignment.get_nearest_boundary(
+                    xyz_coords, allen, extent=extent, steps=steps, parent=parent,
+                    brain_atlas=brain_atlas)
+            return copy.deepcopy(atlas_cache[key])
 
         vector = atlas.Insertion.from_track(xyz_coords, brain_atlas=brain_atlas).trajectory.vector
         nearest_bound = dict()
@@ -290,55 +314,57 @@ class EphysAlignment:
             # nearest_bound['parent_adj_id'] = np.zeros((xyz_coords.shape[0]))
             nearest_bound['parent_col'] = []
 
-        for iP, point in enumerate(xyz_coords):
-            d = np.dot(vector, point)
-            x_vals = np.r_[np.linspace(point[0] - extent / 1e6, point[0] + extent / 1e6, steps),
-                           point[0]]
-            y_vals = np.r_[np.linspace(point[1] - extent / 1e6, point[1] + extent / 1e6, steps),
-                           point[1]]
-
-            X, Y = np.meshgrid(x_vals, y_vals)
-            Z = (d - vector[0] * X - vector[1] * Y) / vector[2]
-            XYZ = np.c_[np.reshape(X, X.size), np.reshape(Y, Y.size), np.reshape(Z, Z.size)]
-            dist = np.sqrt(np.sum((XYZ - point) ** 2, axis=1))
-
+        # planes of all points (n_points, steps + 1, steps + 1), the last row and column go
+        # through the point
+        d = np.dot(xyz_coords, vector)
+        x_vals = np.c_[np.linspace(xyz_coords[:, 0] - extent / 1e6, xyz_coords[:, 0] + extent / 1e6,
+                                   steps, axis=1), xyz_coords[:, 0]]
+        y_vals = np.c_[np.linspace(xyz_coords[:, 1] - extent / 1e6, xyz_coords[:, 1] + extent / 1e6,
+                                   steps, axis=1), xyz_coords[:, 1]]
+        X = np.broadcast_to(x_vals[:, np.newaxis, :], (xyz_coords.shape[0], steps + 1, steps + 1))
+        Y = np.broadcast_to(y_vals[:, :, np.newaxis], (xyz_coords.shape[0], steps + 1, steps + 1))
+        Z = (d[:, np.newaxis, np.newaxis] - vector[0] * X - vector[1] * Y) / vector[2]
+        XYZ = np.stack([X, Y, Z], axis=-1).reshape(xyz_coords.shape[0], -1, 3)
+        dist = np.sqrt(np.sum((XYZ - xyz_coords[:, np.newaxis, :]) ** 2, axis=-1))
+
+        # the points whose plane goes outside of the atlas volume are skipped
+        ixyz = brain_atlas.bc.xyz2i(XYZ, mode='wrap')
+        valid = np.all((ixyz >= 0) & (ixyz < brain_atlas.bc.nxyz), axis=(1, 2))
+        for iP in np.where(~valid)[0]:
             try:
-                brain_id = brain_atlas.regions.get(brain_atlas.get_labels(XYZ))['id']
-            except Exception as err:
+                brain_atlas.bc.xyz2i(XYZ[iP])
+            except ValueError as err:
                 print(err)
-                continue
-
-            dist_sorted = np.argsort(dist)
-            brain_id_sorted = brain_id[dist_sorted]
-            nearest_bound['id'][iP] = brain_id_sorted[0]
-            nearest_bound['col'].append(allen['color_hex_triplet'][np.where(allen['id'] ==
-                                                                   brain_id_sorted[0])[0][0]])
-            bound_idx = np.where(brain_id_sorted != brain_id_sorted[0])[0]
-            if np.any(bound_idx):
-                nearest_bound['dist'][iP] = dist[dist_sorted[bound_idx[0]]] * 1e6
-                # nearest_bound['adj_id'][iP] = brain_id_sorted[bound_idx[0]]
-            else:
-                nearest_bound['dist'][iP] = np.max(dist) * 1e6
-                # nearest_bound['adj_id'][iP] = brain_id_sorted[0]
-
-            if parent:
-                # Now compute for the parents
-                brain_parent = np.array([allen['parent_structure_id'][np.where(allen['id'] == br)
-                                        [0][0]] for br in brain_id_sorted])
-                brain_parent[np.isnan(brain_parent)] = 0
-
-                nearest_bound['parent_id'][iP] = brain_parent[0]
-                nearest_bound['parent_col'].append(allen['color_hex_triplet']
-                                                   [np.where(allen['id'] ==
-                                                             brain_parent[0])[0][0]])
-
-                parent_idx = np.where(brain_parent != brain_parent[0])[0]
-                if np.any(parent_idx):
-                    nearest_bound['parent_dist'][iP] = dist[dist_sorted[parent_idx[0]]] * 1e6
-                    # nearest_bound['parent_adj_id'][iP] = brain_parent[parent_idx[0]]
-                else:
-                    nearest_bound['parent_dist'][iP] = np.max(dist) * 1e6
-                    # nearest_bound['parent_adj_id'][iP] = brain_parent[0]
+        dist = dist[valid]
+        brain_id = brain_atlas.get_labels(XYZ[valid].reshape(-1, 3)).reshape(dist.shape)
+
+        def _nearest(ids):
+            # region of the nearest point, and distance to the nearest point of another region
+            inear = np.argmin(dist, axis=1)
+            id_near = ids[np.arange(ids.shape[0]), inear]
+            other = ids != id_near[:, np.newaxis]
+            dist_bound = np.where(np.any(other, axis=1),
+                                  np.min(np.where(other, dist, np.inf), axis=1), np.max(dist, axis=1))
+            return id_near, dist_bound * 1e6
+
+        def _colours(ids):
+            uids, iuids = np.unique(ids, return_inverse=True)
+            cols = [allen['color_hex_triplet'][np.where(allen['id'] == uid)[0][0]] for uid in uids]
+            return [cols[i] for i in iuids]
+
+        nearest_bound['id'][valid], nearest_bound['dist'][valid] = _nearest(brain_id)
+        nearest_bound['col'] = _colours(nearest_bound['id'][valid])
+
+        if parent:
+            # Now compute for the parents
+            uids, iuids = np.unique(brain_id, return_inverse=True)
+            uparents = np.array([allen['parent_structure_id'][np.where(allen['id'] == br)[0][0]]
+                                 for br in uids])
+            uparents[np.isnan(uparents)] = 0
+            brain_parent = uparents[iuids].reshape(brain_id.shape)
+            nearest_bound['parent_id'][valid], nearest_bound['parent_dist'][valid] = \
+                _nearest(brain_parent)
+            nearest_bound['parent_col'] = _colours(nearest_bound['parent_id'][valid])
 
         return nearest_bound
 
@@ -1,3 +1,7 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import shared_memory
+import multiprocessing
 from pathlib import Path
 import logging
 
@@ -24,7 +28,7 @@ def load_track_csv(file_track, brain_atlas=None):
     :return: xyz
     """
 
-    brain_atlas = brain_atlas or atlas.AllenAtlas(25)
+    brain_atlas = brain_atlas or atlas.shared_atlas(25)
     # apmldv in the histology file is flipped along y direction
     file_track = Path(file_track)
     if file_track.stat().st_size == 0:
@@ -43,7 +47,7 @@ def get_picked_tracks(histology_path, glob_pattern="*_pts_transformed.csv", brai
     :param histology_path: Path object: folder path containing tracks
     :return: xyz coordinates in
     """
-    brain_atlas = brain_atlas or atlas.AllenAtlas()
+    brain_atlas = brain_atlas or atlas.shared_atlas()
     xyzs = []
     histology_path = Path(histology_path)
     if histology_path.is_file():
@@ -108,7 +112,7 @@ def plot2d_all(trajectories, tracks, brain_atlas=None):
     :param tracks:
     :return:
     """
-    brain_atlas = brain_atlas or atlas.AllenAtlas(25)
+    brain_atlas = brain_atlas or atlas.shared_atlas(25)
     plt.figure()
     axs = brain_atlas.plot_sslice(brain_atlas.bc.i2x(190), cmap=plt.get_cmap('bone'))
     plt.figure()
@@ -131,7 +135,7 @@ def plot3d_all(trajectories, tracks, brain_atlas=None):
     :return:
     """
     from mayavi import mlab
-    brain_atlas = brain_atlas or atlas.AllenAtlas()
+    brain_atlas = brain_atlas or atlas.shared_atlas()
     src = mlab.pipeline.scalar_field(brain_atlas.label)
     mlab.pipeline.iso_surface(src, contours=[0.5, ], opacity=0.3)
 
@@ -186,7 +190,7 @@ def get_brain_regions(xyz, channels_positions=None, brain_atlas=None):
     Due to the blockiness, depths may not be unique along the track so it has to be prepared
     """
 
-    brain_atlas = brain_atlas or atlas.AllenAtlas(25)
+    brain_atlas = brain_atlas or atlas.shared_atlas(25)
     if channels_positions is None:
         geometry = trace_header(version=1)
         channels_positions = np.c_[geometry['x'], geometry['y']]
@@ -229,7 +233,7 @@ def register_track(probe_id, picks=None, one=None, overwrite=False, channels=Tru
     3) Channel locations are set in the table
     """
     assert one
-    brain_atlas = brain_atlas or atlas.AllenAtlas()
+    brain_atlas = brain_atlas or atlas.shared_atlas()
     # 0) if it's an empty track, create a null trajectory and exit
     if picks is None or picks.size == 0:
         tdict = {'probe_insertion': probe_id,
@@ -288,7 +292,7 @@ def register_aligned_track(probe_id, xyz_channels, chn_coords=None, one=None, ov
     2) Channel locations are set to the trajectory
     """
     assert one
-    brain_atlas = brain_atlas or atlas.AllenAtlas(25)
+    brain_atlas = brain_atlas or atlas.shared_atlas(25)
     if chn_coords is None:
         geometry = trace_header(version=1)
         chn_coords = np.c_[geometry['x'], geometry['y']]
@@ -386,7 +390,7 @@ def register_track_files(path_tracks, one=None, overwrite=False, brain_atlas=Non
     :param one:
     :return:
     """
-    brain_atlas = brain_atlas or atlas.AllenAtlas()
+    brain_atlas = brain_atlas or atlas.shared_atlas()
     glob_pattern = "*_probe*_pts*.csv"
     path_tracks = Path(path_tracks)
 
@@ -437,7 +441,7 @@ def detect_missing_histology_tracks(path_tracks=None, one=None, subject=None, br
     :param subject: subject nickname for which to detect missing tracks
     """
 
-    brain_atlas = brain_atlas or atlas.AllenAtlas()
+    brain_atlas = brain_atlas or atlas.shared_atlas()
     if path_tracks:
         glob_pattern = "*_probe*_pts*.csv"
 
@@ -492,84 +496,152 @@ def detect_missing_histology_tracks(path_tracks=None, one=None, subject=None, br
                     continue
 
 
-def coverage(trajs, ba=None, dist_fcn=[100, 150]):
+def _coverage_insertion(traj, bc, dist_fcn):
     """
-    Computes a coverage volume from
-    :param trajs: dictionary of trajectories from Alyx rest endpoint (one.alyx.rest...)
-    :param ba: ibllib.atlas.BrainAtlas instance
-    :return: 3D np.array the same size as the volume provided in the brain atlas
+    Computes the coverage of a single insertion, only for the voxels around the active part of the shank
+    :param traj: trajectory dictionary from Alyx rest endpoint
+    :param bc: ibllib.atlas.BrainCoordinates of the atlas volume
+    :param dist_fcn: distances (um) to the shank: coverage = 1 below the first one, 0 after the second
+     one, cosine taper in between
+    :return: ixyz (n, 3) volume indices of the voxels, coverage (n, ), xyz (n, 3) voxels coordinates.
+     None if the insertion is skipped
     """
     # in um. Coverage = 1 below the first value, 0 after the second, cosine taper in between
     ACTIVE_LENGTH_UM = 3.5 * 1e3
     MAX_DIST_UM = dist_fcn[1]  # max distance around the probe to be searched for
-    if ba is None:
-        ba = atlas.AllenAtlas()
 
     def crawl_up_from_tip(ins, d):
         return (ins.entry - ins.tip) * (d[:, np.newaxis] /
                                         np.linalg.norm(ins.entry - ins.tip)) + ins.tip
 
-    full_coverage = np.zeros(ba.image.shape, dtype=np.float32).flatten()
-
-    for p in np.arange(len(trajs)):
-        if len(trajs) > 20:
-            if p % 20 == 0:
-                print(p / len(trajs))
-        traj = trajs[p]
-
-        ins = atlas.Insertion.from_dict(traj)
-        # those are the top and bottom coordinates of the active part of the shank extended
-        # to maxdist
-        d = (np.array([ACTIVE_LENGTH_UM + MAX_DIST_UM * np.sqrt(2),
-                       -MAX_DIST_UM * np.sqrt(2)]) + TIP_SIZE_UM)
-        top_bottom = crawl_up_from_tip(ins, d / 1e6)
-        # this is the axis that has the biggest deviation. Almost always z
-        axis = np.argmax(np.abs(np.diff(top_bottom, axis=0)))
-        if axis != 2:
-            _logger.warning(f"This works only for 45 degree or vertical tracks so far, skipping"
-                            f" {ins}")
+    ins = atlas.Insertion.from_dict(traj)
+    # those are the top and bottom coordinates of the active part of the shank extended
+    # to maxdist
+    d = (np.array([ACTIVE_LENGTH_UM + MAX_DIST_UM * np.sqrt(2),
+                   -MAX_DIST_UM * np.sqrt(2)]) + TIP_SIZE_UM)
+    top_bottom = crawl_up_from_tip(ins, d / 1e6)
+    # this is the axis that has the biggest deviation. Almost always z
+    axis = np.argmax(np.abs(np.diff(top_bottom, axis=0)))
+    if axis != 2:
+        _logger.warning(f"This works only for 45 degree or vertical tracks so far, skipping"
+                        f" {ins}")
+        return
+    # sample the active track path along this axis
+    tbi = bc.xyz2i(top_bottom)
+    nz = tbi[1, axis] - tbi[0, axis] + 1
+    ishank = np.round(np.array(
+        [np.linspace(tbi[0, i], tbi[1, i], nz) for i in np.arange(3)]).T).astype(np.int32)
+
+    # creates a "column" of candidate volume indices around the track
+    # around each sample get an horizontal square slice of nx *2 +1 and ny *2 +1 samples
+    # and compute the min distance to the track only for those
+    nx = int(np.floor(MAX_DIST_UM / 1e6 / np.abs(bc.dxyz[0]) * np.sqrt(2) / 2)) * 2 + 1
+    ny = int(np.floor(MAX_DIST_UM / 1e6 / np.abs(bc.dxyz[1]) * np.sqrt(2) / 2)) * 2 + 1
+    shape = (ny * 2 + 1, nx * 2 + 1, nz)
+    ixyz = np.c_[
+        (np.arange(-nx, nx + 1)[np.newaxis, :, np.newaxis] + ishank[:, 0]).repeat(shape[0], axis=0).flatten(),
+        (np.arange(-ny, ny + 1)[:, np.newaxis, np.newaxis] + ishank[:, 1]).repeat(shape[1], axis=1).flatten(),
+        np.broadcast_to(ishank[:, 2], shape).flatten()]
+    # if any, remove indices that lie outside of the volume bounds
+    ixyz = ixyz[np.all((ixyz >= 0) & (ixyz < bc.nxyz), axis=1), :]
+    # get the minimum distance to the active segment of the shank, to which is applied the cosine taper
+    xyz = np.c_[bc.xscale[ixyz[:, 0]], bc.yscale[ixyz[:, 1]], bc.zscale[ixyz[:, 2]]]
+    sites_bounds = crawl_up_from_tip(
+        ins, (np.array([ACTIVE_LENGTH_UM, 0]) + TIP_SIZE_UM) / 1e6)
+    segment = sites_bounds[1] - sites_bounds[0]
+    t = np.clip(np.dot(xyz - sites_bounds[0], segment) / np.dot(segment, segment), 0, 1)
+    mdist = np.sqrt(np.sum((xyz - sites_bounds[0] - t[:, np.newaxis] * segment) ** 2, axis=1))
+    coverage = 1 - fcn_cosine(np.array(dist_fcn) / 1e6)(mdist)
+    return ixyz, coverage, xyz
+
+
+def _coverage_worker_init(shm_name, shape, lock):
+    """Attaches the worker process to the shared coverage volume"""
+    global _COVERAGE_SHM, _COVERAGE_VOLUME, _COVERAGE_LOCK
+    _COVERAGE_SHM = shared_memory.SharedMemory(name=shm_name)
+    _COVERAGE_VOLUME = np.ndarray(shape, dtype=np.float32, buffer=_COVERAGE_SHM.buf)
+    _COVERAGE_LOCK = lock
+
+
+def _coverage_trajectories(trajs, bc, xyz2dims, dist_fcn, full_coverage=None):
+    """
+    Accumulates the coverage of a list of trajectories into the flat coverage volume
+    :param trajs: list of trajectories dictionaries
+    :param bc: ibllib.atlas.BrainCoordinates of the atlas volume
+    :param xyz2dims: ordering of the volume axes
+    :param dist_fcn: see coverage
+    :param full_coverage: flat float32 coverage volume. Defaults to the shared volume of the pool worker, in
+     which case the additions are done under the lock
+    :return: voxel coordinates mean and flat indices of the last insertion, None if none was computed
+    """
+    last = None
+    for traj in trajs:
+        out = _coverage_insertion(traj, bc, dist_fcn)
+        if out is None:
             continue
-        # sample the active track path along this axis
-        tbi = ba.bc.xyz2i(top_bottom)
-        nz = tbi[1, axis] - tbi[0, axis] + 1
-        ishank = np.round(np.array(
-            [np.linspace(tbi[0, i], tbi[1, i], nz) for i in np.arange(3)]).T).astype(np.int32)
-
-        # creates a flattened "column" of candidate volume indices around the track
-        # around each sample get an horizontal square slice of nx *2 +1 and ny *2 +1 samples
-        # flatten the corresponding xyz indices and  compute the min distance to the track only
-        # for those
-        nx = int(np.floor(MAX_DIST_UM / 1e6 / np.abs(ba.bc.dxyz[0]) * np.sqrt(2) / 2)) * 2 + 1
-        ny = int(np.floor(MAX_DIST_UM / 1e6 / np.abs(ba.bc.dxyz[1]) * np.sqrt(2) / 2)) * 2 + 1
-        ixyz = np.stack([v.flatten() for v in np.meshgrid(
-            np.arange(-nx, nx + 1), np.arange(-ny, ny + 1), np.arange(nz))]).T
-        ixyz[:, 0] = ishank[ixyz[:, 2], 0] + ixyz[:, 0]
-        ixyz[:, 1] = ishank[ixyz[:, 2], 1] + ixyz[:, 1]
-        ixyz[:, 2] = ishank[ixyz[:, 2], 2]
-        # if any, remove indices that lie outside of the volume bounds
-        iok = np.logical_and(0 <= ixyz[:, 0], ixyz[:, 0] < ba.bc.nx)
-        iok &= np.logical_and(0 <= ixyz[:, 1], ixyz[:, 1] < ba.bc.ny)
-        iok &= np.logical_and(0 <= ixyz[:, 2], ixyz[:, 2] < ba.bc.nz)
-        ixyz = ixyz[iok, :]
-        # get the minimum distance to the trajectory, to which is applied the cosine taper
-        xyz = np.c_[ba.bc.xscale[ixyz[:, 0]], ba.bc.yscale[ixyz[:, 1]], ba.bc.zscale[ixyz[:, 2]]]
-        sites_bounds = crawl_up_from_tip(
-            ins, (np.array([ACTIVE_LENGTH_UM, 0]) + TIP_SIZE_UM) / 1e6)
-        mdist = ins.trajectory.mindist(xyz, bounds=sites_bounds)
-        coverage = 1 - fcn_cosine(np.array(dist_fcn) / 1e6)(mdist)
-        # remap to the coverage volume
-        flat_ind = ba._lookup_inds(ixyz)
-        full_coverage[flat_ind] += coverage
+        ixyz, coverage, xyz = out
+        # remap to the coverage volume, the indices of an insertion are unique
+        flat_ind = np.ravel_multi_index(ixyz[:, xyz2dims].T, bc.nxyz[xyz2dims])
+        if full_coverage is None:
+            with _COVERAGE_LOCK:
+                _COVERAGE_VOLUME[flat_ind] += coverage
+        else:
+            full_coverage[flat_ind] += coverage
+        last = (np.mean(xyz, 0), flat_ind)
+    return last
+
+
+def coverage(trajs, ba=None, dist_fcn=[100, 150], n_workers=1):
+    """
+    Computes a coverage volume from
+    :param trajs: dictionary of trajectories from Alyx rest endpoint (one.alyx.rest...)
+    :param ba: ibllib.atlas.BrainAtlas instance
+    :param dist_fcn: distances (um) to the shank: coverage = 1 below the first one, 0 after the second
+     one, cosine taper in between
+    :param n_workers: number of processes the insertions are distributed on, accumulating into a
+     shared memory volume
+    :return: 3D np.array the same size as the volume provided in the brain atlas, voxel coordinates mean
+     and flat indices of the last insertion (None if no insertion was computed)
+    """
+    if ba is None:
+        ba = atlas.shared_atlas()
+    xyz2dims = np.array(ba.xyz2dims)
+    nvox = int(np.prod(ba.image.shape))
+    if n_workers > 1 and len(trajs) > 1:
+        shm = shared_memory.SharedMemory(create=True, size=nvox * np.dtype(np.float32).itemsize)
+        try:
+            full_coverage = np.ndarray(nvox, dtype=np.float32, buffer=shm.buf)
+            full_coverage[:] = 0
+            chunks = np.array_split(np.arange(len(trajs)), min(len(trajs), n_workers * 4))
+            with ProcessPoolExecutor(n_workers, initializer=_coverage_worker_init,
+                                     initargs=(shm.name, nvox, multiprocessing.Lock())) as executor:
+                lasts = list(executor.map(_coverage_trajectories, [[trajs[i] for i in c] for c in chunks],
+                                          repeat(ba.bc), repeat(xyz2dims), repeat(dist_fcn)))
+            full_coverage = full_coverage.copy()
+        finally:
+            shm.close()
+            shm.unlink()
+        last = next((last for last in lasts[::-1] if last is not None), None)
+    else:
+        full_coverage = np.zeros(nvox, dtype=np.float32)
+        last = None
+        for p in range(0, len(trajs), 20):
+            if len(trajs) > 20:
+                _logger.info(f"Coverage: {p / len(trajs):.0%}")
+            last = _coverage_trajectories(trajs[p:p + 20], ba.bc, xyz2dims, dist_fcn,
+                                          full_coverage=full_coverage) or last
 
     full_coverage = full_coverage.reshape(ba.image.shape)
     full_coverage[ba.label == 0] = np.nan
-    return full_coverage, np.mean(xyz, 0), flat_ind
+    if last is None:  # no insertion was computed
+        return full_coverage, None, None
+    return (full_coverage, *last)
 
 
 def coverage_grid(xyz_channels, spacing=500, ba=None):
 
     if ba is None:
-        ba = atlas.AllenAtlas()
+        ba = atlas.shared_atlas()
 
     def _get_scale_and_indices(v, bin, lim):
         _lim = [np.min(lim), np.max(lim)]
@@ -12,6 +12,8 @@ from one.api import ONE
 
 from ibllib.io.extractors.base import get_pipeline, get_task_protocol, get_session_extractor_type
 from ibllib.pipes import tasks, training_preprocessing, ephys_preprocessing
+from ibllib.pipes.misc import get_session_paths, session_paths_cache_file, session_rel_path, update_session_paths_cache
+from ibllib.pipes.scheduler import TaskScheduler
 from ibllib.time import date2isostr
 import ibllib.oneibl.registration as registration
 
@@ -109,10 +111,13 @@ def job_creator(root_path, one=None, dry=False, rerun=False, max_md5_size=None):
             # if the subject doesn't exist in the database, skip
             ses = rc.create_session(session_path)
             eid = ses['url'][-36:]
-            if one.path2eid(session_path, query_type='remote') is None:
+            # the session record gives the ALF path without querying Alyx again
+            if Path(*session_path.parts[-3:]) != session_rel_path(ses):
                 raise ValueError(f'Session ALF path mismatch: {ses["url"][-36:]} \n '
-                                 f'{one.eid2path(eid, query_type="remote")} in params \n'
+                                 f'{session_rel_path(ses)} in params \n'
                                  f'{session_path} on disk \n')
+            # the tasks runner finds the session path of the tasks created below in the cache
+            update_session_paths_cache(session_paths_cache_file(), {eid: session_rel_path(ses)})
             files, dsets = registration.register_session_raw_data(
                 session_path, one=one, max_md5_size=max_md5_size)
             if dsets is not None:
@@ -170,7 +175,7 @@ def task_queue(mode='all', lab=None, one=None):
     return sorted_tasks
 
 
-def tasks_runner(subjects_path, tasks_dict, one=None, dry=False, count=5, time_out=None, **kwargs):
+def tasks_runner(subjects_path, tasks_dict, one=None, dry=False, count=5, time_out=None, n_workers=1, **kwargs):
     """
     Function to run a list of tasks (task dictionary from Alyx query) on a local server
     :param subjects_path:
@@ -179,26 +184,29 @@ def tasks_runner(subjects_path, tasks_dict, one=None, dry=False, count=5, time_o
     :param dry:
     :param count: maximum number of tasks to run
     :param time_out: between each task, if time elapsed is greater than time out, returns (seconds)
+    :param n_workers: if > 1, runs the tasks concurrently in separate processes within the machine
+     resources, see ibllib.pipes.scheduler.TaskScheduler
     :param kwargs:
     :return: list of dataset dictionaries
     """
     if one is None:
         one = ONE(cache_rest=None)
+    # resolve the local session paths of the whole batch at once
+    session_paths = get_session_paths(subjects_path, (tdict['session'] for tdict in tasks_dict), one,
+                                      cache_file=session_paths_cache_file())
+    tasks_dict = [tdict for tdict in tasks_dict if tdict['session'] in session_paths]
+    if n_workers > 1 and not dry:
+        results = TaskScheduler(one=one, max_workers=n_workers).run(
+            tasks_dict, session_paths, count=count, time_out=time_out, **kwargs)
+        return [d for _, dsets in results if dsets for d in dsets]
     tstart = time.time()
     c = 0
-    last_session = None
     all_datasets = []
     for tdict in tasks_dict:
         # if the count is reached or if the time_out has been elapsed, break the loop and return
         if c >= count or (time_out and time.time() - tstart > time_out):
             break
-        # reconstruct the session local path. As many jobs belong to the same session
-        # cache the result
-        if last_session != tdict['session']:
-            ses = one.alyx.rest('sessions', 'list', django=f"pk,{tdict['session']}")[0]
-            session_path = Path(subjects_path).joinpath(
-                Path(ses['subject'], ses['start_time'][:10], str(ses['number']).zfill(3)))
-            last_session = tdict['session']
+        session_path = session_paths[tdict['session']]
         if dry:
             print(session_path, tdict['name'])
         else:
@@ -1,6 +1,8 @@
 import json
 import logging
+import os
 import shutil
+import time
 import hashlib
 from pathlib import Path
 import re
@@ -18,6 +20,8 @@ import ibllib.io.raw_data_loaders as raw
 from ibllib.io.misc import delete_empty_folders
 
 log = logging.getLogger("ibllib")
+SESSION_PATHS_TTL = 3600 * 24 * 7  # the relative path of a session is not expected to change
+SESSION_PATHS_QUERY_SIZE = 100  # number of sessions queried at once, keeps the urls short
 
 
 def subjects_data_folder(folder: Path, rglob: bool = False) -> Path:
@@ -641,3 +645,70 @@ def multi_parts_flags_creation(root_paths: Union[list, str, Path]) -> List[Path]
                                files=list(map(str, recordings[k]))), fid)
             log.info(f"{k}: {i}/{nrecs} written sequence file {recordings}")
     return recordings
+
+
+def session_rel_path(ses):
+    """Relative session path subject/yyyy-mm-dd/NNN from an Alyx session record"""
+    return Path(ses['subject'], ses['start_time'][:10], str(ses['number']).zfill(3))
+
+
+def session_paths_cache_file():
+    """the cache of the sessions relative paths is in ~/.one/session_paths.json"""
+    folder = Path.home().joinpath('.one')
+    folder.mkdir(exist_ok=True)
+    return folder.joinpath('session_paths.json')
+
+
+def _read_session_paths_cache(cache_file):
+    try:
+        with open(cache_file) as fid:
+            return json.load(fid)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_session_paths_cache(cache_file, rel_paths):
+    """
+    Adds relative session paths to the cache file
+    :param cache_file: json file, None to skip
+    :param rel_paths: dictionary {eid: relative session path}
+    """
+    if cache_file is None or len(rel_paths) == 0:
+        return
+    cache = _read_session_paths_cache(cache_file)
+    now = time.time()
+    cache.update({eid: {'rel_path': Path(rel_path).as_posix(), 'time': now} for eid, rel_path in rel_paths.items()})
+    # write to a temporary file first so that concurrent readers never see a partial file
+    file_tmp = Path(cache_file).with_suffix(f'.{os.getpid()}.part')
+    with open(file_tmp, 'w+') as fid:
+        json.dump(cache, fid)
+    file_tmp.replace(cache_file)
+
+
+def get_session_paths(subjects_path, eids, one, cache_file=None, ttl=SESSION_PATHS_TTL):
+    """
+    Resolves the local paths of a batch of sessions. The sessions missing from the cache are queried
+    on Alyx in one request per SESSION_PATHS_QUERY_SIZE sessions
+    :param subjects_path: local folder containing the subjects folders
+    :param eids: iterable of session eids
+    :param one: ONE instance, only one.alyx.rest is used
+    :param cache_file: json file caching the relative session paths, None to disable the cache
+    :param ttl: time after which a cached path is queried again (secs)
+    :return: dictionary {eid: session path}
+    """
+    eids = list(dict.fromkeys(str(eid) for eid in eids))
+    cache = _read_session_paths_cache(cache_file) if cache_file else {}
+    now = time.time()
+    rel_paths = {eid: cache[eid]['rel_path'] for eid in eids if eid in cache and now - cache[eid]['time'] < ttl}
+    missing = [eid for eid in eids if eid not in rel_paths]
+    queried = {}
+    for i in range(0, len(missing), SESSION_PATHS_QUERY_SIZE):
+        chunk = missing[i:i + SESSION_PATHS_QUERY_SIZE]
+        for ses in one.alyx.rest('sessions', 'list', django=f"pk__in,{chunk}"):
+            queried[ses.get('id') or ses['url'][-36:]] = session_rel_path(ses)
+    update_session_paths_cache(cache_file, queried)
+    rel_paths.update(queried)
+    notfound = [eid for eid in eids if eid not in rel_paths]
+    if notfound:
+        log.warning(f"Sessions not found on Alyx: {notfound}")
+    return {eid: Path(subjects_path).joinpath(rel_paths[eid]) for eid in eids if eid in rel_paths}
@@ -0,0 +1,171 @@
+"""
+Concurrent execution of Alyx tasks on a local server.
+
+Each task runs in its own process through `ibllib.pipes.tasks.run_alyx_task`, which updates the task
+status and registers the datasets on Alyx. The scheduler starts a task once its parents within the
+batch are done and if the resources it declares (cpu, gpu, io_charge, ram) fit in the machine budget, so that
+light tasks (video compression, trials extraction, QC) run alongside long ones such as spike sorting.
+
+>>> scheduler = TaskScheduler(one=one, resources={'cpu': 32, 'gpu': 1, 'io_charge': 100, 'ram': 128})
+>>> results = scheduler.run(tasks_dicts, session_paths={eid: session_path})
+"""
+import logging
+import multiprocessing
+import queue
+import time
+import traceback
+
+from ibllib.pipes import tasks
+
+_logger = logging.getLogger('ibllib')
+
+MACHINE_RESOURCES = tasks.MACHINE_RESOURCES
+POLL_SECS = 1
+
+
+def _run_alyx_task_process(results, tdict, session_path, one, kwargs):
+    """Process target: runs one Alyx task and puts (task id, task dict, datasets) in the results queue"""
+    dsets = None
+    try:
+        tdict, dsets = tasks.run_alyx_task(tdict=tdict, session_path=session_path, one=one, **kwargs)
+    except Exception:
+        _logger.error(traceback.format_exc())
+    results.put((tdict['id'], tdict, dsets))
+
+
+class TaskScheduler:
+    """
+    Runs Alyx tasks concurrently within resources budgets:
+        - a task starts once none of its parents in the batch is waiting or running. The parents
+         statuses are then checked by run_alyx_task as for serial runs
+        - the sum of the declared cpu, gpu, io_charge and ram of the running tasks stays within the budget,
+         a task exceeding the budget on its own runs alone
+        - a task running for more than its time out is terminated and labeled as Errored
+        - the tasks with highest priority are started first
+    """
+
+    def __init__(self, one=None, resources=None, max_workers=None, poll_secs=POLL_SECS,
+                 target=_run_alyx_task_process):
+        """
+        :param one: ONE instance, passed to the task processes
+        :param resources: dictionary of machine budgets, defaults to MACHINE_RESOURCES
+        :param max_workers: maximum number of tasks running at once, defaults to the cpu budget
+        :param poll_secs: time between two checks of the running tasks
+        :param target: process target running a task, see _run_alyx_task_process
+        """
+        self.one = one
+        self.resources = {**MACHINE_RESOURCES, **(resources or {})}
+        self.max_workers = max_workers or max(1, int(self.resources['cpu']))
+        self.poll_secs = poll_secs
+        self.target = target
+
+    def requirements(self, tdict):
+        """Resources declared by a task dictionary, defaulting to the Task class attributes"""
+        return {k: tdict.get(k) if tdict.get(k) is not None else getattr(tasks.Task, k, 0)
+                for k in self.resources}
+
+    def fits(self, tdict, running):
+        """Whether a task fits in the budget left by the running tasks"""
+        if len(running) == 0:
+            return True
+        if len(running) >= self.max_workers:
+            return False
+        req = self.requirements(tdict)
+        for k in self.resources:
+            used = sum(self.requirements(r['tdict'])[k] for r in running.values())
+            if used + req[k] > self.resources[k]:
+                return False
+        return True
+
+    def run(self, tdicts, session_paths, count=None, time_out=None, **kwargs):
+        """
+        Runs the tasks
+        :param tdicts: list of task dictionaries from Alyx
+        :param session_paths: dictionary of session paths, keys are the sessions eids
+        :param count: stops starting new tasks once this number of tasks registered datasets
+        :param time_out: stops starting new tasks after this time (secs)
+        :param kwargs: passed to run_alyx_task (machine, clobber, location, max_md5_size, admission_wait_secs)
+        :return: list of (task dictionary, registered datasets) for each task run, in the input order
+        """
+        tstart = time.time()
+        results_queue = multiprocessing.Queue()
+        # stable sort by decreasing priority
+        pending = sorted(tdicts, key=lambda t: -(t.get('priority') or 0))
+        running, results, nregistered = ({}, {}, 0)
+        while pending or running:
+            # collect the finished tasks, a process exits only once its result is in the queue
+            exited = [tid for tid, r in running.items() if not r['process'].is_alive()]
+            for tid, tdict, dsets in self._drain(results_queue):
+                if tid not in running:  # already labeled as timed out
+                    continue
+                running.pop(tid)['process'].join()
+                results[tid] = (tdict, dsets)
+                nregistered += int(bool(dsets))
+            for tid in [tid for tid in exited if tid in running]:
+                r = running.pop(tid)
+                results[tid] = (self._errored(r['tdict'], f"exited with code {r['process'].exitcode}"), None)
+            for tid, r in list(running.items()):
+                t_out = r['tdict'].get('time_out_sec') or tasks.Task.time_out_secs
+                if time.time() - r['start'] > t_out:
+                    r['process'].terminate()
+                    r['process'].join()
+                    results[tid] = (self._errored(r['tdict'], f"timed out after {t_out} secs"), None)
+                    running.pop(tid)
+            # stop starting new tasks if the count or the time out is reached
+            if pending and ((count and nregistered >= count) or (time_out and time.time() - tstart > time_out)):
+                _logger.info(f"Scheduler stops, {len(pending)} tasks not started")
+                pending = []
+            # start the tasks that are ready and fit in the resources left
+            waiting_ids = set(t['id'] for t in pending) | set(running.keys())
+            for tdict in list(pending):
+                if any(p in waiting_ids for p in tdict.get('parents', [])) or not self.fits(tdict, running):
+                    continue
+                process = multiprocessing.Process(
+                    target=self.target, args=(results_queue, tdict, session_paths[tdict['session']], self.one, kwargs))
+                process.start()
+                _logger.info(f"Started {tdict['name']} ({session_paths[tdict['session']]}), {len(running) + 1} running")
+                running[tdict['id']] = {'process': process, 'tdict': tdict, 'start': time.time()}
+                pending.remove(tdict)
+            if running:
+                time.sleep(self.poll_secs)
+        results = [results[t['id']] for t in tdicts if t['id'] in results]
+        self.report(results)
+        return results
+
+    @staticmethod
+    def _drain(results_queue):
+        """Gets all the results available in the queue"""
+        out = []
+        while True:
+            try:
+                out.append(results_queue.get(timeout=0.1))
+            except queue.Empty:
+                return out
+
+    def _errored(self, tdict, message):
+        """Labels a task whose process did not complete as Errored on Alyx"""
+        _logger.error(f"{tdict['name']} {message}")
+        if tdict.get('gpu'):
+            tasks.Task._lock_file_path().unlink(missing_ok=True)
+        if self.one is None:
+            return {**tdict, 'status': 'Errored'}
+        return self.one.alyx.rest('tasks', 'partial_update', id=tdict['id'],
+                                  data={'status': 'Errored', 'log': f"Scheduler: {tdict['name']} {message}"})
+
+    def report(self, results):
+        """
+        Logs a summary of the tasks statuses and, as the tasks ran in separate processes, releases the
+        Held tasks of the sessions whose parents are now all complete
+        """
+        statuses = {}
+        for tdict, _ in results:
+            statuses[tdict['status']] = statuses.get(tdict['status'], 0) + 1
+        _logger.info(f"Scheduler ran {len(results)} tasks: {statuses}")
+        if self.one is None:
+            return
+        for eid in set(tdict['session'] for tdict, _ in results):
+            job_deck = self.one.alyx.rest('tasks', 'list', session=eid, no_cache=True)
+            status = {t['id']: t['status'] for t in job_deck}
+            for t in job_deck:
+                if t['status'] == 'Held' and all(status.get(p) == 'Complete' for p in t['parents']):
+                    self.one.alyx.rest('tasks', 'partial_update', id=t['id'], data={'status': 'Waiting'})
@@ -1,14 +1,22 @@
 from pathlib import Path
 import abc
+import cProfile
+from contextlib import contextmanager
+from datetime import datetime
 import logging
 import io
 import importlib
+import os
+import pstats
+import sys
 import time
+import tracemalloc
 from _collections import OrderedDict
 import traceback
 import json
 
 from graphviz import Digraph
+import pandas as pd
 
 import ibllib
 from ibllib.oneibl import data_handlers
@@ -17,6 +25,41 @@ from one.api import ONE
 
 _logger = logging.getLogger('ibllib')
 
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+
+def _total_ram():
+    """Total physical memory of the machine (Go)"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+    except (AttributeError, ValueError, OSError):
+        return float('inf')
+
+
+# budgets of the machine shared by the tasks running concurrently, in the units of the Task attributes
+MACHINE_RESOURCES = {'cpu': os.cpu_count(), 'gpu': 1, 'io_charge': 100, 'ram': _total_ram()}
+ADMISSION_POLL_SECS = 10
+# the task metrics are written in this folder of the session, see Task.write_metrics and load_task_metrics
+METRICS_FOLDER = 'logs'
+PROFILE_NFUNCTIONS = 30
+
+
+def _io_counters():
+    """Bytes read and written by the process, on Linux only"""
+    try:
+        with open('/proc/self/io') as fid:
+            counters = dict(line.split(': ') for line in fid.read().splitlines())
+    except (OSError, ValueError):
+        return {}
+    return {k: int(counters[k]) for k in ('rchar', 'wchar', 'read_bytes', 'write_bytes') if k in counters}
+
 
 class Task(abc.ABC):
     log = ""  # place holder to keep the log of the task for registratoin
@@ -33,6 +76,10 @@ class Task(abc.ABC):
     version = ibllib.__version__
     signature = {'input_files': [], 'output_files': []}  # list of tuples (filename, collection, required_flag)
     force = False  # whether or not to re-download missing input files on local server if not present
+    admission_wait_secs = None  # if set, claims the machine resources before running, waiting up to this time (status -2)
+    usage = None  # place holder for the measured resources of the run: cpu seconds and peak rss (Go)
+    profile = False  # if True, profiles _run with cProfile and tracemalloc, see write_metrics
+    metrics = None  # place holder for the stages timings, bytes read and written and profile of the run
 
     def __init__(self, session_path, parents=None, taskid=None, one=None,
                  machine=None, clobber=True, location='server'):
@@ -103,8 +150,12 @@ class Task(abc.ABC):
         _logger.info(f"running ibllib version {ibllib.__version__}")
         # setup
         start_time = time.time()
+        usage_start = None
+        self.metrics = {'start_time': datetime.now().isoformat(), 'stages': {}}
+        self._profiler = None
         try:
-            setup = self.setUp(**kwargs)
+            with self._stage('setUp'):
+                setup = self.setUp(**kwargs)
             _logger.info(f"Setup value is: {setup}")
             self.status = 0
             if not setup:
@@ -113,21 +164,29 @@ class Task(abc.ABC):
                 _, self.outputs = self.assert_expected_outputs()
             else:
                 # run task
-                if self.gpu >= 1:
-                    if not self._creates_lock():
-                        self.status = -2
-                        _logger.info(f"Job {self.__class__} exited as a lock was found")
-                        new_log = log_capture_string.getvalue()
-                        self.log = new_log if self.clobber else self.log + new_log
-                        log_capture_string.close()
-                        _logger.removeHandler(ch)
-                        return self.status
-                self.outputs = self._run(**kwargs)
+                if self.admission_wait_secs is not None and not self._claims_resources():
+                    self.status = -2
+                    _logger.info(f"Job {self.__class__} exited as the machine resources are used by other tasks")
+                elif self.gpu >= 1 and not self._creates_lock():
+                    self._release_resources()
+                    self.status = -2
+                    _logger.info(f"Job {self.__class__} exited as a lock was found")
+                if self.status == -2:
+                    new_log = log_capture_string.getvalue()
+                    self.log = new_log if self.clobber else self.log + new_log
+                    log_capture_string.close()
+                    _logger.removeHandler(ch)
+                    return self.status
+                usage_start = self._measure_usage(reset=True)
+                with self._stage('_run'), self._profiling():
+                    self.outputs = self._run(**kwargs)
                 _logger.info(f"Job {self.__class__} complete")
         except Exception:
             _logger.error(traceback.format_exc())
             _logger.info(f"Job {self.__class__} errored")
             self.status = -1
+        finally:
+            self._release_resources()
 
         self.time_elapsed_secs = time.time() - start_time
         # log the outputs
@@ -140,6 +199,13 @@ class Task(abc.ABC):
 
         _logger.info(f"N outputs: {nout}")
         _logger.info(f"--- {self.time_elapsed_secs} seconds run-time ---")
+        if usage_start is not None:
+            usage = self._measure_usage()
+            self.usage = {'cpu_secs': usage['cpu_secs'] - usage_start['cpu_secs'],
+                          'peak_rss': usage['peak_rss'], 'children_peak_rss': usage['children_peak_rss']}
+            _logger.info(f"--- {self.usage['cpu_secs']:.1f} cpu seconds, peak rss {self.usage['peak_rss']:.2f} Go,"
+                         f" children peak rss {self.usage['children_peak_rss']:.2f} Go"
+                         f" (declared cpu {self.cpu}, ram {self.ram} Go) ---")
         # after the run, capture the log output, amend to any existing logs if not overwrite
         new_log = log_capture_string.getvalue()
         self.log = new_log if self.clobber else self.log + new_log
@@ -147,9 +213,65 @@ class Task(abc.ABC):
         _logger.removeHandler(ch)
         _logger.setLevel(logger_level)
         # tear down
-        self.tearDown()
+        with self._stage('tearDown'):
+            self.tearDown()
         return self.status
 
+    @contextmanager
+    def _stage(self, name):
+        """Records the duration and the bytes read and written by the process during a stage of the task"""
+        t0, io0 = (time.time(), _io_counters())
+        try:
+            yield
+        finally:
+            io1 = _io_counters()
+            if self.metrics is None:
+                self.metrics = {'stages': {}}
+            self.metrics['stages'][name] = {'secs': time.time() - t0, **{k: io1[k] - io0[k] for k in io1}}
+
+    @contextmanager
+    def _profiling(self):
+        """If the profile attribute is set, profiles the calls with cProfile and the python allocations"""
+        if not self.profile:
+            yield
+            return
+        tracemalloc.start()
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+        try:
+            yield
+        finally:
+            self._profiler.disable()
+            self.metrics['tracemalloc_peak'] = tracemalloc.get_traced_memory()[1] / 1024 ** 3
+            tracemalloc.stop()
+            # the functions with the highest cumulative time
+            stats = sorted(pstats.Stats(self._profiler).stats.items(), key=lambda x: -x[1][3])
+            self.metrics['profile'] = [
+                {'function': f"{file}:{line}({fcn})", 'ncalls': nc, 'tottime': tt, 'cumtime': ct}
+                for (file, line, fcn), (_, nc, tt, ct, _) in stats[:PROFILE_NFUNCTIONS]]
+
+    def write_metrics(self):
+        """
+        Writes the metrics of the run as json in the session logs folder: session_path/logs/{name}.metrics.json
+        and the cProfile stats in {name}.prof if the task was profiled (for snakeviz or pstats).
+        The metrics of several sessions are loaded as a table with load_task_metrics
+        :return: path of the json file, None if the session folder does not exist
+        """
+        if self.metrics is None or not Path(self.session_path).exists():
+            return
+        folder = Path(self.session_path).joinpath(METRICS_FOLDER)
+        folder.mkdir(exist_ok=True)
+        metrics = {'name': self.name, 'session_path': str(self.session_path), 'taskid': self.taskid,
+                   'machine': self.machine, 'version': self.version, 'status': getattr(self, 'status', None),
+                   'time_elapsed_secs': self.time_elapsed_secs, 'cpu': self.cpu, 'ram': self.ram,
+                   'io_charge': self.io_charge, 'usage': self.usage, **self.metrics}
+        file_metrics = folder.joinpath(f"{self.name}.metrics.json")
+        with open(file_metrics, 'w+') as fid:
+            json.dump(metrics, fid, indent=1)
+        if getattr(self, '_profiler', None) is not None:
+            self._profiler.dump_stats(folder.joinpath(f"{self.name}.prof"))
+        return file_metrics
+
     def register_datasets(self, one=None, **kwargs):
         """
         Register output datasets form the task to Alyx
@@ -337,6 +459,127 @@ class Task(abc.ABC):
         folder.mkdir(exist_ok=True)
         return folder.joinpath('gpu.lock')
 
+    @staticmethod
+    def _claims_folder():
+        """the resources claims of the running tasks are in ~/.one/resources"""
+        folder = Path.home().joinpath('.one', 'resources')
+        folder.mkdir(parents=True, exist_ok=True)
+        return folder
+
+    @staticmethod
+    def machine_usage():
+        """
+        Sums the resources declared by the tasks currently running on the machine. The claims of
+        the processes that died or timed out are removed
+        :return: dictionary of used resources with the keys of MACHINE_RESOURCES, number of claims
+        """
+        used = {k: 0 for k in MACHINE_RESOURCES}
+        nclaims = 0
+        for file_claim in Task._claims_folder().glob('*.json'):
+            try:
+                with open(file_claim) as fid:
+                    d = json.load(fid)
+            except (OSError, ValueError):  # the claim is being written or was just released
+                continue
+            if (time.time() - d['start']) > d['time_out_secs'] or not _pid_alive(d['pid']):
+                file_claim.unlink(missing_ok=True)
+                continue
+            nclaims += 1
+            for k in used:
+                used[k] += d.get(k, 0)
+        return used, nclaims
+
+    def _claim_file_path(self):
+        return self._claims_folder().joinpath(f"{os.getpid()}_{self.name}.json")
+
+    def _claims_resources(self):
+        """
+        Admission control: claims the declared cpu, io_charge and ram of the task on the machine if
+        they fit in what is left by the other running tasks, waiting up to admission_wait_secs.
+        A task runs if no other task is running, even when its declaration exceeds the machine.
+        The gpu is handled by the lock file
+        :return: True if the resources were claimed, False otherwise
+        """
+        t0 = time.time()
+        while True:
+            # the claims are read and written under the same lock so that concurrent tasks can't both fit
+            with self._claims_lock():
+                used, nclaims = self.machine_usage()
+                if nclaims == 0 or all(used[k] + getattr(self, k) <= MACHINE_RESOURCES[k] for k in used if k != 'gpu'):
+                    d = {'pid': os.getpid(), 'name': self.name, 'start': time.time(),
+                         'time_out_secs': self.time_out_secs, **{k: getattr(self, k) for k in MACHINE_RESOURCES}}
+                    with open(self._claim_file_path(), 'w+') as fid:
+                        json.dump(d, fid)
+                    return True
+            if time.time() - t0 >= self.admission_wait_secs:
+                _logger.info(f"Resources used by {nclaims} running tasks: {used}, machine: {MACHINE_RESOURCES}")
+                return False
+            time.sleep(ADMISSION_POLL_SECS)
+
+    @staticmethod
+    @contextmanager
+    def _claims_lock(time_out_secs=60):
+        """
+        Exclusive lock on the claims folder: flock on Unix, otherwise a lock file created with O_EXCL
+        that is considered stale after time_out_secs
+        """
+        file_lock = Task._claims_folder().joinpath('claims.lock')
+        if fcntl is not None:
+            with open(file_lock, 'a') as fid:
+                fcntl.flock(fid, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(fid, fcntl.LOCK_UN)
+            return
+        t0 = time.time()
+        while True:
+            try:
+                os.close(os.open(file_lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - file_lock.stat().st_mtime > time_out_secs:
+                        file_lock.unlink(missing_ok=True)
+                except FileNotFoundError:
+                    pass
+                if time.time() - t0 > time_out_secs:
+                    raise TimeoutError(f"Could not acquire {file_lock}")
+                time.sleep(.05)
+        try:
+            yield
+        finally:
+            file_lock.unlink(missing_ok=True)
+
+    def _release_resources(self):
+        self._claim_file_path().unlink(missing_ok=True)
+
+    @staticmethod
+    def _measure_usage(reset=False):
+        """
+        Cpu seconds (user and system) of the process and its terminated children and peak resident
+        memory (Go). On Linux the peak of the process is reset so that it only covers the task
+        :param reset: if True, resets the peak resident memory of the process
+        :return: dictionary with keys 'cpu_secs', 'peak_rss', 'children_peak_rss'
+        """
+        if resource is None:
+            return {'cpu_secs': time.process_time(), 'peak_rss': float('nan'), 'children_peak_rss': float('nan')}
+        proc_status = Path('/proc/self/status')
+        if reset and proc_status.exists():
+            try:
+                Path('/proc/self/clear_refs').write_text('5')
+            except OSError:
+                pass
+        rself, rchildren = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+        # ru_maxrss is in kilobytes on linux, bytes on mac
+        scale = 1024 ** 3 if sys.platform == 'darwin' else 1024 ** 2
+        peak_rss = rself.ru_maxrss / scale
+        if proc_status.exists():
+            vmhwm = next((line for line in proc_status.read_text().split('\n') if line.startswith('VmHWM')), None)
+            peak_rss = int(vmhwm.split()[1]) / 1024 ** 2 if vmhwm else peak_rss
+        return {'cpu_secs': sum([rself.ru_utime, rself.ru_stime, rchildren.ru_utime, rchildren.ru_stime]),
+                'peak_rss': peak_rss, 'children_peak_rss': rchildren.ru_maxrss / scale}
+
     def _make_lock_file(self):
         """creates a lock file with the current time"""
         return Task.make_lock_file(self.name, self.time_out_secs)
@@ -364,6 +607,35 @@ class Task(abc.ABC):
             return True
 
 
+def load_task_metrics(root_path):
+    """
+    Loads the metrics written by the tasks runs of all the sessions under a folder
+    :param root_path: subjects folder, or any folder containing sessions
+    :return: pandas dataframe, one row per task run and session, the stages metrics are flattened
+     as columns such as 'stages._run.secs', 'stages._run.read_bytes'
+    """
+    records = []
+    for file_metrics in sorted(Path(root_path).rglob(f"{METRICS_FOLDER}/*.metrics.json")):
+        with open(file_metrics) as fid:
+            d = json.load(fid)
+        d.pop('profile', None)
+        records.append(d)
+    return pd.json_normalize(records)
+
+
+def _pid_alive(pid):
+    """Whether a process is running, on windows os.kill would terminate it so the claims only time out"""
+    if os.name == 'nt':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
 class Pipeline(abc.ABC):
     """
     Pipeline class: collection of related and potentially interdependent tasks
@@ -453,13 +725,15 @@ class Pipeline(abc.ABC):
             tasks_alyx.append(talyx)
         return tasks_alyx
 
-    def run(self, status__in=['Waiting'], machine=None, clobber=True, **kwargs):
+    def run(self, status__in=['Waiting'], machine=None, clobber=True, n_workers=1, **kwargs):
         """
         Get all the session related jobs from alyx and run them
         :param status__in: lists of status strings to run in
         ['Waiting', 'Started', 'Errored', 'Empty', 'Complete']
         :param machine: string identifying the machine the task is run on, optional
         :param clobber: bool, if True any existing logs are overwritten, default is True
+        :param n_workers: if > 1, runs the independent tasks concurrently in separate processes,
+         see ibllib.pipes.scheduler.TaskScheduler
         :param kwargs: arguments passed downstream to run_alyx_task
         :return: jalyx: list of REST dictionaries of the job endpoints
         :return: job_deck: list of REST dictionaries of the jobs endpoints
@@ -472,13 +746,22 @@ class Pipeline(abc.ABC):
         task_deck = self.one.alyx.rest('tasks', 'list', session=self.eid, no_cache=True)
         # [(t['name'], t['level']) for t in task_deck]
         all_datasets = []
+        if n_workers > 1:
+            from ibllib.pipes.scheduler import TaskScheduler
+            tdicts = [j for j in task_deck if j['status'] in status__in]
+            results = TaskScheduler(one=self.one, max_workers=n_workers).run(
+                tdicts, {self.eid: self.session_path}, machine=machine, clobber=clobber, **kwargs)
+            updated = {t['id']: t for t, _ in results}
+            task_deck = [updated.get(j['id'], j) for j in task_deck]
+            all_datasets = [d for _, dsets in results if dsets for d in dsets]
+            return task_deck, all_datasets
         for i, j in enumerate(task_deck):
             if j['status'] not in status__in:
                 continue
             # here we update the status in-place to avoid another hit to the database
             task_deck[i], dsets = run_alyx_task(tdict=j, session_path=self.session_path,
                                                 one=self.one, job_deck=task_deck,
-                                                machine=machine, clobber=clobber)
+                                                machine=machine, clobber=clobber, **kwargs)
             if dsets is not None:
                 all_datasets.extend(dsets)
         return task_deck, all_datasets
@@ -496,7 +779,8 @@ class Pipeline(abc.ABC):
 
 
 def run_alyx_task(tdict=None, session_path=None, one=None, job_deck=None,
-                  max_md5_size=None, machine=None, clobber=True, location='server'):
+                  max_md5_size=None, machine=None, clobber=True, location='server', profile=False, metrics=False,
+                  admission_wait_secs=None):
     """
     Runs a single Alyx job and registers output datasets
     :param tdict:
@@ -511,6 +795,10 @@ def run_alyx_task(tdict=None, session_path=None, one=None, job_deck=None,
     :param clobber: bool, if True any existing logs are overwritten, default is True
     :param location: where you are running the task, 'server' - local lab server, 'remote' - any
     compute node/ computer, 'SDSC' - flatiron compute node, 'AWS' - using data from aws s3
+    :param profile: bool, if True profiles the task run and writes the metrics, see Task.write_metrics
+    :param metrics: bool, if True writes the stages timings and resources usage in the session logs folder
+    :param admission_wait_secs: if set, the task claims its declared resources on the machine before running
+     and waits up to this time for other tasks to free them, otherwise it is set back to Waiting, see Task.run
     :return:
     """
     registered_dsets = []
@@ -537,6 +825,9 @@ def run_alyx_task(tdict=None, session_path=None, one=None, job_deck=None,
     classe = getattr(importlib.import_module(strmodule), strclass)
     task = classe(session_path, one=one, taskid=tdict['id'], machine=machine, clobber=clobber,
                   location=location)
+    task.profile = profile
+    if admission_wait_secs is not None:
+        task.admission_wait_secs = admission_wait_secs
     # sets the status flag to started before running
     one.alyx.rest('tasks', 'partial_update', id=tdict['id'], data={'status': 'Started'})
     status = task.run()
@@ -548,11 +839,14 @@ def run_alyx_task(tdict=None, session_path=None, one=None, job_deck=None,
     # otherwise register data and set (provisional) status to Complete
     else:
         try:
-            registered_dsets = task.register_datasets(one=one, max_md5_size=max_md5_size)
+            with task._stage('register_datasets'):
+                registered_dsets = task.register_datasets(one=one, max_md5_size=max_md5_size)
         except Exception:
             _logger.error(traceback.format_exc())
             patch_data['status'] = 'Errored'
         patch_data['status'] = 'Complete'
+    if metrics or profile:
+        task.write_metrics()
     # overwrite status to errored
     if status == -1:
         patch_data['status'] = 'Errored'
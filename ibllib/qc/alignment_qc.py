@@ -6,7 +6,7 @@ from pathlib import Path
 from neuropixel import trace_header
 import spikeglx
 
-from ibllib.atlas import AllenAtlas
+from ibllib.atlas import shared_atlas
 from ibllib.pipes import histology
 from ibllib.pipes.ephys_alignment import EphysAlignment
 from ibllib.qc import base
@@ -38,7 +38,7 @@ class AlignmentQC(base.QC):
         self.criteria = CRITERIA
 
         # Get the brain atlas
-        self.brain_atlas = brain_atlas or AllenAtlas(25)
+        self.brain_atlas = brain_atlas or shared_atlas(25)
         # Flag for uploading channels to alyx. For testing purposes
         self.channels_flag = channels
 
@@ -394,7 +394,7 @@ class AlignmentQC(base.QC):
 
 def get_aligned_channels(ins, chn_coords, one, ba=None, save_dir=None):
 
-    ba = ba or AllenAtlas(25)
+    ba = ba or shared_atlas(25)
     depths = chn_coords[:, 1]
     xyz = np.array(ins['json']['xyz_picks']) / 1e6
     traj = one.alyx.rest('trajectories', 'list', probe_insertion=ins['id'],
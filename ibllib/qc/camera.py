@@ -23,13 +23,20 @@ Example - Run specific video QC check and display the plots
 Example - Run the QC for all cameras
     qcs = run_all_qc(eid)
     qcs['left'].metrics  # Dict of checks and outcomes for left camera
+
+Example - Re-run the QC of many sessions in 8 processes, save the results then update Alyx
+    df = run_qc_batch(session_paths, n_workers=8, results_file='camera_qc.pqt', update=True)
 """
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import json
 import logging
+import time
 from inspect import getmembers, isfunction
 from pathlib import Path
 
 import cv2
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
 
@@ -39,6 +46,7 @@ from one.alf.spec import is_session_path
 from one.alf.exceptions import ALFObjectNotFound
 from iblutil.util import Bunch
 from iblutil.numerical import within_ranges
+from one.api import ONE
 
 from ibllib.io.extractors.camera import extract_camera_sync, extract_all
 from ibllib.io.extractors import ephys_fpga, training_wheel
@@ -48,8 +56,11 @@ from ibllib.io import raw_data_loaders as raw
 import brainbox.behavior.wheel as wh
 from ibllib.io.video import get_video_meta, get_video_frames_preload, assert_valid_label
 from . import base
+from . import frame_metrics
 
 _log = logging.getLogger('ibllib')
+_REFERENCE_FRAMES = {}  # reference frames loaded once per process, see CameraQC.load_reference_frames
+_WORKER_ONE = None  # ONE instance of a batch QC worker process, see run_qc_batch
 
 
 class CameraQC(base.QC):
@@ -110,12 +121,14 @@ class CameraQC(base.QC):
         the remote source.
         :param log: A logging.Logger instance, if None the 'ibllib' logger is used
         :param one: An ONE instance for fetching and setting the QC on Alyx
+        :param n_workers: The number of threads computing the image metrics of the frame samples
         """
         # When an eid is provided, we will download the required data by default (if necessary)
         download_data = not is_session_path(session_path_or_eid)
         self.download_data = kwargs.pop('download_data', download_data)
         self.stream = kwargs.pop('stream', None)
         self.n_samples = kwargs.pop('n_samples', 100)
+        self.n_workers = kwargs.pop('n_workers', 1)
         super().__init__(session_path_or_eid, **kwargs)
 
         # Data
@@ -140,6 +153,7 @@ class CameraQC(base.QC):
                 'frame_samples', 'timestamps', 'camera_times', 'bonsai_times')
         self.data = Bunch.fromkeys(keys)
         self.frame_samples_idx = None
+        self._face_locations = {}  # frames and template matching results, shared by the position and focus checks
 
         # QC outcomes map
         self.metrics = None
@@ -254,6 +268,7 @@ class CameraQC(base.QC):
             self.frame_samples_idx = indices
             self.data['frame_samples'] = get_video_frames_preload(self.video_path, indices,
                                                                   mask=np.s_[:, :, 0])
+            self._face_locations = {}
         except AssertionError:
             _log.error('Failed to read video file; setting outcome to CRITICAL')
             self._outcome = 'CRITICAL'
@@ -363,16 +378,24 @@ class CameraQC(base.QC):
         outcome = next(k for k, v in base.CRITERIA.items() if v == code)
 
         if update:
-            extended = {
-                k: None if v is None or v == 'NOT_SET'
-                else base.CRITERIA[v] < 3 if isinstance(v, str)
-                else (base.CRITERIA[v[0]] < 3, *v[1:])  # Convert first value to bool if array
-                for k, v in self.metrics.items()
-            }
-            self.update_extended_qc(extended)
-            self.update(outcome, namespace)
+            self.update_metrics(outcome)
         return outcome, self.metrics
 
+    def update_metrics(self, outcome):
+        """
+        Updates the extended QC with the metrics and the session QC with the outcome on Alyx
+        :param outcome: The video QC outcome of the camera
+        """
+        namespace = f'video{self.label.capitalize()}'
+        extended = {
+            k: None if v is None or v == 'NOT_SET'
+            else base.CRITERIA[v] < 3 if isinstance(v, str)
+            else (base.CRITERIA[v[0]] < 3, *v[1:])  # Convert first value to bool if array
+            for k, v in self.metrics.items()
+        }
+        self.update_extended_qc(extended)
+        self.update(outcome, namespace)
+
     def check_brightness(self, bounds=(40, 200), max_std=20, roi=True, display=False):
         """Check that the video brightness is within a given range
         The mean brightness of each frame must be with the bounds provided, and the standard
@@ -630,16 +653,14 @@ class CameraQC(base.QC):
         #     corr *= 100
         # hist_passed = corr > hist_thresh
         ####
-        ref_h = cv2.calcHist([refs[0]], [0], None, [256], [0, 256])
         frames = refs if test else self.data['frame_samples']
-        hists = [cv2.calcHist([x], [0], None, [256], [0, 256]) for x in frames]
-        corr = np.array([cv2.compareHist(test_h, ref_h, cv2.HISTCMP_CORREL) for test_h in hists])
+        corr = frame_metrics.hist_correlation(frames, refs[0], n_workers=self.n_workers)
         if pct_thresh:
             corr *= 100
         hist_passed = [np.all(corr > x) for x in hist_thresh]
 
         # Method 2:
-        top_left, roi, template = self.find_face(roi=roi, test=test, metric=metric, refs=refs)
+        top_left, roi, template = self.find_face(roi=roi, test=test, metric=metric)
         (y1, y2), (x1, x2) = roi
         err = (x1, y1) - np.median(np.array(top_left), axis=0)
         h, w = frames[0].shape[:2]
@@ -678,8 +699,8 @@ class CameraQC(base.QC):
             ax0.set_axis_off()
             # Plot the image histograms
             ax1 = plt.subplot(212)
-            ax1.plot(ref_h[5:-1], label='reference frame')
-            ax1.plot(np.array(hists).mean(axis=0)[5:-1], label='mean frame')
+            ax1.plot(frame_metrics.histograms(refs[:1])[0, 5:-1], label='reference frame')
+            ax1.plot(frame_metrics.histograms(frames).mean(axis=0)[5:-1], label='mean frame')
             ax1.set_xlim([0, 256])
             plt.legend()
             # Plot the correlations for each sample frame
@@ -757,7 +778,7 @@ class CameraQC(base.QC):
             for i, k in enumerate(kernal_sz):
                 img[i] = ref.copy() if k == 0 else cv2.blur(ref, (k, k))
             if equalize:
-                [cv2.equalizeHist(x, x) for x in img]
+                img = frame_metrics.equalize_hist(img, n_workers=self.n_workers)
             if display:
                 # Plot blurred images
                 f, axes = plt.subplots(1, len(kernal_sz))
@@ -769,13 +790,10 @@ class CameraQC(base.QC):
             idx = np.unique(np.linspace(0, len(self.data['frame_samples']) - 1, n, dtype=int))
             img = self.data['frame_samples'][idx]
             if equalize:
-                [cv2.equalizeHist(x, x) for x in img]
+                img = frame_metrics.equalize_hist(img, n_workers=self.n_workers)
 
         # A measure of the sharpness effectively taking the second derivative of the image
-        lpc_var = np.empty((min(n, len(img)), len(roi)))
-        for i, frame in enumerate(img[::-1]):
-            lpc = cv2.Laplacian(frame, cv2.CV_16S, ksize=1)
-            lpc_var[i] = [lpc[mask].var() for mask in roi]
+        lpc_var = frame_metrics.laplacian_variance(img[::-1], roi, n_workers=self.n_workers)
 
         if display:
             # Plot the first sample image
@@ -803,37 +821,30 @@ class CameraQC(base.QC):
             plt.legend()
 
         # Second test is to highpass with dft
-        h, w = img.shape[1:]
-        cX, cY = w // 2, h // 2
-        sz = 60  # Seems to be the magic number for high pass
-        mask = np.ones((h, w, 2), bool)
-        mask[cY - sz:cY + sz, cX - sz:cX + sz] = False
-        filt_mean = np.empty(len(img))
-        for i, frame in enumerate(img[::-1]):
-            dft = cv2.dft(np.float32(frame), flags=cv2.DFT_COMPLEX_OUTPUT)
-            f_shift = np.fft.fftshift(dft) * mask  # Shift & remove low frequencies
-            f_ishift = np.fft.ifftshift(f_shift)  # Shift back
-            filt_frame = cv2.idft(f_ishift)  # Reconstruct
+        filt_mean = frame_metrics.highpass_energy(img[::-1], n_workers=self.n_workers)
+        if display:
+            # Plot Fourier transforms of the first frame
+            h, w = img.shape[1:]
+            cX, cY = w // 2, h // 2
+            sz = frame_metrics.HIGHPASS_SIZE
+            dft_shift = np.fft.fftshift(cv2.dft(np.float32(img[0]), flags=cv2.DFT_COMPLEX_OUTPUT))
+            magnitude = 20 * np.log(cv2.magnitude(dft_shift[..., 0], dft_shift[..., 1]))
+            dft_shift[cY - sz:cY + sz, cX - sz:cX + sz] = 0  # Remove low frequencies
+            filt_frame = cv2.idft(np.fft.ifftshift(dft_shift))
             filt_frame = cv2.magnitude(filt_frame[..., 0], filt_frame[..., 1])
-            # Re-normalize to 8-bits to make threshold simpler
             img_back = cv2.normalize(filt_frame, None, alpha=0, beta=256,
                                      norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_8U)
-            filt_mean[i] = np.mean(img_back)
-            if i == len(img) - 1 and display:
-                # Plot Fourier transforms
-                f = plt.figure()
-                gs = f.add_gridspec(2, 3)
-                self.imshow(img[0], ax=f.add_subplot(gs[0, 0]), title='Original frame')
-                dft_shift = np.fft.fftshift(dft)
-                magnitude = 20 * np.log(cv2.magnitude(dft_shift[..., 0], dft_shift[..., 1]))
-                self.imshow(magnitude, ax=f.add_subplot(gs[0, 1]), title='Magnitude spectrum')
-                self.imshow(img_back, ax=f.add_subplot(gs[0, 2]), title='Filtered frame')
-                ax = f.add_subplot(gs[1, :])
-                ax.plot(filt_mean)
-                ax.axhline(threshold[1], 0, n, linestyle=':', color='r', label='lower threshold')
-                ax.set(xlabel='Frame sample', ylabel='Mean of filtered frame')
-                f.suptitle('Discrete Fourier Transform')
-                plt.show()
+            f = plt.figure()
+            gs = f.add_gridspec(2, 3)
+            self.imshow(img[0], ax=f.add_subplot(gs[0, 0]), title='Original frame')
+            self.imshow(magnitude, ax=f.add_subplot(gs[0, 1]), title='Magnitude spectrum')
+            self.imshow(img_back, ax=f.add_subplot(gs[0, 2]), title='Filtered frame')
+            ax = f.add_subplot(gs[1, :])
+            ax.plot(filt_mean)
+            ax.axhline(threshold[1], 0, n, linestyle=':', color='r', label='lower threshold')
+            ax.set(xlabel='Frame sample', ylabel='Mean of filtered frame')
+            f.suptitle('Discrete Fourier Transform')
+            plt.show()
         passes = np.all(lpc_var > threshold[0]) or np.all(filt_mean > threshold[1])
         return 'PASS' if passes else 'FAIL'
 
@@ -849,6 +860,7 @@ class CameraQC(base.QC):
         :param refs: An array of frames to match the template to
 
         :returns: (y1, y2), (x1, x2)
+        The locations found with the default reference frames are kept for subsequent calls.
         """
         ROI = {
             'left': ((45, 346), (138, 501)),
@@ -856,18 +868,18 @@ class CameraQC(base.QC):
             'body': ((141, 272), (90, 339))
         }
         roi = roi or ROI[self.label]
+        key = (tuple(map(tuple, roi)), test, metric) if refs is None else None
         refs = self.load_reference_frames(self.label) if refs is None else refs
 
         frames = refs if test else self.data['frame_samples']
         template = refs[0][tuple(slice(*r) for r in roi)]
-        top_left = []  # [(x1, y1), ...]
-        for frame in frames:
-            res = cv2.matchTemplate(frame, template, metric)
-            min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(res)
-            # If the method is TM_SQDIFF or TM_SQDIFF_NORMED, take minimum
-            top_left.append(min_loc if metric < 2 else max_loc)
-            # bottom_right = (top_left[0] + w, top_left[1] + h)
-        return top_left, roi, template
+        # the locations are kept with the frames they were found in, new frame samples are matched again
+        if key not in self._face_locations or self._face_locations[key][0] is not frames:
+            top_left = frame_metrics.match_template(frames, template, metric, n_workers=self.n_workers)
+            if key is None:
+                return top_left, roi, template
+            self._face_locations[key] = (frames, top_left)  # [(x1, y1), ...]
+        return self._face_locations[key][1], roi, template
 
     @staticmethod
     def load_reference_frames(side):
@@ -878,11 +890,14 @@ class CameraQC(base.QC):
         session eids can be found in qc/reference/frame_src.json
 
         :param side: Video label, e.g. 'left'
-        :return: numpy array of frames with the shape (n, h, w)
+        :return: read-only numpy array of frames with the shape (n, h, w), loaded once per process
         """
-        file = next(Path(__file__).parent.joinpath('reference').glob(f'frames_{side}.npy'))
-        refs = np.load(file)
-        return refs
+        if side not in _REFERENCE_FRAMES:
+            file = next(Path(__file__).parent.joinpath('reference').glob(f'frames_{side}.npy'))
+            refs = np.load(file)
+            refs.flags.writeable = False
+            _REFERENCE_FRAMES[side] = refs
+        return _REFERENCE_FRAMES[side]
 
     @staticmethod
     def imshow(frame, ax=None, title=None, **kwargs):
@@ -921,3 +936,91 @@ def run_all_qc(session, cameras=('left', 'right', 'body'), **kwargs):
         qc[camera] = CameraQC(session, camera, **kwargs)
         qc[camera].run(**run_args)
     return qc
+
+
+def _init_qc_worker(one_kwargs):
+    """Creates the ONE instance of a batch QC worker process"""
+    global _WORKER_ONE
+    _WORKER_ONE = ONE(**one_kwargs)
+
+
+def _run_camera_qc(session, camera, kwargs, run_args, one=None):
+    """
+    Runs the QC of one camera and returns a record of the results table, see run_qc_batch
+    """
+    record = {'session': str(session), 'camera': camera, 'eid': None, 'outcome': 'NOT_SET', 'error': None}
+    t0 = time.time()
+    try:
+        qc = CameraQC(session, camera, one=one or _WORKER_ONE, **kwargs)
+        record['eid'] = str(qc.eid) if qc.eid else None
+        outcome, metrics = qc.run(update=False, **run_args)
+        record['outcome'] = outcome
+        record['metrics'] = json.dumps(metrics, default=lambda x: x.item() if isinstance(x, np.generic) else str(x))
+        for k, v in metrics.items():  # one column per check, without the camera namespace
+            record['check_' + k.split('_', 2)[-1]] = v if v is None or isinstance(v, str) else v[0]
+    except Exception as e:
+        _log.error(f'{session} {camera} camera QC errored: {e}')
+        record['error'] = str(e)
+    record['time_secs'] = time.time() - t0
+    return record
+
+
+def run_qc_batch(sessions, cameras=('left', 'right', 'body'), n_workers=1, results_file=None,
+                 update=False, one=None, one_kwargs=None, **kwargs):
+    """Run the camera QC over many sessions
+    The reference frames are loaded once and shared with the worker processes, at most n_workers
+    cameras are processed at once to bound the memory. The results are saved as a table before
+    the QC is optionally updated on Alyx.
+    :param sessions: A list of session paths or eids.
+    :param cameras: A list of camera names to perform QC on.
+    :param n_workers: The number of processes, if 1 the QC runs in the current process.
+    :param results_file: Optional parquet file path where the results table is saved.
+    :param update: If True, QC fields are updated on Alyx, once the results are saved.
+    :param one: An ONE instance, used in the current process.
+    :param one_kwargs: The arguments of the ONE instance of each worker process, if n_workers > 1.
+    :param kwargs: CameraQC arguments (e.g. n_samples, stream) and run arguments (download_data,
+    extract_times).
+    :return: pandas DataFrame, one row per session and camera with the outcome, the outcome of each
+    check, the json serialized metrics, the error message if any and the run time.
+    """
+    run_args = {k: kwargs.pop(k) for k in ('download_data', 'extract_times') if k in kwargs.keys()}
+    if one is None and (n_workers == 1 or update):
+        one = ONE(**(one_kwargs or {}))
+    jobs = [(session, camera) for session in sessions for camera in cameras]
+    # load the reference frames before the workers start so that they share them
+    for camera in cameras:
+        CameraQC.load_reference_frames(camera)
+    records = []
+
+    def log_progress(record):
+        records.append(record)
+        _log.info(f"{len(records)}/{len(jobs)} {record['session']} {record['camera']} camera QC: "
+                  f"{record['outcome']} ({record['time_secs']:.1f} secs)")
+
+    if n_workers == 1:
+        for session, camera in jobs:
+            log_progress(_run_camera_qc(session, camera, kwargs, run_args, one=one))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_qc_worker,
+                                 initargs=(one_kwargs or {},)) as executor:
+            running = set()
+            for session, camera in jobs:
+                if len(running) >= n_workers:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    [log_progress(f.result()) for f in done]
+                running.add(executor.submit(_run_camera_qc, session, camera, kwargs, run_args))
+            [log_progress(f.result()) for f in wait(running)[0]]
+    # sort the records in the order of the sessions and cameras
+    order = {(str(session), camera): i for i, (session, camera) in enumerate(jobs)}
+    df = pd.DataFrame(sorted(records, key=lambda r: order[(r['session'], r['camera'])]))
+    if results_file is not None:
+        df.to_parquet(results_file)
+    if update:
+        for _, rec in df[df['error'].isna() & df['eid'].notna()].iterrows():
+            metrics = json.loads(rec['metrics'])
+            if not metrics:  # the checks did not run
+                continue
+            qc = CameraQC(rec['eid'], rec['camera'], one=one, stream=False)
+            qc.metrics = {k: tuple(v) if isinstance(v, list) else v for k, v in metrics.items()}
+            qc.update_metrics(rec['outcome'])
+    return df
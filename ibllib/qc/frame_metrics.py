@@ -0,0 +1,133 @@
+"""Image metrics computed on a stack of video frames
+These functions operate on the (n, h, w) uint8 frame samples array of the camera QC at once and
+return the same values as the frame by frame OpenCV calls of the checks. The OpenCV kernels
+release the GIL, so the frames are processed concurrently by n_workers threads, and the outputs
+are written in preallocated arrays.
+
+Example - Focus metrics of the equalized frame samples
+    frames = equalize_hist(qc.data['frame_samples'], n_workers=4)
+    lpc_var = laplacian_variance(frames, (np.s_[:400, :561],), n_workers=4)
+    filt_mean = highpass_energy(frames, n_workers=4)
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+HIGHPASS_SIZE = 60  # half size of the low frequencies square removed by the high pass filter
+
+
+def _map_frames(fcn, frames, n_workers=1):
+    """Applies a function to each frame, concurrently if n_workers > 1, returns a list"""
+    if n_workers == 1 or len(frames) < 2:
+        return [fcn(frame) for frame in frames]
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(fcn, frames))
+
+
+def histograms(frames, n_workers=1):
+    """
+    256 bins intensity histograms of uint8 frames
+    :param frames: uint8 array (n, h, w)
+    :param n_workers: number of threads
+    :return: float32 array (n, 256)
+    """
+    hists = np.empty((len(frames), 256), dtype=np.float32)
+
+    def hist(i):
+        hists[i] = cv2.calcHist([frames[i]], [0], None, [256], [0, 256])[:, 0]
+    _map_frames(hist, range(len(frames)), n_workers)
+    return hists
+
+
+def hist_correlation(frames, ref, n_workers=1):
+    """
+    Correlation of the histogram of each frame with the histogram of a reference frame, as
+    cv2.compareHist(hist, ref_hist, cv2.HISTCMP_CORREL)
+    :param frames: uint8 array (n, h, w)
+    :param ref: uint8 reference frame (h, w)
+    :param n_workers: number of threads
+    :return: float array (n,)
+    """
+    hists = histograms(frames, n_workers=n_workers).astype(np.float64)
+    ref_h = histograms(ref[np.newaxis]).astype(np.float64)
+    hists -= hists.mean(axis=1, keepdims=True)
+    ref_h -= ref_h.mean(axis=1, keepdims=True)
+    num = (hists * ref_h).sum(axis=1)
+    den = np.sqrt((hists ** 2).sum(axis=1) * (ref_h ** 2).sum(axis=1))
+    return np.divide(num, den, out=np.ones_like(num), where=np.abs(den) > np.finfo(np.float64).eps)
+
+
+def equalize_hist(frames, n_workers=1):
+    """
+    Histogram equalization of each frame
+    :param frames: uint8 array (n, h, w)
+    :param n_workers: number of threads
+    :return: uint8 array (n, h, w)
+    """
+    out = np.empty_like(frames)
+    _map_frames(lambda i: cv2.equalizeHist(frames[i], out[i]), range(len(frames)), n_workers)
+    return out
+
+
+def laplacian_variance(frames, rois=(np.s_[:, :],), n_workers=1):
+    """
+    Variance of the Laplacian of each frame within regions of interest, a measure of sharpness
+    :param frames: uint8 array (n, h, w)
+    :param rois: list of 2D slices
+    :param n_workers: number of threads
+    :return: float array (n, number of rois)
+    """
+    lpc_var = np.empty((len(frames), len(rois)))
+
+    def lpc(i):
+        lpc = cv2.Laplacian(frames[i], cv2.CV_16S, ksize=1)
+        lpc_var[i] = [lpc[roi].var() for roi in rois]
+    _map_frames(lpc, range(len(frames)), n_workers)
+    return lpc_var
+
+
+def highpass_energy(frames, sz=HIGHPASS_SIZE, n_workers=1):
+    """
+    Mean of the high pass filtered frames, a measure of sharpness. The low frequencies within a
+    square of half size sz around the centre of the shifted spectrum are removed, the magnitude of
+    the inverse transform is min-max normalized to 8 bits and averaged.
+    :param frames: uint8 array (n, h, w)
+    :param sz: half size of the low frequencies square removed
+    :param n_workers: number of threads
+    :return: float array (n,)
+    """
+    h, w = frames.shape[1:]
+    cX, cY = w // 2, h // 2
+    mask = np.ones((h, w), np.float32)
+    mask[cY - sz:cY + sz, cX - sz:cX + sz] = 0
+    # shifting the mask once rather than each spectrum back and forth
+    mask = np.fft.ifftshift(mask)[..., np.newaxis]
+    filt_mean = np.empty(len(frames))
+
+    def highpass(i):
+        dft = cv2.dft(np.float32(frames[i]), flags=cv2.DFT_COMPLEX_OUTPUT)
+        dft *= mask
+        filt_frame = cv2.idft(dft)  # Reconstruct
+        filt_frame = cv2.magnitude(filt_frame[..., 0], filt_frame[..., 1])
+        # Re-normalize to 8-bits to make threshold simpler
+        filt_mean[i] = cv2.normalize(filt_frame, None, alpha=0, beta=256,
+                                     norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_8U).mean()
+    _map_frames(highpass, range(len(frames)), n_workers)
+    return filt_mean
+
+
+def match_template(frames, template, metric=cv2.TM_CCOEFF_NORMED, n_workers=1):
+    """
+    Location of the best match of a template in each frame
+    :param frames: uint8 array (n, h, w)
+    :param template: uint8 array (th, tw)
+    :param metric: cv2 template matching method
+    :param n_workers: number of threads
+    :return: list of (x, y) top left locations
+    """
+    def match(frame):
+        min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(cv2.matchTemplate(frame, template, metric))
+        # If the method is TM_SQDIFF or TM_SQDIFF_NORMED, take minimum
+        return min_loc if metric < 2 else max_loc
+    return _map_frames(match, frames, n_workers)
@@ -1,4 +1,5 @@
 import unittest
+from unittest import mock
 from tempfile import TemporaryDirectory
 from pathlib import Path
 import logging
@@ -9,7 +10,7 @@ import matplotlib.pyplot as plt
 
 from one.api import ONE
 from ibllib.tests import TEST_DB
-from ibllib.qc.camera import CameraQC
+from ibllib.qc.camera import CameraQC, run_qc_batch
 from ibllib.io.raw_data_loaders import load_camera_ssv_times
 from ibllib.tests.fixtures import utils
 from iblutil.util import Bunch
@@ -192,6 +193,14 @@ class TestCameraQC(unittest.TestCase):
         thr = [ln._y[0] for ln in plt.figure(fig).axes[2].lines[1:]]
         self.assertCountEqual(thr, thresh, 'unexpected thresholds in figure')
 
+        # Verify the face is found again when the frame samples change
+        refs = self.qc.load_reference_frames('left')
+        self.qc.data['frame_samples'] = refs
+        top_left, *_ = self.qc.find_face()
+        self.qc.data['frame_samples'] = np.roll(refs, 10, axis=2)
+        shifted, *_ = self.qc.find_face()
+        np.testing.assert_array_equal(np.array(shifted) - np.array(top_left), [[10, 0]] * len(refs))
+
     def test_check_resolution(self):
         self.qc.data['video'] = {'width': 1280, 'height': 1024}
         self.assertEqual('PASS', self.qc.check_resolution())
@@ -280,5 +289,42 @@ class TestCameraQC(unittest.TestCase):
             self.qc.ensure_required_data()
 
 
+class TestRunQCBatch(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tempdir = TemporaryDirectory()
+        self.sessions = []
+        for i in range(2):
+            session_path = utils.create_fake_session_folder(self.tempdir.name, date=f'2022-01-0{i + 1}')
+            utils.create_fake_raw_video_data_folder(session_path)
+            self.sessions.append(session_path)
+        eids = dict(zip(self.sessions, ('d3372b15-f696-4279-9be5-98f15783b5bb', 'a2ec6341-c55f-48a0-a23b-0ef2f5b1d71e')))
+        self.one = mock.MagicMock()
+        self.one.path2eid.side_effect = eids.get
+        self.one.eid2path.side_effect = {v: k for k, v in eids.items()}.get
+
+    def tearDown(self) -> None:
+        self.tempdir.cleanup()
+
+    def test_run_qc_batch(self):
+        def run(qc, update=False, **_):
+            if qc.session_path == self.sessions[1] and qc.label == 'body':
+                raise ValueError('corrupt video')
+            return 'WARNING', {f'_video{qc.label.capitalize()}_focus': 'PASS',
+                               f'_video{qc.label.capitalize()}_position': ('WARNING', np.float64(12.5))}
+        results_file = Path(self.tempdir.name).joinpath('camera_qc.pqt')
+        with mock.patch.object(CameraQC, 'run', run), mock.patch.object(CameraQC, 'update_metrics') as update:
+            df = run_qc_batch(self.sessions, cameras=('left', 'body'), one=self.one,
+                              results_file=results_file, update=True, stream=False)
+        self.assertEqual(df.shape[0], 4)
+        self.assertEqual(df['camera'].tolist(), ['left', 'body', 'left', 'body'])
+        self.assertEqual(df['outcome'].tolist(), ['WARNING', 'WARNING', 'WARNING', 'NOT_SET'])
+        self.assertEqual(df['check_position'][0], 'WARNING')
+        self.assertEqual(df['error'][3], 'corrupt video')
+        self.assertEqual(df['eid'][0], 'd3372b15-f696-4279-9be5-98f15783b5bb')
+        self.assertTrue(results_file.exists())
+        # the QC of the three cameras that ran is updated once the results are saved
+        self.assertEqual(update.call_count, 3)
+
+
 if __name__ == "__main__":
     unittest.main(exit=False, verbosity=2)
@@ -0,0 +1,54 @@
+import unittest
+
+import cv2
+import numpy as np
+
+from ibllib.qc import frame_metrics
+from ibllib.qc.camera import CameraQC
+
+
+class TestFrameMetrics(unittest.TestCase):
+    def setUp(self) -> None:
+        refs = CameraQC.load_reference_frames('body')
+        ks = (1, 3, 5, 7, 9)
+        self.frames = np.stack([np.roll(cv2.blur(refs[i % len(refs)], (k, k)), 4 * k, axis=1) for i, k in enumerate(ks)])
+        self.ref = refs[0]
+
+    def test_hist_correlation(self):
+        ref_h = cv2.calcHist([self.ref], [0], None, [256], [0, 256])
+        expected = [cv2.compareHist(cv2.calcHist([x], [0], None, [256], [0, 256]), ref_h, cv2.HISTCMP_CORREL)
+                    for x in self.frames]
+        for n_workers in (1, 2):
+            np.testing.assert_allclose(frame_metrics.hist_correlation(self.frames, self.ref, n_workers), expected)
+
+    def test_focus_metrics(self):
+        expected = np.array([cv2.equalizeHist(x) for x in self.frames])
+        frames = frame_metrics.equalize_hist(self.frames, n_workers=2)
+        np.testing.assert_array_equal(frames, expected)
+        rois = (np.s_[:200, :300], np.s_[200:, 100:])
+        expected = [[cv2.Laplacian(x, cv2.CV_16S, ksize=1)[r].var() for r in rois] for x in frames]
+        np.testing.assert_array_equal(frame_metrics.laplacian_variance(frames, rois, n_workers=2), expected)
+        # high pass with shifted spectra
+        h, w = frames.shape[1:]
+        mask = np.ones((h, w, 2), bool)
+        mask[h // 2 - 60:h // 2 + 60, w // 2 - 60:w // 2 + 60] = False
+        expected = []
+        for x in frames:
+            dft = np.fft.fftshift(cv2.dft(np.float32(x), flags=cv2.DFT_COMPLEX_OUTPUT)) * mask
+            filt = cv2.idft(np.fft.ifftshift(dft))
+            filt = cv2.magnitude(filt[..., 0], filt[..., 1])
+            expected.append(cv2.normalize(filt, None, alpha=0, beta=256, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_8U).mean())
+        np.testing.assert_allclose(frame_metrics.highpass_energy(frames, n_workers=2), expected)
+
+    def test_match_template(self):
+        template = self.ref[141:272, 90:339]
+        top_left = frame_metrics.match_template(self.frames, template, n_workers=2)
+        expected = [cv2.minMaxLoc(cv2.matchTemplate(x, template, cv2.TM_CCOEFF_NORMED))[3] for x in self.frames]
+        self.assertEqual(top_left, expected)
+        self.assertEqual(top_left[0], (94, 141))
+        top_left = frame_metrics.match_template(self.frames, template, metric=cv2.TM_SQDIFF)
+        self.assertEqual(top_left[0], (94, 141))
+
+
+if __name__ == '__main__':
+    unittest.main()
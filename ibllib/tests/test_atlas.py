@@ -1,10 +1,14 @@
 import unittest
+from unittest import mock
+from pathlib import Path
+import tempfile
 
 import numpy as np
 import matplotlib.pyplot as plt
+import nrrd
 
 from ibllib.atlas import (BrainCoordinates, cart2sph, sph2cart, Trajectory,
-                          Insertion, ALLEN_CCF_LANDMARKS_MLAPDV_UM, AllenAtlas)
+                          Insertion, ALLEN_CCF_LANDMARKS_MLAPDV_UM, AllenAtlas, shared_atlas)
 from ibllib.atlas.regions import BrainRegions
 from ibllib.atlas.plots import prepare_lr_data, reorder_data
 from iblutil.numerical import ismember
@@ -61,6 +65,24 @@ class TestBrainRegions(unittest.TestCase):
         chemin = br.subtree(453)
         assert np.all(np.sort(chemin.id) == np.unique(np.r_[br.descendants(453).id, br.ancestors(453).id]))
 
+    def test_ancestors_matrix(self):
+        br = self.brs
+        tpath = np.array([997, 8, 567, 688, 695, 315, 453, 12993])
+        ids = np.array([12993, 0, 999999, 12993, -12993, 688])
+        m = br.ancestors_matrix(ids)
+        self.assertEqual(m.shape, (ids.size, br.id.size))
+        np.testing.assert_array_equal(np.sort(br.id[m[0].indices]), np.sort(tpath))
+        np.testing.assert_array_equal(np.sort(br.id[m[4].indices]), np.sort(-tpath))
+        np.testing.assert_array_equal(br.id[m[1].indices], [0])
+        self.assertEqual(m[2].nnz, 0)
+        # ids in the subtree of the isocortex
+        in_ctx = m[:, np.where(br.id == 315)[0][0]].toarray().flatten()
+        np.testing.assert_array_equal(in_ctx, [True, False, False, True, False, False])
+        # the nested set intervals give the descendants
+        ictx = np.where(br.id == 688)[0][0]
+        idesc = np.where((br.tree.first >= br.tree.first[ictx]) & (br.tree.first <= br.tree.last[ictx]))[0]
+        np.testing.assert_array_equal(idesc, br.descendants(688, return_indices=True)[1])
+
     def test_mappings_lateralized(self):
         # the mapping assigns all non found regions to root (1:997), except for the void (0:0)
         # here we're looking at the retina (1327:304325711), so we expect 1327 at index 1327
@@ -425,6 +447,77 @@ class TestAtlasSlicesConversion(unittest.TestCase):
         assert np.all(np.isclose(self.ba.xyz2ccf(xyz_mlapdv, 'apdvml'), ccf_apdvml))
 
 
+class TestAtlasVolumes(unittest.TestCase):
+
+    def test_read_volume_npy_cache(self):
+        volume = np.random.randint(0, 1000, size=(8, 6, 4)).astype(np.int16)
+        with tempfile.TemporaryDirectory() as td:
+            file_nrrd = Path(td).joinpath('average_template_25.nrrd')
+            nrrd.write(str(file_nrrd), volume, index_order='C')
+            file_npz = Path(td).joinpath('annotation_25_lut_v01.npz')
+            np.savez_compressed(file_npz, volume)
+            for file_volume in (file_nrrd, file_npz):
+                expected = AllenAtlas._read_volume(file_volume)
+                # the first call creates the npy cache, the second one memory-maps it
+                for _ in range(2):
+                    vol = AllenAtlas._read_volume(file_volume, mmap=True)
+                    self.assertIsInstance(vol, np.memmap)
+                    self.assertFalse(vol.flags.writeable)
+                    np.testing.assert_array_equal(vol, expected)
+                    self.assertEqual(vol.strides, expected.strides)
+                self.assertEqual(len(list(Path(td).glob(f'{file_volume.stem}_*.npy'))), 1)
+                del vol
+            self.assertEqual(len(list(Path(td).glob('*.part'))), 0)
+            # if the cache can't be written, the volume is read in memory
+            for file_npy in Path(td).glob(f'{file_npz.stem}_*.npy'):
+                file_npy.unlink()
+            with mock.patch.object(np, 'save', side_effect=OSError('Read-only file system')), \
+                    self.assertLogs('ibllib', 'WARNING'):
+                vol = AllenAtlas._read_volume(file_npz, mmap=True)
+            self.assertNotIsInstance(vol, np.memmap)
+            np.testing.assert_array_equal(vol, volume)
+            self.assertEqual(len(list(Path(td).glob('*.part'))), 0)
+
+    def test_boundary_surface_volumes(self):
+        ba = AllenAtlas(res_um=25, mock=True)
+        label = np.random.randint(0, 3, size=(20, 16, 12)).astype(np.uint16)
+        ba.label[100:120, 200:216, 150:162] = label
+        ba.compute_surface()
+        surface, top, bottom = (ba.surface.copy(), ba.top.copy(), ba.bottom.copy())
+        coords = [(ba.bc.i2x(205), 0), (ba.bc.i2y(110), 1), (ba.bc.i2z(155), 2)]
+        boundaries = [ba.slice(c, axis=axis, volume='boundary', mapping='Beryl') for c, axis in coords]
+        bvol = ba.compute_boundary_volume('Beryl')
+        self.assertEqual(bvol.shape, ba.label.shape)
+        for (c, axis), boundary in zip(coords, boundaries):
+            values = ba.slice(c, axis=axis, volume='value', mapping='Beryl', region_values=np.arange(ba.regions.id.size))
+            expected = (np.diff(values, axis=0, append=0) != 0) | (np.diff(values, axis=1, append=0) != 0)
+            np.testing.assert_array_equal(ba.slice(c, axis=axis, volume='boundary', mapping='Beryl'), expected)
+            # the per-slice computation gives the same result
+            np.testing.assert_array_equal(boundary, expected)
+        # the volumes are cached next to the label file
+        with tempfile.TemporaryDirectory() as td:
+            ba._label_file = Path(td).joinpath('annotation_25_lut_v01.npz')
+            ba._label_file.touch()
+            ba.surface, ba.boundary = (None, {})
+            for _ in range(2):
+                ba.compute_surface()
+                np.testing.assert_array_equal(ba.surface, surface)
+                np.testing.assert_array_equal(ba.top, top)
+                np.testing.assert_array_equal(ba.bottom, bottom)
+                self.assertIsInstance(ba.surface, np.memmap)
+                self.assertIsInstance(ba.compute_boundary_volume('Beryl'), np.memmap)
+                np.testing.assert_array_equal(ba.compute_boundary_volume('Beryl'), bvol)
+                ba.surface, ba.boundary = (None, {})
+            self.assertEqual(len(list(Path(td).glob('*.npy'))), 3)
+
+    def test_shared_atlas(self):
+        ba = shared_atlas(25, mock=True)
+        self.assertIs(ba, shared_atlas(25, mock=True))
+        self.assertIsNot(ba, shared_atlas(25, mock=True, scaling=np.array([1, 1.087, 0.952])))
+        self.assertIs(ba, shared_atlas(25, mock=True, scaling=np.array([1, 1, 1])))
+        self.assertIs(ba, shared_atlas(25, mock=True, scaling=[1., 1., 1.]))
+
+
 class TestInsertion(unittest.TestCase):
 
     def test_init_from_dict(self):
@@ -1,15 +1,20 @@
 # Mock dataset
 import unittest
+from pathlib import Path
 from tempfile import TemporaryDirectory
+from unittest import mock
 
 import numpy as np
 import scipy.signal
 
 from one.api import ONE
+import one.alf.io as alfio
 import neuropixel
+import spikeglx
 from neurodsp import voltage
 
-from ibllib.ephys import ephysqc, spikes
+from ibllib.ephys import ephysqc, spikes, raw_pass
+from ibllib.io.extractors import ephys_fpga
 from ibllib.tests import TEST_DB
 from ibllib.tests.fixtures import utils
 
@@ -164,6 +169,102 @@ class TestEphysQC(unittest.TestCase):
         self.qc._ensure_required_data()
 
 
+class TestRmsMap(unittest.TestCase):
+
+    def setUp(self):
+        """Creates a small LF file with random data, the last window is too short for Welch"""
+        meta_file = Path(__file__).parent.joinpath('fixtures', 'sync_ephys_fpga', 'sample3B_g0_t0.imec1.ap.meta')
+        meta = meta_file.read_text().replace('imSampRate=30000.390639481', 'imSampRate=2500')
+        meta = meta.replace('snsApLfSy=384,0,1', 'snsApLfSy=0,384,1')
+        self.ns, self.nc = (8192 * 4 + 500, 385)
+        np.random.seed(42)
+        data = (np.random.randn(self.ns, self.nc) * 1000).astype(np.int16)
+        data[:, -1] = np.random.randint(0, 4, self.ns)  # sync fronts on the 2 first sync channels
+        self.tempdir = TemporaryDirectory()
+        self.bin_file = Path(self.tempdir.name).joinpath('_spikeglx_ephysData_g0_t0.imec0.lf.bin')
+        data.tofile(self.bin_file)
+        self.bin_file.with_suffix('.meta').write_text(meta)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_rmsmap_parallel(self):
+        """
+        Computes the RMS map serially and with several workers, and checks that the sharded
+        computation gives the same outputs
+        """
+        serial = ephysqc.rmsmap(spikeglx.Reader(self.bin_file, ignore_warnings=True))
+        parallel = ephysqc.rmsmap(spikeglx.Reader(self.bin_file, ignore_warnings=True), n_workers=3)
+        # a memory ceiling smaller than a window falls back to a single worker
+        ceiling = ephysqc.rmsmap(spikeglx.Reader(self.bin_file, ignore_warnings=True), n_workers=3, max_memory_gb=0)
+        for k in ['TRMS', 'nsamples', 'fscale', 'tscale']:
+            np.testing.assert_array_equal(serial[k], parallel[k])
+            np.testing.assert_array_equal(serial[k], ceiling[k])
+        np.testing.assert_allclose(serial['spectral_density'], parallel['spectral_density'], rtol=1e-12)
+        np.testing.assert_array_equal(serial['spectral_density'], ceiling['spectral_density'])
+        self.assertEqual(serial['TRMS'].shape, (5, self.nc))
+
+    def test_sync_rmsmap_overwrite(self):
+        """
+        Existing sync and RMS map files are returned without reading the raw data unless overwrite is set
+        """
+        folder = self.bin_file.parent
+        names = ['_spikeglx_sync.times.npy', '_spikeglx_sync.channels.npy', '_spikeglx_sync.polarities.npy',
+                 '_iblqc_ephysTimeRmsLF.rms.npy', '_iblqc_ephysTimeRmsLF.timestamps.npy',
+                 '_iblqc_ephysSpectralDensityLF.power.npy', '_iblqc_ephysSpectralDensityLF.freqs.npy']
+        for name in names:
+            np.save(folder.joinpath(name), np.zeros(2))
+        with mock.patch.object(ephys_fpga, '_sync_to_alf', side_effect=StopIteration) as sync_to_alf:
+            out_files = ephysqc.extract_sync_rmsmap(spikeglx.Reader(self.bin_file, ignore_warnings=True))
+            sync_to_alf.assert_not_called()
+            self.assertCountEqual([f.name for f in out_files], names)
+            with self.assertRaises(StopIteration):
+                ephysqc.extract_sync_rmsmap(spikeglx.Reader(self.bin_file, ignore_warnings=True), overwrite=True)
+
+    def test_raw_pass(self):
+        """
+        Extracts the sync and the RMS map in a single pass and compares with the separate extractions
+        """
+        sync = ephys_fpga._sync_to_alf(spikeglx.Reader(self.bin_file, ignore_warnings=True))
+        rms = ephysqc.rmsmap(spikeglx.Reader(self.bin_file, ignore_warnings=True))
+        out_files = ephysqc.extract_sync_rmsmap(spikeglx.Reader(self.bin_file, ignore_warnings=True))
+        self.assertEqual(len(out_files), 7)
+        sync_ = alfio.load_object(self.bin_file.parent, 'sync', namespace='spikeglx')
+        for k in sync:
+            np.testing.assert_array_equal(sync[k], sync_[k])
+        self.assertTrue(np.all(np.isin(sync['channels'], [0, 1])))
+        rms_ = alfio.load_object(self.bin_file.parent, 'ephysTimeRmsLF', namespace='iblqc')
+        np.testing.assert_array_equal(rms['TRMS'].astype(np.single), rms_['rms'])
+        psd_ = alfio.load_object(self.bin_file.parent, 'ephysSpectralDensityLF', namespace='iblqc')
+        np.testing.assert_allclose(rms['spectral_density'].astype(np.single), psd_['power'], rtol=1e-6)
+        # a pass with only the sync consumer does not read the data
+        sync_only, = raw_pass.raw_pass(spikeglx.Reader(self.bin_file, ignore_warnings=True), [ephys_fpga.SyncFronts()])
+        np.testing.assert_array_equal(sync['times'], sync_only['times'])
+
+    def test_sync_spill(self):
+        """
+        Extracts the sync fronts in memory and with a spill to disk and checks the outputs match
+        """
+        sync = ephys_fpga._sync_to_alf(spikeglx.Reader(self.bin_file, ignore_warnings=True))
+        self.assertEqual(sync['channels'].dtype, np.int8)
+        self.assertEqual(sync['polarities'].dtype, np.int8)
+        self.assertEqual(sync['times'].dtype, np.float64)
+        consumer = ephys_fpga.SyncFronts(spill_size=1000, file_spill=self.bin_file.with_suffix('.spill'))
+        spilled, = raw_pass.raw_pass(spikeglx.Reader(self.bin_file, ignore_warnings=True), [consumer], batch_secs=1)
+        self.assertFalse(self.bin_file.with_suffix('.spill').exists())
+        self.assertTrue(sync['times'].size > 1000)
+        for k in sync:
+            np.testing.assert_array_equal(sync[k], spilled[k])
+        # by default the spill file is a temporary file, removed after the pass
+        with mock.patch('tempfile.tempdir', str(self.bin_file.parent.joinpath('tmp'))):
+            self.bin_file.parent.joinpath('tmp').mkdir()
+            consumer = ephys_fpga.SyncFronts(spill_size=1000)
+            spilled, = raw_pass.raw_pass(spikeglx.Reader(self.bin_file, ignore_warnings=True), [consumer], batch_secs=1)
+        self.assertEqual(Path(consumer.fid_spill.name).parent, self.bin_file.parent.joinpath('tmp'))
+        self.assertEqual(list(self.bin_file.parent.joinpath('tmp').iterdir()), [])
+        np.testing.assert_array_equal(sync['times'], spilled['times'])
+
+
 class TestDetectSpikes(unittest.TestCase):
 
     def test_spike_detection(self):
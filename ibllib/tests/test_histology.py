@@ -2,9 +2,13 @@ from pathlib import Path
 import unittest
 
 import numpy as np
+import pandas as pd
+
+from neurodsp.utils import fcn_cosine
 
 from ibllib.pipes import histology
-from ibllib.pipes.ephys_alignment import (EphysAlignment, TIP_SIZE_UM, _cumulative_distance)
+from ibllib.pipes.ephys_alignment import (
+    EphysAlignment, TIP_SIZE_UM, NEAREST_BOUNDARY_CACHE, _cumulative_distance)
 import ibllib.atlas as atlas
 
 # TODO Place this in setUpModule()
@@ -45,6 +49,41 @@ class TestHistology(unittest.TestCase):
         self.assertTrue(np.isclose(brain_atlas.top[iy, ix], top[2]))
         self.assertTrue(np.isclose(brain_atlas.bottom[iy, ix], bottom[2]))
 
+    def test_coverage(self):
+        # 50 um atlas with all voxels in the brain
+        label = np.ones((264, 228, 160), dtype=np.uint16)
+        ba = atlas.BrainAtlas(label, label, np.array([1, -1, -1]) * 50e-6, atlas.BrainRegions(),
+                              atlas.ALLEN_CCF_LANDMARKS_MLAPDV_UM['bregma'] / 50,
+                              dims2xyz=np.array([1, 0, 2]), xyz2dims=np.array([1, 0, 2]))
+        trajs = [dict(x=-2000., y=-2000., z=0., depth=4000., theta=0, phi=0),
+                 dict(x=-1900., y=-2100., z=0., depth=4000., theta=15, phi=90),
+                 dict(x=2000., y=-3000., z=0., depth=4000., theta=10, phi=180)]
+        full_coverage, xyz_mean, flat_ind = histology.coverage(trajs, ba=ba)
+        self.assertEqual(full_coverage.shape, label.shape)
+        # compare with the cosine taper of the distances to the active segment of the last insertion
+        ins = atlas.Insertion.from_dict(trajs[-1])
+        bounds = (ins.entry - ins.tip) * (np.array([3500 + TIP_SIZE_UM, TIP_SIZE_UM])[:, np.newaxis] / 1e6 /
+                                          np.linalg.norm(ins.entry - ins.tip)) + ins.tip
+        ixyz = np.c_[np.unravel_index(flat_ind, label.shape)][:, [1, 0, 2]]
+        xyz = ba.bc.i2xyz(ixyz)
+        mdist = ins.trajectory.mindist(xyz, bounds=bounds)
+        np.testing.assert_allclose(full_coverage.flat[flat_ind], 1 - fcn_cosine(np.array([100, 150]) / 1e6)(mdist),
+                                   atol=1e-6)
+        np.testing.assert_allclose(xyz_mean, np.mean(xyz, axis=0))
+        # the two first insertions overlap
+        self.assertTrue(np.nanmax(full_coverage) > 1)
+        # distributed over processes
+        full_coverage_, xyz_mean_, flat_ind_ = histology.coverage(trajs, ba=ba, n_workers=2)
+        np.testing.assert_allclose(full_coverage_, full_coverage, atol=1e-6)
+        np.testing.assert_array_equal(flat_ind_, flat_ind)
+        # no trajectory, or only skipped trajectories
+        skipped = [dict(x=-2000., y=-2000., z=0., depth=4000., theta=80, phi=0)] * 2
+        for trajs_, n_workers in [([], 1), ([], 2), (skipped, 1), (skipped, 2)]:
+            full_coverage_, xyz_mean_, flat_ind_ = histology.coverage(trajs_, ba=ba, n_workers=n_workers)
+            self.assertEqual(np.nansum(full_coverage_), 0)
+            self.assertIsNone(xyz_mean_)
+            self.assertIsNone(flat_ind_)
+
     def test_filename_parser(self):
         tdata = [
             {'input': Path("/gna/electrode_tracks_SWC_014/2019-12-12_SWC_014_001_probe01_fit.csv"),
@@ -143,6 +182,41 @@ class TestsEphysAlignment(unittest.TestCase):
         self.assertTrue(np.isclose(np.around(scale_factor[0], 3), linear_fit))
         self.assertTrue(np.isclose(np.around(scale_factor[-1], 3), linear_fit))
 
+    def test_nearest_boundary(self):
+        ba = atlas.AllenAtlas(25, mock=True)
+        # blocks of 8 voxels of random regions
+        np.random.seed(42)
+        blocks = np.random.randint(0, 1328, size=np.ceil(np.array(ba.label.shape) / 8).astype(int) + 1)
+        ba.label[:] = blocks.repeat(8, 0).repeat(8, 1).repeat(8, 2)[tuple(slice(n) for n in ba.label.shape)]
+        allen = pd.read_csv(Path(atlas.__file__).parent.joinpath('allen_structure_tree.csv'))
+        xyz = np.c_[np.linspace(-2000, -1900, 50), np.linspace(-2000, -2500, 50), np.linspace(-500, -4000, 50)] / 1e6
+        nb = EphysAlignment.get_nearest_boundary(xyz, allen, brain_atlas=ba)
+        # compare with the labels of the plane of one point
+        vector = atlas.Insertion.from_track(xyz, brain_atlas=ba).trajectory.vector
+        for ip in [0, 21, 49]:
+            x, y = [np.r_[np.linspace(xyz[ip, i] - 100 / 1e6, xyz[ip, i] + 100 / 1e6, 8), xyz[ip, i]] for i in range(2)]
+            X, Y = np.meshgrid(x, y)
+            Z = (np.dot(vector, xyz[ip]) - vector[0] * X - vector[1] * Y) / vector[2]
+            XYZ = np.c_[X.flatten(), Y.flatten(), Z.flatten()]
+            dist = np.sqrt(np.sum((XYZ - xyz[ip]) ** 2, axis=1)) * 1e6
+            ids = ba.get_labels(XYZ)
+            self.assertEqual(nb['id'][ip], ids[-1])
+            self.assertEqual(nb['col'][ip], allen['color_hex_triplet'][np.where(allen['id'] == ids[-1])[0][0]])
+            expected = np.min(dist[ids != ids[-1]]) if np.any(ids != ids[-1]) else np.max(dist)
+            self.assertAlmostEqual(nb['dist'][ip], expected)
+        # cached results
+        nb_cached = EphysAlignment.get_nearest_boundary(xyz, allen, brain_atlas=ba, cache=True)
+        for k in nb:
+            np.testing.assert_array_equal(nb[k], nb_cached[k])
+        self.assertIsNot(nb_cached, EphysAlignment.get_nearest_boundary(xyz, allen, brain_atlas=ba, cache=True))
+        # the cache is held per atlas and a different allen tree is not served the cached results
+        self.assertEqual(len(NEAREST_BOUNDARY_CACHE[ba]), 1)
+        allen_ = allen.copy()
+        allen_['color_hex_triplet'] = 'FFFFFF'
+        nb_ = EphysAlignment.get_nearest_boundary(xyz, allen_, brain_atlas=ba, cache=True)
+        self.assertEqual(set(nb_['col']), {'FFFFFF'})
+        self.assertEqual(len(NEAREST_BOUNDARY_CACHE[ba]), 2)
+
 
 class TestsEphysReconstruction(unittest.TestCase):
 
@@ -6,6 +6,7 @@ import tempfile
 from pathlib import Path
 import sys
 
+import cv2
 import numpy as np
 from one.api import ONE
 from iblutil.io import params
@@ -459,5 +460,44 @@ class TestVideo(unittest.TestCase):
             video.assert_valid_label(None)
 
 
+class TestVideoFramesPreload(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.video_path = Path(self.tmpdir.name).joinpath('_iblrig_leftCamera.raw.mp4')
+        writer = cv2.VideoWriter(str(self.video_path), cv2.VideoWriter_fourcc(*'mp4v'), 30, (64, 48))
+        base = np.random.default_rng(0).integers(0, 255, (48, 64, 3), dtype=np.uint8)
+        for i in range(120):
+            writer.write(np.roll(base, i, axis=1))
+        writer.release()
+        # reference frames read sequentially
+        cap = cv2.VideoCapture(str(self.video_path))
+        self.frames = np.array([cap.read()[1] for _ in range(120)])
+        cap.release()
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test_read_plan(self):
+        runs = video._read_plan([50, 3, 1, 3, 90, 95], max_gap=10)
+        self.assertEqual([r.tolist() for r in runs], [[1, 3], [50], [90, 95]])
+        runs = video._read_plan(range(10), n_runs=3)
+        self.assertEqual([r.tolist() for r in runs], [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+
+    def test_get_video_frames_preload(self):
+        frame_numbers = [100, 5, 6, 7, 60, 5, 119, 0]
+        for n_workers in (1, 3):
+            frames = video.get_video_frames_preload(self.video_path, frame_numbers, quiet=True, n_workers=n_workers)
+            np.testing.assert_array_equal(frames, self.frames[frame_numbers])
+        # from a capture, as a list with a mask
+        cap = cv2.VideoCapture(str(self.video_path))
+        frames = video.get_video_frames_preload(cap, frame_numbers, mask=np.s_[:, :, 0], as_list=True, quiet=True)
+        cap.release()
+        np.testing.assert_array_equal(np.array(frames), self.frames[frame_numbers, :, :, 0])
+        # in a preallocated array
+        out = np.zeros((len(frame_numbers), 48, 64, 3), dtype=np.uint8)
+        video.get_video_frames_preload(str(self.video_path), frame_numbers, quiet=True, n_workers=2, out=out)
+        np.testing.assert_array_equal(out, self.frames[frame_numbers])
+
+
 if __name__ == "__main__":
     unittest.main(exit=False, verbosity=2)
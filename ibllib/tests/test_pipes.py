@@ -4,12 +4,17 @@ import unittest
 from unittest import mock
 from pathlib import Path
 import json
+import os
+import threading
+import time
 
 from one.api import ONE
 
 import ibllib.io.extractors.base
 import ibllib.tests.fixtures.utils as fu
 from ibllib.pipes import misc
+from ibllib.pipes.scheduler import TaskScheduler
+from ibllib.pipes.tasks import Task, Pipeline, MACHINE_RESOURCES, load_task_metrics, run_alyx_task
 from ibllib.tests import TEST_DB
 import ibllib.pipes.scan_fix_passive_files as fix
 
@@ -431,5 +436,240 @@ class TestMultiPartsRecordings(unittest.TestCase):
         assert len(recordings['probe01']) == 4
 
 
+def _dummy_task_process(results, tdict, session_path, one, kwargs):
+    """Scheduler target recording the start and end times of a task, a negative duration hangs"""
+    t0 = time.time()
+    time.sleep(tdict['duration'] if tdict['duration'] >= 0 else 100)
+    results.put((tdict['id'], {**tdict, 'status': 'Complete', 'start': t0, 'end': time.time()},
+                 [{'name': tdict['name']}]))
+
+
+class TestTaskScheduler(unittest.TestCase):
+
+    def setUp(self):
+        def tdict(name, parents=(), duration=.5, **kwargs):
+            return {'id': name, 'name': name, 'session': 'eid', 'parents': list(parents),
+                    'duration': duration, 'status': 'Waiting', **kwargs}
+        self.tdicts = [
+            tdict('a', cpu=2), tdict('b', cpu=2), tdict('c', parents=['a', 'b']),
+            tdict('d', cpu=3, priority=100), tdict('e', cpu=0, time_out_sec=.5, duration=-1)]
+
+    def test_scheduler(self):
+        scheduler = TaskScheduler(resources={'cpu': 4, 'gpu': 1, 'io_charge': 100, 'ram': 100}, max_workers=3,
+                                  poll_secs=.05, target=_dummy_task_process)
+        results = scheduler.run(self.tdicts, {'eid': Path(tempfile.gettempdir())})
+        self.assertEqual([t['id'] for t, _ in results], ['a', 'b', 'c', 'd', 'e'])
+        t = {t['id']: t for t, _ in results}
+        # the timed out task is killed and labeled as errored
+        self.assertEqual(t['e']['status'], 'Errored')
+        self.assertIsNone(results[-1][1])
+        self.assertTrue(all(t[k]['status'] == 'Complete' for k in 'abcd'))
+        # the child starts after both parents complete
+        self.assertGreaterEqual(t['c']['start'], max(t['a']['end'], t['b']['end']))
+        # the high priority task starts first and the cpu budget holds back the heavy tasks
+        self.assertLessEqual(t['d']['end'], min(t['a']['start'], t['b']['start']))
+        # the two light tasks run concurrently
+        self.assertLess(t['b']['start'], t['a']['end'])
+        # the count stops the scheduler from starting new tasks
+        results = scheduler.run(self.tdicts[:4], {'eid': Path(tempfile.gettempdir())}, count=1)
+        self.assertEqual([t['id'] for t, _ in results], ['d'])
+
+
+def _dummy_run_alyx_task(tdict=None, session_path=None, one=None, job_deck=None, **kwargs):
+    """Stand-in for run_alyx_task returning the task dictionary with the keyword arguments it received"""
+    return {**tdict, 'status': 'Complete', 'kwargs': kwargs}, []
+
+
+class TestPipelineRun(unittest.TestCase):
+
+    def test_kwargs(self):
+        """The keyword arguments reach run_alyx_task for serial and concurrent runs"""
+        tdicts = [{'id': name, 'name': name, 'session': 'eid', 'parents': [], 'status': 'Waiting'}
+                  for name in 'ab']
+        one = mock.Mock()
+        one.alyx.cache_mode = False
+        one.alyx.rest.return_value = tdicts
+        pipeline = Pipeline(session_path=Path(tempfile.gettempdir()), one=one, eid='eid')
+        with mock.patch('ibllib.pipes.tasks.run_alyx_task', side_effect=_dummy_run_alyx_task):
+            for n_workers in (1, 2):
+                task_deck, _ = pipeline.run(n_workers=n_workers, location='remote', max_md5_size=10)
+                for t in task_deck:
+                    self.assertEqual(t['kwargs']['location'], 'remote')
+                    self.assertEqual(t['kwargs']['max_md5_size'], 10)
+
+
+class _DummyTask(Task):
+    ram = 1
+    io_charge = 60
+
+    def setUp(self, **kwargs):
+        return True
+
+    def _run(self, **kwargs):
+        return [Path(self.session_path)]
+
+    def tearDown(self):
+        pass
+
+    def register_datasets(self, one=None, **kwargs):
+        return []
+
+    def cleanUp(self):
+        pass
+
+
+class _OtherDummyTask(_DummyTask):
+    pass
+
+
+class TestTaskAdmission(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.patch = mock.patch.object(Task, '_claims_folder', return_value=Path(self.tmp_dir.name))
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.tmp_dir.cleanup()
+
+    def claim(self, name, pid, **kwargs):
+        d = {'pid': pid, 'name': name, 'start': time.time(), 'time_out_secs': 3600, **kwargs}
+        with open(Path(self.tmp_dir.name).joinpath(f"{pid}_{name}.json"), 'w+') as fid:
+            json.dump(d, fid)
+
+    def test_admission(self):
+        task = _DummyTask(self.tmp_dir.name)
+        # without admission_wait_secs, the task runs regardless of the claims of the other tasks
+        self.claim('Other', os.getppid(), ram=MACHINE_RESOURCES['ram'], cpu=1)
+        self.assertEqual(task.run(), 0)
+        Path(self.tmp_dir.name).joinpath(f"{os.getppid()}_Other.json").unlink()
+        task.admission_wait_secs = 0
+        # a task runs alone even if it declares more than the machine
+        with mock.patch.object(_DummyTask, 'ram', MACHINE_RESOURCES['ram'] + 1):
+            self.assertEqual(task.run(), 0)
+        self.assertIn('cpu seconds, peak rss', task.log)
+        self.assertGreater(task.usage['peak_rss'], 0)
+        self.assertEqual(list(Path(self.tmp_dir.name).glob('*.json')), [])
+        # the claim of a running process with all the ram left delays the task until the time out
+        self.claim('Other', os.getppid(), ram=MACHINE_RESOURCES['ram'], cpu=1)
+        self.assertEqual(task.machine_usage()[1], 1)
+        self.assertEqual(task.run(), -2)
+        self.assertIn('machine resources are used by other tasks', task.log)
+        # the claims of dead processes are discarded
+        self.claim('Other', 2 ** 22 + 1, ram=MACHINE_RESOURCES['ram'], cpu=1)
+        used, nclaims = task.machine_usage()
+        self.assertEqual((used['ram'], nclaims), (MACHINE_RESOURCES['ram'], 1))
+
+    def test_run_alyx_task(self):
+        """run_alyx_task sets the admission and labels the refused task as Waiting"""
+        self.claim('Other', os.getppid(), ram=MACHINE_RESOURCES['ram'], cpu=1)
+        tdict = {'id': 'tid', 'name': '_DummyTask', 'parents': [], 'status': 'Waiting', 'log': '',
+                 'executable': 'ibllib.tests.test_pipes._DummyTask'}
+        one = mock.Mock()
+        one.alyx.rest.side_effect = lambda *args, id=None, data=None, **kwargs: {**tdict, **data}
+        for admission_wait_secs, status in [(None, 'Complete'), (0, 'Waiting')]:
+            t, _ = run_alyx_task(tdict=tdict, session_path=self.tmp_dir.name, one=one, job_deck=[dict(tdict)],
+                                 admission_wait_secs=admission_wait_secs)
+            self.assertEqual(t['status'], status)
+
+    def test_concurrent_claims(self):
+        # the claimants read the claims at the same time, and only one of them fits on the machine
+        machine_usage = Task.machine_usage
+
+        def slow_machine_usage():
+            usage = machine_usage()
+            time.sleep(.5)
+            return usage
+
+        admitted = {}
+
+        def claim(task):
+            task.admission_wait_secs = 0
+            admitted[task.name] = task._claims_resources()
+
+        tasks = [_DummyTask(self.tmp_dir.name), _OtherDummyTask(self.tmp_dir.name)]
+        with mock.patch.object(Task, 'machine_usage', side_effect=slow_machine_usage):
+            claimants = [threading.Thread(target=claim, args=(task,)) for task in tasks]
+            for t in claimants:
+                t.start()
+            for t in claimants:
+                t.join()
+        self.assertEqual(sorted(admitted.values()), [False, True])
+        self.assertEqual(len(list(Path(self.tmp_dir.name).glob('*.json'))), 1)
+
+
+class TestTaskMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_metrics(self):
+        session_path = Path(self.tmp_dir.name).joinpath('subject', '2022-01-01', '001')
+        session_path.mkdir(parents=True)
+        task = _DummyTask(session_path)
+        task.profile = True
+        self.assertEqual(task.run(), 0)
+        self.assertEqual(set(task.metrics['stages'].keys()), {'setUp', '_run', 'tearDown'})
+        self.assertTrue(any('_run' in f['function'] for f in task.metrics['profile']))
+        # the run doesn't write in the session, the metrics are written on demand after the registration
+        self.assertFalse(session_path.joinpath('logs').exists())
+        with task._stage('register_datasets'):
+            pass
+        task.write_metrics()
+        self.assertTrue(session_path.joinpath('logs', '_DummyTask.prof').exists())
+        df = load_task_metrics(self.tmp_dir.name)
+        self.assertEqual(df.shape[0], 1)
+        self.assertEqual(df['name'][0], '_DummyTask')
+        self.assertIn('stages.register_datasets.secs', df.columns)
+        self.assertIn('usage.peak_rss', df.columns)
+
+
+class _SessionsRest:
+    """Stand-in for one.alyx with a sessions list endpoint, counts the requests"""
+
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self.nqueries = 0
+
+    def rest(self, url, action, django=''):
+        assert (url, action) == ('sessions', 'list')
+        self.nqueries += 1
+        eids = eval(django.split(',', 1)[1])
+        return [s for s in self.sessions if s['id'] in eids]
+
+
+class TestSessionPaths(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        sessions = [{'id': f'eid{i}', 'subject': f'subject{i % 2}', 'start_time': f'2022-01-0{i + 1}T10:00:00',
+                     'number': i} for i in range(5)]
+        self.one = mock.Mock()
+        self.one.alyx = _SessionsRest(sessions)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_get_session_paths(self):
+        cache_file = Path(self.tmp_dir.name).joinpath('session_paths.json')
+        eids = ['eid3', 'eid0', 'eid3', 'eid4', 'unknown']
+        with mock.patch.object(misc, 'SESSION_PATHS_QUERY_SIZE', 2):
+            paths = misc.get_session_paths('/mnt/s0/Subjects', eids, self.one, cache_file=cache_file)
+        self.assertEqual(self.one.alyx.nqueries, 2)
+        self.assertEqual(list(paths.keys()), ['eid3', 'eid0', 'eid4'])
+        self.assertEqual(paths['eid3'], Path('/mnt/s0/Subjects/subject1/2022-01-04/003'))
+        # the second call only queries the sessions that were not found
+        paths_ = misc.get_session_paths('/mnt/s0/Subjects', eids, self.one, cache_file=cache_file)
+        self.assertEqual(paths, paths_)
+        self.assertEqual(self.one.alyx.nqueries, 3)
+        # expired entries are queried again
+        misc.get_session_paths('/mnt/s0/Subjects', ['eid3'], self.one, cache_file=cache_file, ttl=0)
+        self.assertEqual(self.one.alyx.nqueries, 4)
+
+
 if __name__ == "__main__":
     unittest.main(exit=False, verbosity=2)